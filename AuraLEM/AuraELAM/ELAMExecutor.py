@@ -0,0 +1,438 @@
+'''
+Background executors for asynchronous ELAM analyses (LEMTestUtilities.analyze_async). In container/local deployments
+FakeLambdaClient hands analyses to one of these instead of running them inline, so the chat request returns as soon as
+synchronize_ddb has finished. Selected with the "elam_executor" cw_config entry:
+  None      - run inline (the original behaviour)
+  "thread"  - a thread pool in this process
+  "process" - a process pool (analyses don't hold the GIL of the chat process)
+  "sqlite"  - a durable SQLite job queue drained by worker processes; queued jobs survive a restart
+
+All executors bound concurrency (workers) and the number of pending jobs (submit is rejected when full), report job
+status and drain gracefully on shutdown. Analyses run in another process update that process's context cache: the
+executors put the UDS of finished jobs into the chat process's cache as well.
+'''
+
+import os
+import time
+import atexit
+import sqlite3
+import threading
+import multiprocessing
+import simplejson as json
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+REQUEUE_INTERVAL_SECONDS = 30 # how often sqlite workers requeue jobs whose lease ran out
+
+
+def run_elam_job(payload):
+  '''
+  Runs one analysis. Top-level so process pools & worker processes can import it.
+  Returns (status, result). result['queue_lag_seconds'] is how long the analysis waited to start since it was queued.
+  '''
+  from LEMTestUtilities import analyze_async
+  from Tracing import traced_invocation, span, observe
+  started_at = time.time()
+
+  with traced_invocation('ELAM') as trace:
+    try:
+      with span('analyze_async'):
+        result = analyze_async(payload, {})
+      status = SUCCEEDED if result.get('statusCode') == 200 else FAILED
+    except Exception as e:
+      status, result = FAILED, {'statusCode': 500, 'body': json.dumps(f'ELAM job raised: {repr(e)}')}
+
+    if result.get('uds') is not None: result = dict(result, cache_key=[payload['api_key'], payload['uid'], payload['iid']])
+    if payload.get('queued_at') is not None:
+      result = dict(result, queue_lag_seconds=max(started_at - float(payload['queued_at']), 0.0))
+      observe('elam_queue_lag_ms', result['queue_lag_seconds'] * 1000)
+    if trace is not None: trace.set_property('statusCode', result.get('statusCode'))
+
+  return (status, result)
+
+
+def cache_job_result(result):
+  '''
+  Puts the UDS a finished job wrote into this process's context cache (a no-op for a cache that already has it).
+  '''
+  from ContextCache import context_cache
+  if result is not None and result.get('cache_key') is not None:
+    context_cache.update_uds(tuple(result['cache_key']), result['uds'], result['uds_sortk'])
+
+
+class PoolELAMExecutor():
+  '''
+  Runs jobs on a concurrent.futures pool. Job status is kept in memory for the last max_history jobs.
+  '''
+  cache_results = False # whether finished jobs' UDS must be put into this process's context cache
+
+  def __init__(self, pool, max_pending=64, max_history=1024):
+    self.pool = pool
+    self.max_pending = max_pending
+    self.max_history = max_history
+
+    self.jobs = OrderedDict() # { job_id: { 'status', 'result', 'submitted_at', 'finished_at' } }, oldest first
+    self.lags = deque(maxlen=max_history) # queue lags (seconds) of the last max_history jobs
+    self.futures = {} # { job_id: future } of unfinished jobs
+    self.lock = threading.Lock()
+    self.next_id = 0
+    self.accepting = True
+
+    self.submitted = 0
+    self.rejected = 0
+    self.succeeded = 0
+    self.failed = 0
+
+
+  def submit(self, payload):
+    '''
+    Queues an analysis. Returns its job id, or None if the executor is full or shutting down.
+    '''
+    with self.lock:
+      if not self.accepting or len(self.futures) >= self.max_pending:
+        self.rejected += 1
+        return None
+
+      self.next_id += 1
+      job_id = str(self.next_id)
+      self.jobs[job_id] = {'status': QUEUED, 'result': None, 'submitted_at': time.time(), 'finished_at': None}
+      self.submitted += 1
+
+      while len(self.jobs) > self.max_history:
+        oldest_id = next(iter(self.jobs))
+        if oldest_id in self.futures: break
+        del self.jobs[oldest_id]
+
+      future = self.pool.submit(run_elam_job, payload)
+      self.futures[job_id] = future
+
+    future.add_done_callback(lambda future: self.finish(job_id, future))
+    return job_id
+
+
+  def finish(self, job_id, future):
+    try:
+      status, result = future.result()
+    except Exception as e:
+      # e.g. the worker process died
+      status, result = FAILED, {'statusCode': 500, 'body': json.dumps(f'ELAM job failed: {repr(e)}')}
+
+    with self.lock:
+      self.futures.pop(job_id, None)
+      if status == SUCCEEDED: self.succeeded += 1
+      else: self.failed += 1
+      if 'queue_lag_seconds' in result: self.lags.append(result['queue_lag_seconds'])
+
+      job = self.jobs.get(job_id)
+      if job is not None:
+        job.update({'status': status, 'result': result, 'finished_at': time.time()})
+
+    if self.cache_results: cache_job_result(result)
+
+
+  def status(self, job_id):
+    '''
+    Returns { 'status', 'result', 'submitted_at', 'finished_at' } of a job, or None if it is unknown.
+    '''
+    with self.lock:
+      job = self.jobs.get(job_id)
+      if job is None: return None
+
+      job = dict(job)
+      future = self.futures.get(job_id)
+      if future is not None and future.running(): job['status'] = RUNNING
+      return job
+
+
+  def queue_lags(self):
+    '''
+    Returns the queue lags (seconds from the turn queueing an analysis to its job starting) of recent jobs, oldest first.
+    '''
+    with self.lock:
+      return list(self.lags)
+
+
+  def stats(self):
+    with self.lock:
+      return {
+        'pending': len(self.futures),
+        'submitted': self.submitted,
+        'rejected': self.rejected,
+        'succeeded': self.succeeded,
+        'failed': self.failed
+      }
+
+
+  def shutdown(self, wait=True, cancel_pending=False):
+    '''
+    Stops accepting jobs. With wait, blocks until the running (and, unless cancel_pending, the queued) jobs finish.
+    '''
+    with self.lock:
+      self.accepting = False
+    self.pool.shutdown(wait=wait, cancel_futures=cancel_pending)
+
+
+class ThreadELAMExecutor(PoolELAMExecutor):
+  def __init__(self, max_workers=2, max_pending=64):
+    super().__init__(ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='elam'), max_pending)
+
+
+class ProcessELAMExecutor(PoolELAMExecutor):
+  '''
+  Worker processes are spawned (not forked) so they don't inherit the chat process's boto3 clients & threads.
+  Analyses update the context cache of the worker process: finished jobs' UDS is put into this process's cache on return.
+  '''
+  cache_results = True
+
+  def __init__(self, max_workers=2, max_pending=64, start_method='spawn'):
+    super().__init__(ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method)), max_pending)
+
+
+def connect_job_queue(path):
+  connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+  connection.execute("PRAGMA journal_mode=WAL")
+  connection.execute("""CREATE TABLE IF NOT EXISTS elam_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+  )""")
+  connection.execute("CREATE INDEX IF NOT EXISTS elam_jobs_status ON elam_jobs (status, id)")
+  return connection
+
+
+def claim_job(connection):
+  '''
+  Atomically marks the oldest queued job running. Returns (id, payload) or None.
+  '''
+  connection.execute("BEGIN IMMEDIATE")
+  try:
+    row = connection.execute("SELECT id, payload FROM elam_jobs WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)).fetchone()
+    if row is not None:
+      connection.execute("UPDATE elam_jobs SET status = ?, started_at = ?, attempts = attempts + 1 WHERE id = ?", (RUNNING, time.time(), row[0]))
+    connection.execute("COMMIT")
+  except Exception:
+    connection.execute("ROLLBACK")
+    raise
+
+  return row
+
+
+def requeue_expired_jobs(connection, lease_seconds, max_attempts):
+  '''
+  Requeues jobs left running past their lease (their worker died), or fails them once they have had max_attempts.
+  '''
+  expired = time.time() - lease_seconds
+  connection.execute("UPDATE elam_jobs SET status = ? WHERE status = ? AND started_at < ? AND attempts < ?",
+    (QUEUED, RUNNING, expired, max_attempts))
+  connection.execute("UPDATE elam_jobs SET status = ?, finished_at = ? WHERE status = ? AND started_at < ?",
+    (FAILED, time.time(), RUNNING, expired))
+
+
+def sqlite_worker(path, drain_event, stop_event, poll_seconds=0.5, lease_seconds=900, max_attempts=3):
+  '''
+  Worker process loop: runs queued jobs until stop_event is set, or drain_event is set and the queue is empty.
+  Every REQUEUE_INTERVAL_SECONDS it also requeues the expired jobs of workers that died.
+  '''
+  connection = connect_job_queue(path)
+  requeued_at = 0.0
+
+  while not stop_event.is_set():
+    if time.monotonic() - requeued_at >= REQUEUE_INTERVAL_SECONDS:
+      requeue_expired_jobs(connection, lease_seconds, max_attempts)
+      requeued_at = time.monotonic()
+
+    job = claim_job(connection)
+    if job is None:
+      if drain_event.is_set(): break
+      time.sleep(poll_seconds)
+      continue
+
+    job_id, payload = job
+    status, result = run_elam_job(json.loads(payload))
+    connection.execute("UPDATE elam_jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+      (status, json.dumps(result), time.time(), job_id))
+
+  connection.close()
+
+
+class SQLiteELAMExecutor():
+  '''
+  Durable job queue in a SQLite (WAL) database, drained by worker processes. Jobs left running by a process that died
+  are requeued (up to max_attempts) by the workers once their lease_seconds have passed, so a crash doesn't lose
+  analyses. A worker that died is replaced on the next submit.
+  '''
+
+  def __init__(self, path, workers=2, max_pending=256, max_attempts=3, lease_seconds=900, poll_seconds=0.5, start_method='spawn'):
+    self.path = path
+    self.max_pending = max_pending
+    self.max_attempts = max_attempts
+    self.lease_seconds = lease_seconds
+    self.poll_seconds = poll_seconds
+    self.accepting = True
+    self.rejected = 0
+    self.restarts = 0 # workers replaced after dying
+    self.cached_ids = set() # finished jobs after cached_id whose UDS is in this process's context cache
+
+    self.connection = connect_job_queue(path)
+    self.lock = threading.Lock() # the connection is shared by the handler's threads
+    self.requeue_expired()
+
+    # the UDS of every finished job up to this id is in this process's context cache (or predates it: jobs that finished
+    # before this start have nothing to put in a new cache)
+    self.cached_id = self.connection.execute("SELECT COALESCE((SELECT MIN(id) - 1 FROM elam_jobs WHERE status IN (?, ?)), " \
+      "(SELECT MAX(id) FROM elam_jobs), 0)", (QUEUED, RUNNING)).fetchone()[0]
+
+    self.context = multiprocessing.get_context(start_method)
+    self.drain_event = self.context.Event()
+    self.stop_event = self.context.Event()
+    self.workers = [self.start_worker() for _ in range(workers)]
+
+
+  def start_worker(self):
+    worker = self.context.Process(target=sqlite_worker, daemon=True,
+      args=(self.path, self.drain_event, self.stop_event, self.poll_seconds, self.lease_seconds, self.max_attempts))
+    worker.start()
+    return worker
+
+
+  def requeue_expired(self):
+    with self.lock:
+      requeue_expired_jobs(self.connection, self.lease_seconds, self.max_attempts)
+
+
+  def restart_dead_workers(self):
+    # called holding the lock. Their running jobs are requeued by the other workers once the lease runs out
+    for i, worker in enumerate(self.workers):
+      if not worker.is_alive():
+        self.workers[i] = self.start_worker()
+        self.restarts += 1
+
+
+  def cache_finished_results(self):
+    '''
+    Puts the UDS of the jobs that finished since the last call into this process's context cache. Called holding the lock.
+    '''
+    rows = self.connection.execute("SELECT id, status, result FROM elam_jobs WHERE id > ? ORDER BY id", (self.cached_id,)).fetchall()
+
+    unfinished = False
+    for job_id, status, result in rows:
+      if status in (QUEUED, RUNNING): unfinished = True
+      elif job_id not in self.cached_ids:
+        if result is not None: cache_job_result(json.loads(result))
+        if unfinished: self.cached_ids.add(job_id)
+
+      if not unfinished:
+        self.cached_id = job_id
+        self.cached_ids.discard(job_id)
+
+
+  def submit(self, payload):
+    with self.lock:
+      if not self.accepting:
+        self.rejected += 1
+        return None
+
+      self.restart_dead_workers()
+      self.cache_finished_results()
+
+      pending = self.connection.execute("SELECT COUNT(*) FROM elam_jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchone()[0]
+      if pending >= self.max_pending:
+        self.rejected += 1
+        return None
+
+      cursor = self.connection.execute("INSERT INTO elam_jobs (payload, status, submitted_at) VALUES (?, ?, ?)",
+        (json.dumps(payload), QUEUED, time.time()))
+      return str(cursor.lastrowid)
+
+
+  def status(self, job_id):
+    with self.lock:
+      row = self.connection.execute("SELECT status, result, submitted_at, finished_at, attempts FROM elam_jobs WHERE id = ?", (int(job_id),)).fetchone()
+    if row is None: return None
+
+    return {
+      'status': row[0],
+      'result': json.loads(row[1]) if row[1] is not None else None,
+      'submitted_at': row[2],
+      'finished_at': row[3],
+      'attempts': row[4]
+    }
+
+
+  def queue_lags(self, limit=1024):
+    # of the last limit finished jobs, oldest first
+    with self.lock:
+      rows = self.connection.execute("SELECT result FROM elam_jobs WHERE result IS NOT NULL ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+
+    results = [json.loads(row[0]) for row in reversed(rows)]
+    return [result['queue_lag_seconds'] for result in results if 'queue_lag_seconds' in result]
+
+
+  def stats(self):
+    with self.lock:
+      counts = dict(self.connection.execute("SELECT status, COUNT(*) FROM elam_jobs GROUP BY status").fetchall())
+
+    return {
+      'pending': counts.get(QUEUED, 0) + counts.get(RUNNING, 0),
+      'queued': counts.get(QUEUED, 0),
+      'running': counts.get(RUNNING, 0),
+      'succeeded': counts.get(SUCCEEDED, 0),
+      'failed': counts.get(FAILED, 0),
+      'rejected': self.rejected,
+      'workers': sum(worker.is_alive() for worker in self.workers),
+      'restarts': self.restarts
+    }
+
+
+  def shutdown(self, wait=True, cancel_pending=False, timeout=None):
+    '''
+    Stops accepting jobs. The workers finish the queued jobs first unless cancel_pending, in which case they stop after
+    their current job and the rest stay queued in the database for the next start.
+    '''
+    with self.lock:
+      self.accepting = False
+
+    self.drain_event.set()
+    if cancel_pending: self.stop_event.set()
+
+    if wait:
+      for worker in self.workers: worker.join(timeout)
+
+
+elam_executors = {} # { (kind, workers): executor }, one per process
+
+def get_elam_executor(cw_config):
+  '''
+  Returns the process-wide ELAM executor selected by cw_config, or None to run analyses inline.
+  Executors are drained when the process exits. Worker processes open the store configure_storage selected.
+  '''
+  kind = cw_config.get("elam_executor")
+  if kind is None: return None
+
+  workers = cw_config.get("elam_executor_workers", 2)
+  if (kind, workers) not in elam_executors:
+    from DynamoDBUtilities import get_storage
+    if kind in ("process", "sqlite") and get_storage().name == "memory":
+      raise ValueError(f'ELAM executor "{kind}" runs analyses in other processes, which can\'t see the "memory" store: use "sqlite" storage')
+
+    if kind == "thread": executor = ThreadELAMExecutor(workers, cw_config.get("elam_executor_max_pending", 64))
+    elif kind == "process": executor = ProcessELAMExecutor(workers, cw_config.get("elam_executor_max_pending", 64))
+    elif kind == "sqlite":
+      path = cw_config.get("elam_executor_path") or os.environ.get('aura_elam_queue_path', 'elam_jobs.sqlite3')
+      executor = SQLiteELAMExecutor(path, workers, cw_config.get("elam_executor_max_pending", 256))
+    else: raise ValueError(f"Unknown ELAM executor: {kind}")
+
+    atexit.register(executor.shutdown)
+    elam_executors[(kind, workers)] = executor
+
+  return elam_executors[(kind, workers)]
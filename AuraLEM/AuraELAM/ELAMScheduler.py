@@ -0,0 +1,246 @@
+'''
+Per-thread coalescing of async ELAM analyses. Wraps an ELAMExecutor: analyses submitted for the same communication
+thread within debounce_seconds are merged into one call over their combined (contiguous) windows, and a thread never has
+more than one analysis running, so UDS rewrites apply in order instead of racing on a stale UDS.
+Enabled with the "elam_debounce_seconds" cw_config entry (0 disables it).
+'''
+
+import time
+import atexit
+import threading
+import simplejson as json
+from collections import deque, OrderedDict
+from AuraELAM.ELAMExecutor import QUEUED, RUNNING, get_elam_executor
+
+# batches whose result can still be looked up with status()
+MAX_BATCH_HISTORY = 1024
+
+
+class CoalescingELAMExecutor():
+  '''
+  Same interface as the ELAM executors (submit, status, stats, shutdown).
+  Per thread a deque of batches is kept, oldest first; only the newest one still accepts merges. A batch is dispatched to
+  the executor once its debounce interval has passed and the thread's previous analysis has finished.
+  '''
+
+  def __init__(self, executor, debounce_seconds=2.0, max_payload_bytes=200000, poll_seconds=0.25):
+    self.executor = executor
+    self.debounce_seconds = debounce_seconds
+    self.max_payload_bytes = max_payload_bytes
+    self.poll_seconds = poll_seconds
+
+    # { (api_key, uid, iid): { 'batches': deque of batches, 'job_id': of the last dispatched batch } }
+    self.threads = {}
+    self.batches = OrderedDict() # { batch_id: batch }
+    self.condition = threading.Condition()
+    self.next_id = 0
+    self.accepting = True
+    self.stopping = False
+
+    self.submitted = 0
+    self.merged = 0
+    self.dispatched = 0
+    self.rejected = 0
+
+    self.flusher = threading.Thread(target=self.flush_loop, name='elam-scheduler', daemon=True)
+    self.flusher.start()
+
+
+  def thread_busy(self, state):
+    # caller holds the condition. Whether the thread's last dispatched analysis is still queued/running
+    if state['job_id'] is None: return False
+
+    job = self.executor.status(state['job_id'])
+    return job is not None and job['status'] in (QUEUED, RUNNING)
+
+
+  def can_merge(self, batch, payload):
+    older, newer = batch['payload'], payload
+    if "analysis_window" not in older or "analysis_window" not in newer: return False
+
+    return len(json.dumps(newer)) + len(json.dumps(older["analysis_window"])) <= self.max_payload_bytes
+
+
+  def merge(self, batch, payload):
+    '''
+    Folds a newer analysis into the batch. Windows are newest first and contiguous (each async analysis starts the next
+    analysis window), so the merged window is the newer one followed by the older one.
+    '''
+    older = batch['payload']
+    merged = dict(payload)
+    merged["analysis_window"] = payload["analysis_window"] + older["analysis_window"]
+    merged["limits"] = [int(payload["limits"][0]) + len(older["analysis_window"]), int(payload["limits"][1])]
+    merged["context_snapshot"] = bool(payload.get("context_snapshot")) or bool(older.get("context_snapshot"))
+    if "queued_at" in older: merged["queued_at"] = older["queued_at"] # the batch waits since its oldest analysis was queued
+
+    batch['payload'] = merged
+    batch['count'] += 1
+
+
+  def submit(self, payload):
+    '''
+    Queues an analysis, merging it into the thread's open batch if there is one. Returns the batch id (shared by merged
+    analyses), or None if the scheduler is shutting down.
+    '''
+    key = (str(payload["api_key"]), str(payload["uid"]), str(payload["iid"]))
+
+    with self.condition:
+      if not self.accepting:
+        self.rejected += 1
+        return None
+
+      self.submitted += 1
+      state = self.threads.setdefault(key, {'batches': deque(), 'job_id': None})
+
+      open_batch = state['batches'][-1] if state['batches'] and state['batches'][-1]['open'] else None
+      if open_batch is not None and self.can_merge(open_batch, payload):
+        self.merge(open_batch, payload)
+        self.merged += 1
+        return open_batch['id']
+
+      # this batch is closed to merges from now on (its successor carries the newer windows)
+      if open_batch is not None: open_batch['open'] = False
+
+      self.next_id += 1
+      batch = {
+        'id': f'b{self.next_id}',
+        'key': key,
+        'payload': dict(payload),
+        'count': 1,
+        'open': True,
+        'due_at': time.monotonic() + self.debounce_seconds,
+        'job_id': None
+      }
+      state['batches'].append(batch)
+      self.batches[batch['id']] = batch
+
+      while len(self.batches) > MAX_BATCH_HISTORY:
+        oldest_id = next(iter(self.batches))
+        if self.batches[oldest_id]['job_id'] is None: break
+        del self.batches[oldest_id]
+
+      self.condition.notify()
+      return batch['id']
+
+
+  def flush_due(self, force=False):
+    '''
+    Dispatches the head batch of every idle thread whose debounce has passed (all of them with force). Returns the
+    number of batches still waiting. Caller holds the condition.
+    '''
+    now = time.monotonic()
+    waiting = 0
+
+    for key in list(self.threads):
+      state = self.threads[key]
+      if not state['batches']:
+        if not self.thread_busy(state): del self.threads[key]
+        continue
+
+      batch = state['batches'][0]
+      if (not force and batch['due_at'] > now) or self.thread_busy(state):
+        waiting += len(state['batches'])
+        continue
+
+      job_id = self.executor.submit(batch['payload'])
+      if job_id is None:
+        # the executor is full: keep the batch (still open to merges) and retry on the next poll
+        batch['due_at'] = now + self.poll_seconds
+        waiting += len(state['batches'])
+        continue
+
+      state['batches'].popleft()
+      batch['open'] = False
+      batch['job_id'] = job_id
+      state['job_id'] = job_id
+      self.dispatched += 1
+      waiting += len(state['batches'])
+
+    return waiting
+
+
+  def flush_loop(self):
+    with self.condition:
+      while not self.stopping:
+        self.flush_due()
+
+        # sleep until the next debounce ends; heads that are already due are waiting on a busy thread: poll those
+        due_times = [state['batches'][0]['due_at'] for state in self.threads.values() if state['batches']]
+        timeout = min(due_times) - time.monotonic() if due_times else None
+        self.condition.wait(timeout if timeout is None or timeout > 0 else self.poll_seconds)
+
+
+  def status(self, batch_id):
+    '''
+    Returns { 'status', 'merged', 'job_id', ... } of a batch: queued until dispatched, then the executor's job status.
+    '''
+    with self.condition:
+      batch = self.batches.get(batch_id)
+      if batch is None: return None
+      batch = dict(batch)
+
+    if batch['job_id'] is None:
+      return {'status': QUEUED, 'result': None, 'merged': batch['count'], 'job_id': None}
+
+    job = dict(self.executor.status(batch['job_id']) or {'status': None, 'result': None})
+    job.update({'merged': batch['count'], 'job_id': batch['job_id']})
+    return job
+
+
+  def queue_lags(self):
+    return self.executor.queue_lags()
+
+
+  def stats(self):
+    with self.condition:
+      stats = {
+        'submitted': self.submitted,
+        'merged': self.merged, # analyses folded into another one's call
+        'dispatched': self.dispatched,
+        'rejected': self.rejected,
+        'waiting': sum(len(state['batches']) for state in self.threads.values())
+      }
+    stats['executor'] = self.executor.stats()
+    return stats
+
+
+  def shutdown(self, wait=True, cancel_pending=False):
+    '''
+    Stops accepting analyses. With wait, dispatches the waiting batches without debounce (still one at a time per thread)
+    and drains the executor; with cancel_pending, waiting batches are dropped.
+    '''
+    with self.condition:
+      self.accepting = False
+      if cancel_pending:
+        for state in self.threads.values(): state['batches'].clear()
+
+    while wait:
+      with self.condition:
+        if self.flush_due(force=True) == 0: break
+      time.sleep(self.poll_seconds)
+
+    with self.condition:
+      self.stopping = True
+      self.condition.notify()
+
+    self.executor.shutdown(wait=wait, cancel_pending=cancel_pending)
+
+
+coalescing_executors = {} # { id(executor): CoalescingELAMExecutor }, one per process
+
+def get_coalescing_executor(cw_config):
+  '''
+  Returns the process-wide ELAM executor selected by cw_config, wrapped in a CoalescingELAMExecutor when
+  "elam_debounce_seconds" > 0, or None to run analyses inline.
+  '''
+  executor = get_elam_executor(cw_config)
+  debounce_seconds = cw_config.get("elam_debounce_seconds", 0)
+  if executor is None or debounce_seconds <= 0: return executor
+
+  if id(executor) not in coalescing_executors:
+    coalescing_executor = CoalescingELAMExecutor(executor, debounce_seconds)
+    # registered after the executor's own shutdown, so it runs first and flushes into a live executor
+    atexit.register(coalescing_executor.shutdown)
+    coalescing_executors[id(executor)] = coalescing_executor
+
+  return coalescing_executors[id(executor)]
@@ -1,18 +1,64 @@
-from openai import OpenAI
-import os
+from AuraOpenAI.ClientRegistry import get_openai_client
 import simplejson as json
+import time
 import boto3
+import threading
+import contextvars
+from types import SimpleNamespace
 from DynamoDBUtilities import *
 from AuraELAM.UDSUtilities import validate_response
-
-client = boto3.resource('dynamodb', region_name='us-east-1')
-table = client.Table('UserData')
+from AuraOpenAI.RateLimiter import admission, estimate_request_tokens, PRIORITY_ELAM_SYNC
+from AuraOpenAI.LatencyPolicy import close_stream
+from ContextCache import context_cache
+from ContextSnapshot import update_context_snapshot_uds
+from Tracing import count
 
 # lambda_client = boto3.client('lambda')
 from LEMTestUtilities import FakeLambdaClient
+from AuraELAM.ELAMScheduler import get_coalescing_executor
 lambda_client = FakeLambdaClient()
 
+ABANDONED_RESPONSE = {
+  'statusCode': 409,
+  'body': json.dumps('UDS analysis abandoned.')
+}
+
+def use_elam_executor(cw_config):
+  '''
+  Makes the fake lambda client hand async analyses to the background executor selected by cw_config, so the chat
+  request doesn't wait on them (local/container deployments). Analyses of the same thread are coalesced if
+  "elam_debounce_seconds" is set.
+  '''
+  lambda_client.executor = get_coalescing_executor(cw_config)
+
 def analyze_sync(event, context):
+  error_response, modified_UDS = synthesize_uds(event)
+  if error_response is not None: return error_response
+
+  return store_uds(event, modified_UDS)
+
+
+def request_uds(openai_client, model, api_key, messages, elam_response_mtl):
+  '''
+  One ELAM call, admitted by the rate limiter and settled on its usage. Returns the completion.
+  '''
+  reserved_tokens = estimate_request_tokens(messages, elam_response_mtl)
+  admission.acquire(model, api_key, reserved_tokens, PRIORITY_ELAM_SYNC)
+  response = openai_client.chat.completions.create(model=model,
+  messages=messages,
+  stop=None,
+  response_format={"type": "json_object"},
+  max_tokens=elam_response_mtl)
+  admission.settle(model, api_key, reserved_tokens, getattr(getattr(response, 'usage', None), 'total_tokens', None))
+  return response
+
+
+def synthesize_uds(event, request=request_uds):
+  '''
+  Asks the ELAM for the UDS rewritten from event's analysis window. Returns (None, modified UDS), or
+  (error response, None) if no valid UDS came back.
+  request: makes each ELAM call (see request_uds). Returning None instead of a completion abandons the analysis.
+  '''
   # Get the chat history from step function input
   api_key = str(event["api_key"])
   uid = str(event["uid"])
@@ -20,16 +66,18 @@ def analyze_sync(event, context):
   elam_response_mtl = int(event["elam_response_mtl"])
   message_history = event["analysis_window"]
 
-  # Get API key from environment
-  openai_key = os.environ['openai_key']
-  openai_client = OpenAI(api_key=openai_key)
+  # shared client: reuses this process's connections to the API
+  openai_client = get_openai_client()
   
   # Specify the AI model
   model = "gpt-4-1106-preview"
   
   # create the UDS parition key
   UDS_partition_key = api_key + uid + iid + 'UDS'
-  latest_UDS = full_limit_query(UDS_partition_key, False)
+  if "uds" in event:
+    latest_UDS = [{'uds': event["uds"]}]
+  else:
+    latest_UDS = full_limit_query(UDS_partition_key, False)
 
   # Check if latest_UDS exists, if not create a blank one
   if latest_UDS == []:
@@ -49,6 +97,49 @@ def analyze_sync(event, context):
   else:
     latest_UDS = latest_UDS[0]['uds']
 
+  messages = build_elam_messages(latest_UDS, message_history)
+
+  response = request(openai_client, model, api_key, messages, elam_response_mtl)
+  if response is None: return (ABANDONED_RESPONSE, None)
+
+  validated, modified_UDS = validate_response(response)
+
+  # If validation fails try again once more with new message
+  if not validated:
+    print("VALIDATION FAILED. NEEDED RETRY.")
+    count('elam_validation_retries')
+
+    messages.append({
+      "role": "assistant",
+      "content": response.choices[0].message.content
+    })
+
+    messages.append({
+      "role": "user",
+      "content": "This response is not a valid UDS, incorrect syntax. Please try one more time. It is EXTREMELY IMPORTANT that you get the syntax correct as per the system message."
+    })
+      
+    response = request(openai_client, model, api_key, messages, elam_response_mtl)
+    if response is None: return (ABANDONED_RESPONSE, None)
+
+    validated, modified_UDS = validate_response(response)
+    
+  # If validation fails again, return error
+  if not validated:
+    count('elam_validation_failures')
+    return ({
+      'statusCode': 500,
+      'body': json.dumps('Failed to generate UDS.')
+    }, None)
+
+  # at this point, after a max of one retry, it is necessarily valid. Else would have failed.
+  return (None, modified_UDS)
+
+
+def build_elam_messages(latest_UDS, message_history):
+  '''
+  Returns the ELAM prompt: the system message with the current UDS, and the analysis window (newest first) as one user message.
+  '''
   system_message = f"""
     You are being used via API in an LLM chat app which can 'learn' its own users through its chats with them. It works through AI agents: you are such an agent, located in our backend. Your output will never be directly seen by the user but rather you are a reasoning module whose purpose is to initialize & modify the user understanding data structure (UDS) based off chat history.
     
@@ -107,58 +198,35 @@ def analyze_sync(event, context):
       "content": user_message
     }
   ]
-  
-  response = openai_client.chat.completions.create(model=model,
-  messages=messages,
-  stop=None,
-  response_format={"type": "json_object"},
-  max_tokens=elam_response_mtl)
 
-  validated, modified_UDS = validate_response(response)
-
-  # If validation fails try again once more with new message
-  if not validated:
-    print("VALIDATION FAILED. NEEDED RETRY.")
-
-    messages.append({
-      "role": "assistant",
-      "content": response
-    })
+  return messages
 
-    messages.append({
-      "role": "user",
-      "content": "This response is not a valid UDS, incorrect syntax. Please try one more time. It is EXTREMELY IMPORTANT that you get the syntax correct as per the system message."
-    })
-      
-    response = openai_client.chat.completions.create(model=model,
-    messages=messages,
-    stop=None,
-    response_format={"type": "json_object"},
-    max_tokens=elam_response_mtl)
 
-    validated, modified_UDS = validate_response(response)
-    
-  # If validation fails again, return error
-  if not validated:
-    return {
-      'statusCode': 500,
-      'body': json.dumps('Failed to generate UDS.')
-    }
-
-  # at this point, after a max of one retry, it is necessarily valid. Else would have failed.
+def store_uds(event, modified_UDS, sortk=None):
+  '''
+  Writes modified_UDS as the thread's latest UDS (and through to this container's caches), at sortk (default: now).
+  '''
+  api_key = str(event["api_key"])
+  uid = str(event["uid"])
+  iid = str(event["iid"])
+  UDS_partition_key = api_key + uid + iid + 'UDS'
 
   # create the new UDS sort key
   print("modified UDS: ", modified_UDS, "\n\n")
 
   item={
     'partitionk': UDS_partition_key,
-    'sortk': get_sortk_timestamp(),
+    'sortk': sortk or get_sortk_timestamp(),
     'uds': modified_UDS
   }
 
   uds_put_response = put_item_ddb(item)
 
   if uds_put_response['statusCode'] == 200:
+    # keep this container's cached context on the new UDS
+    context_cache.update_uds((api_key, uid, iid), modified_UDS, item['sortk'])
+    if event.get("context_snapshot"): update_context_snapshot_uds(api_key, uid, iid, modified_UDS, item['sortk'])
+
     return {
       'statusCode': 200,
       'body': json.dumps('Successfully updated UDS.')
@@ -172,6 +240,9 @@ def analyze_sync(event, context):
 
 
 def analyze_async(payload):
+    # stamped so the ELAM job can report how long it waited to start (ELAMExecutor.run_elam_job)
+    payload = dict(payload, queued_at=time.time())
+
     # Define the parameters for invoking the Lambda
     params = {
         'FunctionName': 'other-lambda-function-name',  # Replace with the target Lambda function name
@@ -184,7 +255,136 @@ def analyze_async(payload):
     return response
 
 
-def analyze(analysis_input):
+class SpeculativeReflect():
+  '''
+  A force_reflect analysis started alongside the reply synthesis, over the analysis window plus the user message (the
+  intelligence message isn't known yet). Its UDS is only written once update_context_window confirms the turn runs the
+  synchronous reflect (finish); the intelligence message is then analyzed by a follow-up async analysis. Otherwise the
+  turn discards it (cancel): its request is streamed so it can be closed at once, and its rate limit reservation is
+  settled on the prompt alone.
+  '''
+
+  def __init__(self, event):
+    self.event = event
+    self.result = None # (error response, modified UDS) of synthesize_uds
+    self.error = None
+    self.cancelled = threading.Event()
+    self.stream = None # the ELAM request being read
+    self.lock = threading.Lock()
+    # runs in the turn's context, so its ELAM calls are counted in the turn's trace
+    self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self.run,), name='speculative-reflect', daemon=True)
+    self.thread.start()
+
+
+  def run(self):
+    try:
+      self.result = synthesize_uds(self.event, self.request)
+    except Exception as e:
+      self.error = e
+
+
+  def request(self, openai_client, model, api_key, messages, elam_response_mtl):
+    '''
+    request_uds, streamed so cancel can close it. Returns None once cancelled.
+    '''
+    if self.cancelled.is_set(): return None
+
+    reserved_tokens = estimate_request_tokens(messages, elam_response_mtl)
+    admission.acquire(model, api_key, reserved_tokens, PRIORITY_ELAM_SYNC)
+
+    parts = []
+    usage = None
+    try:
+      stream = openai_client.chat.completions.create(model=model,
+      messages=messages,
+      stop=None,
+      response_format={"type": "json_object"},
+      max_tokens=elam_response_mtl,
+      stream=True,
+      stream_options={"include_usage": True})
+
+      with self.lock: self.stream = stream
+      # (cancelled while it was being opened)
+      if self.cancelled.is_set(): close_stream(stream)
+
+      for chunk in stream:
+        if self.cancelled.is_set(): break
+
+        # the final chunk carries only the usage data, no choices
+        if len(chunk.choices) == 0:
+          if getattr(chunk, 'usage', None) is not None: usage = chunk.usage
+          continue
+        if getattr(chunk.choices[0].delta, 'content', None) is not None: parts.append(chunk.choices[0].delta.content)
+
+    except Exception:
+      # (closing the stream interrupts its read)
+      if not self.cancelled.is_set(): raise
+
+    if self.cancelled.is_set():
+      # closed before it finished generating: only its prompt counts
+      admission.settle(model, api_key, reserved_tokens, reserved_tokens - elam_response_mtl)
+      return None
+
+    admission.settle(model, api_key, reserved_tokens, getattr(usage, 'total_tokens', None))
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="".join(parts)))], usage=usage)
+
+
+  def cancel(self):
+    '''
+    Discards the speculation: the turn doesn't run the synchronous reflect it speculated on.
+    '''
+    self.cancelled.set()
+    with self.lock: stream = self.stream
+    if stream is not None: close_stream(stream)
+
+
+  def finish(self, analysis_input):
+    '''
+    Completes the turn's synchronous analysis: writes the speculated UDS and queues the intelligence message's analysis.
+    Falls back to a regular analyze_sync if the speculation failed.
+    '''
+    self.thread.join()
+    if self.error is not None or self.result[0] is not None: return analyze_sync(analysis_input, {})
+
+    sortk = get_sortk_timestamp()
+    analysis_response = store_uds(analysis_input, self.result[1], sortk)
+    if analysis_response['statusCode'] != 200: return analysis_response
+
+    # the intelligence message is the newest message of the window, right before the (now empty) next analysis window
+    followup = {field: value for field, value in analysis_input.items() if field not in ('analysis_window', 'uds')}
+    followup.update({
+      'synchronous': False,
+      'limits': [1, 0],
+      'analysis_window': analysis_input['analysis_window'][:1]
+    })
+    analyze_async(followup)
+
+    return analysis_response
+
+
+def start_speculative_reflect(cw_response, cwm_response, cw_config, um, force_reflect):
+  '''
+  Starts the turn's force_reflect analysis before the reply is synthesized (if "speculative_reflect" is set). Returns a
+  SpeculativeReflect to pass to analyze (which cancels it if the turn doesn't run the reflect), or None.
+  Not started if the turn certainly won't run it: update_context_window queues an async analysis instead when the
+  analysis window overflows, which the user message alone already makes it do.
+  '''
+  if not force_reflect or not cw_config.get("speculative_reflect", False) or cwm_response['aw_overflow_reflect']: return None
+
+  elam_tl = cwm_response['cwm']['elam_aw_token_length'] + um['token_lengths'][cw_config['elam_token_type']]
+  if elam_tl > cw_config["elam_aw_mtl"]: return None
+
+  return SpeculativeReflect({
+    'api_key': cwm_response['api_key'],
+    'uid': cwm_response['uid'],
+    'iid': cwm_response['iid'],
+    'elam_response_mtl': cw_config["elam_response_mtl"],
+    'analysis_window': [um] + cw_response['aw'].to_list(),
+    'uds': cw_response['uds']
+  })
+
+
+def analyze(analysis_input, speculation=None):
   '''
   @param analysis_input: 
     analysis_input = {
@@ -195,12 +395,22 @@ def analyze(analysis_input):
       'uid': user_id,
       'iid': intelligence_id,
       'elam_response_mtl': 1393, # the max length of the response (in tokens of elam_token_type)
+      'analysis_window': [...], # the messages within limits, newest first (async: omitted if the payload is too large)
+      'uds': {...}, # synchronous only: the UDS the turn used (async jobs query the latest)
     }
+  @param speculation: the turn's SpeculativeReflect, if its force_reflect analysis was started early. Cancelled unless
+    analysis_input is the synchronous reflect it speculated on
   '''
   analysis_response = {}
 
+  if speculation is not None and not (analysis_input['analyze'] and analysis_input['synchronous']): speculation.cancel()
+
   if analysis_input['analyze']:
-    if analysis_input['synchronous']:
+    if analysis_input['synchronous'] and speculation is not None:
+      # the analysis already ran alongside the reply
+      analysis_response = speculation.finish(analysis_input)
+
+    elif analysis_input['synchronous']:
       # run the analysis synchronously
       payload = analysis_input
       analysis_response = analyze_sync(payload, {})
@@ -0,0 +1,129 @@
+'''
+Background sender for streamed replies. Reading the model's stream no longer waits on an API Gateway round trip per
+token: deltas are buffered and a sender thread posts them as "partial" frames, coalescing whatever arrived while the
+previous post was in flight (up to max_frame_chars per frame, and no delta waits longer than max_delay_seconds).
+The "complete" frame is sent last, after every partial frame.
+'''
+
+import time
+import threading
+import simplejson as json
+
+class FrameSender():
+  def __init__(self, conn, connection_id, max_frame_chars=256, max_delay_seconds=0.05):
+    self.conn = conn
+    self.connection_id = connection_id
+    self.max_frame_chars = max_frame_chars
+    self.max_delay_seconds = max_delay_seconds
+
+    self.pending = [] # deltas not yet posted, oldest first
+    self.pending_chars = 0
+    self.pending_since = None # when the oldest pending delta arrived
+    self.completed = False
+    self.closed = False
+    self.error = None
+    self.condition = threading.Condition()
+
+    self.deltas = 0
+    self.frames = 0
+    self.max_queue_depth = 0
+    self.send_seconds = [] # duration of each post
+
+    self.thread = threading.Thread(target=self.run, name='frame-sender', daemon=True)
+    self.thread.start()
+
+
+  def partial(self, text):
+    '''
+    Queues a delta of the reply. Never blocks on the socket.
+    '''
+    if not text: return
+
+    with self.condition:
+      if self.pending_since is None: self.pending_since = time.monotonic()
+      self.pending.append(text)
+      self.pending_chars += len(text)
+      self.deltas += 1
+      self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+      self.condition.notify()
+
+
+  def complete(self):
+    '''
+    Queues the "complete" frame, sent once every queued delta has been posted.
+    '''
+    with self.condition:
+      self.completed = True
+      self.condition.notify()
+
+
+  def post(self, message, status):
+    start = time.perf_counter()
+    self.conn.post_to_connection(Data=json.dumps({"message": message, "status": status}), ConnectionId=self.connection_id)
+    self.send_seconds.append(time.perf_counter() - start)
+    self.frames += 1
+
+
+  def take_frame(self):
+    # caller holds the condition. Removes and returns up to max_frame_chars of pending text (whole deltas, at least one)
+    size = 0
+    count = 0
+    while count < len(self.pending) and (count == 0 or size + len(self.pending[count]) <= self.max_frame_chars):
+      size += len(self.pending[count])
+      count += 1
+
+    frame = "".join(self.pending[:count])
+    del self.pending[:count]
+    self.pending_chars -= size
+    self.pending_since = time.monotonic() if self.pending else None
+    return frame
+
+
+  def run(self):
+    try:
+      while True:
+        with self.condition:
+          # wait until a frame is full, the oldest delta is due, or the reply is complete
+          while True:
+            if self.pending and (self.completed or self.closed or self.pending_chars >= self.max_frame_chars): break
+            if self.pending and time.monotonic() - self.pending_since >= self.max_delay_seconds: break
+            if not self.pending and (self.completed or self.closed): break
+            self.condition.wait(self.max_delay_seconds - (time.monotonic() - self.pending_since) if self.pending else None)
+
+          frame = self.take_frame() if self.pending else None
+          send_complete = frame is None and self.completed
+
+        if frame is not None: self.post(frame, "partial")
+        elif send_complete:
+          self.post("null", "complete")
+          return
+        else:
+          return
+
+    except Exception as e:
+      # e.g. the client disconnected: stop sending. The stream's reader checks error to stop early, close() re-raises it
+      self.error = e
+
+
+  def close(self):
+    '''
+    Waits until everything queued has been sent. Raises the error that stopped the sender, if any.
+    '''
+    with self.condition:
+      self.closed = True
+      self.condition.notify()
+    self.thread.join()
+
+    if self.error is not None: raise self.error
+
+
+  def stats(self):
+    ordered = sorted(self.send_seconds)
+    return {
+      'deltas': self.deltas,
+      'frames': self.frames,
+      'max_queue_depth': self.max_queue_depth,
+      'p50_send_ms': ordered[len(ordered) // 2] * 1000 if ordered else None,
+      'max_send_ms': ordered[-1] * 1000 if ordered else None,
+      'total_send_ms': sum(ordered) * 1000
+    }
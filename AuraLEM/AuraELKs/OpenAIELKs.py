@@ -1,17 +1,27 @@
-from openai import OpenAI
-import os
+from AuraOpenAI.ClientRegistry import get_openai_client
 import simplejson as json
+import time
 from DynamoDBUtilities import get_sortk_timestamp
+from AuraOpenAI.RateLimiter import admission, estimate_request_tokens, PRIORITY_ELKS
+from AuraOpenAI.LatencyPolicy import get_latency_policy
+from AuraELKs.FrameSender import FrameSender
+from AuraELKs.ResponseCache import get_response_cache
+from Tracing import current_trace
+
+# token type each model's provider usage data is counted in
+MODEL_TOKEN_TYPES = {
+  "gpt-4-1106-preview": "cl100k_base",
+  "gpt-3.5-turbo-1106": "cl100k_base"
+}
+
+# FrameSender stats of the last reply: { 'deltas', 'frames', 'max_queue_depth', 'p50_send_ms', ... }
+last_frame_stats = None
 
 '''
 Synthesizes a response from the intelligence given the chat history, user message, and memory context. Streams to conn during building.
 '''
 def synthesize_response(cw_response, cw_config, um, tokenizer, connectionId, conn):
-  # response params
-  params = {
-    "Data":"",
-    "ConnectionId": connectionId
-  }
+  global last_frame_stats
 
   chat_history = cw_response['ch']
   uds = cw_response['uds']
@@ -20,12 +30,9 @@ def synthesize_response(cw_response, cw_config, um, tokenizer, connectionId, con
   system_message = "You are speaking to a user who's personality is mapped out below (may be empty). Numbers next to traits or skills are the % strength from 0-100%, and evidence is provided. Please only reference specifics if absolutely relevant, otherwise use holistically to inform your responses:\n\n"
   system_message += json.dumps(uds)
 
-  # Get API key from environment
-  openai_key = os.environ['openai_key']
-  openai_client = OpenAI(api_key=openai_key)
-
-  # Specify the AI model
-  model = "gpt-4-1106-preview"
+  # Specify the AI model (the latency policy may hedge or fail over to another one)
+  latency_policy = get_latency_policy(cw_config)
+  model = latency_policy.model if latency_policy is not None else "gpt-4-1106-preview"
 
   # set the history messages
   messages = []
@@ -36,47 +43,150 @@ def synthesize_response(cw_response, cw_config, um, tokenizer, connectionId, con
   i = len(chat_history) - 1
   while i >= 0:
     item = chat_history[i]
-    item['role'] = "assistant" if item['role'] == "intelligence" else "user"
-    messages.append({"role": item['role'], "content": item['content']})
+    # map roles without mutating the history messages, which may be shared with the context cache
+    role = "assistant" if item['role'] in ("intelligence", "assistant") else "user"
+    messages.append({"role": role, "content": item['content']})
 
     i -= 1
 
   # add latest user message
   messages.append({"role": um['role'], "content": um['content']})
 
-  # call openAI
-  response = ""
+  # deltas are posted to the socket by a background sender, coalesced into frames
+  frame_max_chars = cw_config.get("elks_frame_max_chars", 256)
+  sender = FrameSender(conn, connectionId, frame_max_chars, cw_config.get("elks_frame_max_delay_seconds", 0.05))
+
+  # an exact repeat of a recent call is answered from the response cache (unless the tenant opted out)
+  response_cache = get_response_cache(cw_config)
+  cache_key = None
+  if response_cache is not None and response_cache.enabled_for(cw_response['api_key']):
+    cache_key = response_cache.key(cw_response['api_key'], model, messages, cw_config["elks_response_mtl"])
+  cached = response_cache.get(cache_key) if cache_key is not None else None
+
+  if cached is not None:
+    response, token_lengths = replay_response(cached, tokenizer, sender, frame_max_chars)
+  else:
+    # a reply that will be cached is generated to the end even if the client goes away, for its retry to reuse
+    model, response, token_lengths, generated = stream_response(cw_response, cw_config, messages, model, latency_policy, tokenizer, sender, cache_key is not None)
+
+  # waits for the last frames to be sent. Raises if they couldn't be
+  try:
+    sender.close()
+  finally:
+    last_frame_stats = sender.stats()
+
+    # only replies the model finished are reused, whether or not this delivery succeeded
+    if cached is None and cache_key is not None and generated and response:
+      response_cache.put(cache_key, response, token_lengths, model)
 
-  for resp in openai_client.chat.completions.create(model=model,
-  messages=messages,
-  stream=True,
-  max_tokens=cw_config["elks_response_mtl"],
-  stop=None):
+  im = {
+    "content": response,
+    "role": "intelligence",
+    "token_lengths": token_lengths,
+    "sortk": get_sortk_timestamp(),
+    "partitionk": um["partitionk"],
+    "uid": um["uid"],
+    "iid": um["iid"]
+  }
+
+  return im
+
+
+'''
+Streams a response from openAI to the sender. Returns (model that answered, response, token_lengths, whether the model
+finished the reply). Once the sender fails the stream is abandoned, unless generate_to_end.
+'''
+def stream_response(cw_response, cw_config, messages, model, latency_policy, tokenizer, sender, generate_to_end=False):
+  # shared client: reuses this process's connections to the API
+  openai_client = get_openai_client()
+
+  reserved_tokens = estimate_request_tokens(messages, cw_config["elks_response_mtl"])
+
+  def open_stream(model):
+    # wait for rate limit admission (interactive replies go first), then call openAI
+    admission.acquire(model, cw_response['api_key'], reserved_tokens, PRIORITY_ELKS)
+    return openai_client.chat.completions.create(model=model,
+    messages=messages,
+    stream=True,
+    stream_options={"include_usage": True},
+    max_tokens=cw_config["elks_response_mtl"],
+    stop=None)
+
+  def release_stream(model):
+    # a hedged request that wasn't kept is closed before (or right after) its first tokens: only its prompt counts
+    admission.settle(model, cw_response['api_key'], reserved_tokens, reserved_tokens - cw_config["elks_response_mtl"])
+
+  # time to first token (from before admission) and inter-token gaps are observed when the invocation is traced
+  trace = current_trace()
+  last_delta_at = time.perf_counter()
+  first_delta = True
+
+  if latency_policy is not None: model, stream = latency_policy.stream(open_stream, release_stream)
+  else: stream = open_stream(model)
+
+  response_parts = []
+  usage = None
+  generated = False
+
+  # token lengths of the response are counted as the deltas arrive
+  token_counter = tokenizer.incremental_counter()
+
+  for resp in stream:
+    # the reply can't reach the client any more (e.g. it disconnected): stop generating it. sender.close() raises the error
+    if sender.error is not None and not generate_to_end:
+      if hasattr(stream, 'close'): stream.close()
+      break
+
+    # the final chunk carries only the usage data, no choices
+    if len(resp.choices) == 0:
+      if getattr(resp, 'usage', None) is not None: usage = resp.usage
+      continue
           
     if hasattr(resp.choices[0].delta, 'content'):
       res = resp.choices[0].delta.content
 
       if res is not None:
-        response += res
-        params["Data"] = json.dumps({"message": res, "status": "partial"})
-        conn.post_to_connection(**params)
+        if trace is not None:
+          delta_at = time.perf_counter()
+          trace.observe('elks_ttft_ms' if first_delta else 'elks_inter_token_ms', (delta_at - last_delta_at) * 1000)
+          last_delta_at, first_delta = delta_at, False
+
+        response_parts.append(res)
+        sender.partial(res)
+        token_counter.append(res)
 
       else:
-        params["Data"] = json.dumps({"message": "null", "status": "complete"})
-        conn.post_to_connection(**params)
+        sender.complete()
+        generated = True
 
     else:
-        params["Data"] = json.dumps({"message": "null", "status": "complete"})
-        conn.post_to_connection(**params)
+        sender.complete()
+        generated = True
 
-  im = {
-    "content": response,
-    "role": "intelligence",
-    "token_lengths": tokenizer.calculate_tokenized_length(response),
-    "sortk": get_sortk_timestamp(),
-    "partitionk": um["partitionk"],
-    "uid": um["uid"],
-    "iid": um["iid"]
-  }
+  response = "".join(response_parts)
+  admission.settle(model, cw_response['api_key'], reserved_tokens, getattr(usage, 'total_tokens', None))
 
-  return im
+  # the provider's completion token count is exact for the model's own token type
+  known_lengths = {}
+  if usage is not None and MODEL_TOKEN_TYPES.get(model) in tokenizer.tokenizers:
+    known_lengths[MODEL_TOKEN_TYPES[model]] = usage.completion_tokens
+
+  return (model, response, token_counter.finish(known_lengths), generated)
+
+
+'''
+Replays a cached reply to the sender in frames of up to frame_max_chars. Returns (response, token_lengths).
+'''
+def replay_response(cached, tokenizer, sender, frame_max_chars):
+  response = cached['content']
+  for start in range(0, len(response), frame_max_chars):
+    sender.partial(response[start:start + frame_max_chars])
+  sender.complete()
+
+  # the cached lengths may be of other token types than this tokenizer's
+  token_lengths = {}
+  for token_type in tokenizer.tokenizers:
+    if token_type in cached['token_lengths']: token_lengths[token_type] = cached['token_lengths'][token_type]
+    else: token_lengths[token_type] = tokenizer.cached_tokenized_length(token_type, response)
+
+  return (response, token_lengths)
@@ -0,0 +1,115 @@
+'''
+In-process cache of ELKS replies for exact repeats of a call (the same UDS, chat history & user message, e.g. a greeting
+or a retry after the client disconnected), keyed by a hash of the tenant's api key, the rendered messages and the model
+parameters: replies are never shared across tenants. Enabled
+with the "elks_response_cache" cw_config entry:
+  {
+    "max_entries": 1024, # replies kept, least recently used evicted first
+    "ttl_seconds": 600, # a reply is served for this long after it was generated
+    "opt_out_api_keys": [] # tenants whose calls are never cached nor served from the cache
+  }
+'''
+
+import copy
+import time
+import hashlib
+import threading
+import simplejson as json
+from collections import OrderedDict
+
+class ResponseCache():
+  '''
+  LRU + TTL cache of { 'content', 'token_lengths', 'model' } of a reply, keyed by the hash of its call.
+  '''
+
+  def __init__(self, max_entries=1024, ttl_seconds=600, opt_out_api_keys=()):
+    # must be able to hold at least one entry
+    assert (max_entries > 0)
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self.opt_out_api_keys = set(opt_out_api_keys)
+
+    self.entries = OrderedDict() # { call hash: entry }, ordered oldest -> most recently used
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.expirations = 0
+    self.evictions = 0
+
+
+  def enabled_for(self, api_key):
+    return api_key not in self.opt_out_api_keys
+
+
+  def key(self, api_key, model, messages, max_tokens):
+    # hash the call so the rendered prompt (UDS & history) isn't held as a dictionary key
+    call = json.dumps({"api_key": api_key, "model": model, "messages": messages, "max_tokens": max_tokens}, sort_keys=True)
+    return hashlib.blake2b(call.encode('utf-8'), digest_size=16).digest()
+
+
+  def get(self, key):
+    '''
+    Returns a copy of the cached reply for key, or None if it isn't cached (or has expired).
+    '''
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and time.monotonic() - entry['stored_at'] > self.ttl_seconds:
+        del self.entries[key]
+        self.expirations += 1
+        entry = None
+
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return copy.deepcopy(entry['reply'])
+
+
+  def put(self, key, content, token_lengths, model):
+    entry = {
+      'reply': {'content': content, 'token_lengths': dict(token_lengths), 'model': model},
+      'stored_at': time.monotonic()
+    }
+
+    with self.lock:
+      self.entries[key] = entry
+      self.entries.move_to_end(key)
+
+      # evict the least recently used entries until the cache is within bounds
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self.entries),
+        'hits': self.hits,
+        'misses': self.misses,
+        'expirations': self.expirations,
+        'evictions': self.evictions,
+        'hit_rate': (self.hits / lookups) if lookups > 0 else 0.0
+      }
+
+
+response_caches = {} # { id(settings): ResponseCache }, one per cw_config
+
+def get_response_cache(cw_config):
+  '''
+  Returns the process-wide response cache of cw_config's "elks_response_cache", or None if it isn't set.
+  '''
+  settings = cw_config.get("elks_response_cache")
+  if not settings: return None
+
+  if id(settings) not in response_caches: response_caches[id(settings)] = ResponseCache(**settings)
+  return response_caches[id(settings)]
@@ -0,0 +1,150 @@
+'''
+Process-wide OpenAI clients. Each client owns an HTTP connection pool, so building one per call pays a new TCP + TLS
+handshake every time; the registry keeps one sync and one async client per (base_url, api_key) for the life of the
+process (warm Lambda containers reuse their connections). Pool size & timeouts come from the "openai_client" cw_config
+entry. The API key is read from the openai_key environment variable once.
+'''
+
+import os
+import threading
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+# httpx's Limits type, taken from the SDK so the registry works with whichever httpx the SDK is built on
+Limits = type(openai.DEFAULT_CONNECTION_LIMITS)
+
+DEFAULT_SETTINGS = {
+  "max_connections": 20, # open connections per client
+  "max_keepalive_connections": 10, # idle connections kept for reuse
+  "keepalive_expiry": 120, # seconds an idle connection is kept
+  "connect_timeout": 5.0,
+  "read_timeout": 60.0, # longest gap between streamed chunks
+  "max_retries": 2,
+  "base_url": None # API endpoint for clients not given one, e.g. a local FakeOpenAIServer (None: the SDK's default)
+}
+
+
+class ClientRegistry():
+  '''
+  Connection reuse is measured with the HTTP transport's trace hook: every request is counted, and so is every request
+  that had to open a new TCP connection. reuse_rate = 1 - connections / requests.
+  '''
+
+  def __init__(self, settings=None):
+    self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    self.clients = {} # { ('sync' | 'async', base_url, api_key): client }
+    self.default_api_key = None
+    self.lock = threading.Lock()
+
+    self.requests = 0
+    self.connections = 0
+
+
+  def configure(self, settings):
+    '''
+    Applies new pool settings. Clients already built keep theirs until reset().
+    '''
+    with self.lock:
+      self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+
+
+  def api_key(self, api_key):
+    if api_key is not None: return api_key
+    if self.default_api_key is None: self.default_api_key = os.environ['openai_key']
+    return self.default_api_key
+
+
+  def count_connection(self, event_name):
+    # called by the transport for each step of a request; only new connections start a TCP connect
+    if event_name == 'connection.connect_tcp.started':
+      with self.lock: self.connections += 1
+
+
+  def trace(self, event_name, info):
+    self.count_connection(event_name)
+
+
+  async def trace_async(self, event_name, info):
+    self.count_connection(event_name)
+
+
+  def on_request(self, request):
+    with self.lock: self.requests += 1
+    request.extensions['trace'] = self.trace
+
+
+  async def on_request_async(self, request):
+    with self.lock: self.requests += 1
+    request.extensions['trace'] = self.trace_async
+
+
+  def http_options(self):
+    settings = self.settings
+    return {
+      'limits': Limits(max_connections=settings['max_connections'], max_keepalive_connections=settings['max_keepalive_connections'], keepalive_expiry=settings['keepalive_expiry']),
+      'timeout': openai.Timeout(settings['read_timeout'], connect=settings['connect_timeout'])
+    }
+
+
+  def get(self, api_key=None, base_url=None):
+    '''
+    Returns the shared sync client for (base_url, api_key), building it on first use.
+    '''
+    key = ('sync', base_url if base_url is not None else self.settings['base_url'], self.api_key(api_key))
+
+    with self.lock:
+      if key not in self.clients:
+        http_client = openai.DefaultHttpxClient(event_hooks={'request': [self.on_request]}, **self.http_options())
+        self.clients[key] = OpenAI(api_key=key[2], base_url=key[1], http_client=http_client, max_retries=self.settings['max_retries'])
+      return self.clients[key]
+
+
+  def get_async(self, api_key=None, base_url=None):
+    '''
+    Returns the shared async client for (base_url, api_key). Its connections belong to the event loop that first uses
+    them, so use it from one long-lived loop.
+    '''
+    key = ('async', base_url if base_url is not None else self.settings['base_url'], self.api_key(api_key))
+
+    with self.lock:
+      if key not in self.clients:
+        http_client = openai.DefaultAsyncHttpxClient(event_hooks={'request': [self.on_request_async]}, **self.http_options())
+        self.clients[key] = AsyncOpenAI(api_key=key[2], base_url=key[1], http_client=http_client, max_retries=self.settings['max_retries'])
+      return self.clients[key]
+
+
+  def stats(self):
+    with self.lock:
+      return {
+        'clients': len(self.clients),
+        'requests': self.requests,
+        'connections': self.connections,
+        'reuse_rate': (1 - self.connections / self.requests) if self.requests > 0 else 0.0
+      }
+
+
+  def reset(self):
+    '''
+    Drops every client (e.g. in a forked child, whose inherited connections are shared with the parent).
+    '''
+    self.clients = {}
+    self.lock = threading.Lock()
+
+
+# shared by every OpenAI call made from this process
+registry = ClientRegistry()
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=registry.reset)
+
+
+def get_openai_client(api_key=None, base_url=None):
+  return registry.get(api_key, base_url)
+
+
+def get_async_openai_client(api_key=None, base_url=None):
+  return registry.get_async(api_key, base_url)
+
+
+def configure_openai_clients(cw_config):
+  registry.configure(cw_config.get("openai_client"))
@@ -0,0 +1,296 @@
+'''
+Local stand-in for the chat completions API, for load & latency tests without an openai_key or network access. Speaks
+/v1/chat/completions, streamed (SSE, with stream_options include_usage) and not streamed (e.g. json_object), over
+keep-alive HTTP/1.1 like the real API. Latency, errors and replies come from a scenario:
+  {
+    "seed": 0, # every random choice is derived from (seed, request body, occurrence of that body): reproducible
+    "ttft_seconds": 0.0, # before the first token (or before a non-streamed response)
+    "inter_token_seconds": 0.0, # between streamed tokens
+    "jitter": 0.0, # delays are scaled by a uniform factor in [1 - jitter, 1 + jitter]
+    "error_rate": 0.0, # requests answered with a 500
+    "rate_limit_rate": 0.0, # requests answered with a 429 (retry-after-ms: retry_after_ms)
+    "retry_after_ms": 50,
+    "invalid_uds_rate": 0.0, # json_object responses that fail validate_response (exercises the ELAM retry)
+    "replies": [...], # streamed replies, one picked per request
+    "uds_replies": [...], # UDS dicts for json_object requests
+    "recordings": None, # { user message: reply } (or a JSON file of it), matched on the last user message
+    "models": {} # { model: overrides of any of the above }
+  }
+Point the LEM at it with the "openai_client" cw_config entry ({"base_url": server.url}), or the OPENAI_BASE_URL
+environment variable in processes that don't load a cw_config (the SDK reads it). Run standalone with
+  python -m AuraOpenAI.FakeOpenAIServer --port 8089 --scenario scenario.json
+'''
+
+import sys
+import time
+import random
+import hashlib
+import argparse
+import threading
+import simplejson as json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Tokenizers.TokenizerModels import get_model
+
+DEFAULT_REPLY = "Hi! It's nice to meet you. How has your day been so far, and is there anything on your mind you'd like to talk about?"
+
+DEFAULT_UDS = {
+  'basic_info': {'name': '', 'current_location': '', 'occupation': '', 'sex': ''},
+  'traits': [['curious', 60, 'asks open questions about a range of topics.']],
+  'skills': [],
+  'factual_history': [],
+  'summary': 'A friendly user who has only just started chatting.'
+}
+
+DEFAULT_SCENARIO = {
+  "seed": 0,
+  "ttft_seconds": 0.0,
+  "inter_token_seconds": 0.0,
+  "jitter": 0.0,
+  "error_rate": 0.0,
+  "rate_limit_rate": 0.0,
+  "retry_after_ms": 50,
+  "invalid_uds_rate": 0.0,
+  "replies": [DEFAULT_REPLY],
+  "uds_replies": [DEFAULT_UDS],
+  "recordings": None,
+  "models": {}
+}
+
+# json_object responses validate_response rejects: malformed JSON, a missing field, an out of range trait
+INVALID_UDS_REPLIES = [
+  '{"basic_info": {"name": "", "current_location": ""}, "traits": [["curious", 60, "asks',
+  json.dumps({'basic_info': {}, 'traits': [], 'skills': [], 'factual_history': []}),
+  json.dumps(dict(DEFAULT_UDS, traits=[['curious', 160, 'out of range']]))
+]
+
+
+def load_encoding():
+  '''
+  Returns the cl100k encoding replies are split with, or None if it can't be loaded (replies are then split into words).
+  '''
+  try:
+    return get_model("cl100k_base")
+  except Exception as e:
+    print(f"FakeOpenAIServer: cl100k_base could not be loaded ({e!r}), replies stream word by word", file=sys.stderr)
+    return None
+
+
+def split_tokens(text, encoding):
+  '''
+  Splits text into the pieces it would stream in: tokens of encoding (merged until they decode to whole characters), or
+  words if encoding is None.
+  '''
+  if encoding is None:
+    words = text.split(' ')
+    return [(' ' if i > 0 else '') + word for i, word in enumerate(words)]
+
+  pieces = []
+  pending = b''
+  for token in encoding.encode(text):
+    pending += encoding.decode_single_token_bytes(token)
+    try:
+      pieces.append(pending.decode('utf-8'))
+      pending = b''
+    except UnicodeDecodeError:
+      continue
+  return pieces
+
+
+class FakeOpenAIServer():
+  def __init__(self, scenario=None, host='127.0.0.1', port=0):
+    self.scenario = dict(DEFAULT_SCENARIO, **(scenario or {}))
+    recordings = self.scenario["recordings"]
+    if isinstance(recordings, str):
+      with open(recordings) as recordings_file: self.scenario["recordings"] = json.load(recordings_file)
+
+    self.occurrences = {} # { request body hash: requests seen with that body }
+    self.lock = threading.Lock()
+    self.counts = {'requests': 0, 'streamed': 0, 'errors': 0, 'rate_limited': 0, 'invalid_uds': 0}
+
+    # resolved once, so every request of a run is split (and counted in usage) the same way
+    self.encoding = load_encoding()
+    self.splitter = 'words' if self.encoding is None else 'cl100k_base'
+
+    server = self
+    class Handler(FakeOpenAIHandler):
+      fake = server
+
+    self.httpd = ThreadingHTTPServer((host, port), Handler)
+    self.httpd.daemon_threads = True
+    self.thread = None
+
+
+  @property
+  def url(self):
+    host, port = self.httpd.server_address[:2]
+    return f'http://{host}:{port}/v1'
+
+
+  def start(self):
+    '''
+    Serves on a background thread. Returns self.
+    '''
+    self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-openai', daemon=True)
+    self.thread.start()
+    return self
+
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+
+  def settings(self, model):
+    return dict(self.scenario, **self.scenario["models"].get(model, {}))
+
+
+  def request_rng(self, body):
+    # the same body gets the same sequence of outcomes, whatever the order requests arrive in
+    body_hash = hashlib.blake2b(body, digest_size=16).hexdigest()
+    with self.lock:
+      occurrence = self.occurrences.get(body_hash, 0)
+      self.occurrences[body_hash] = occurrence + 1
+    return random.Random(f'{self.scenario["seed"]}:{body_hash}:{occurrence}')
+
+
+  def count(self, name):
+    with self.lock: self.counts[name] += 1
+
+
+  def reply_text(self, request, settings, rng):
+    '''
+    Returns (content, outcome) for the request: the recorded or a scripted reply, or a UDS for json_object requests.
+    '''
+    if (request.get('response_format') or {}).get('type') == 'json_object':
+      if rng.random() < settings["invalid_uds_rate"]: return (rng.choice(INVALID_UDS_REPLIES), 'invalid_uds')
+      return (json.dumps(rng.choice(settings["uds_replies"])), None)
+
+    user_messages = [message['content'] for message in request['messages'] if message['role'] == 'user']
+    recordings = settings["recordings"] or {}
+    if user_messages and user_messages[-1] in recordings: return (recordings[user_messages[-1]], None)
+    return (rng.choice(settings["replies"]), None)
+
+
+  def delay(self, seconds, settings, rng):
+    if seconds > 0: time.sleep(seconds * rng.uniform(1 - settings["jitter"], 1 + settings["jitter"]))
+
+
+  def stats(self):
+    with self.lock: return dict(self.counts, splitter=self.splitter)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1' # keep-alive, so client connection reuse can be measured
+  disable_nagle_algorithm = True # headers, body & SSE events are separate small writes: don't hold them for delayed ACKs
+  fake = None
+
+  def log_message(self, format, *args):
+    pass
+
+
+  def send_json(self, status, payload, headers=None):
+    body = json.dumps(payload).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).items(): self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def send_event(self, payload):
+    data = b'data: ' + (payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')) + b'\n\n'
+    self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+    self.wfile.flush()
+
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if not self.path.rstrip('/').endswith('/chat/completions'):
+      return self.send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+
+    fake = self.fake
+    request = json.loads(body)
+    settings = fake.settings(request['model'])
+    rng = fake.request_rng(body)
+    fake.count('requests')
+
+    # injected failures are answered right away, as the API does
+    outcome = rng.random()
+    if outcome < settings["error_rate"]:
+      fake.count('errors')
+      return self.send_json(500, {'error': {'message': 'The server had an error while processing your request.', 'type': 'server_error'}})
+    if outcome < settings["error_rate"] + settings["rate_limit_rate"]:
+      fake.count('rate_limited')
+      return self.send_json(429, {'error': {'message': 'Rate limit reached.', 'type': 'rate_limit_error'}}, {'retry-after-ms': str(settings["retry_after_ms"])})
+
+    content, reply_outcome = fake.reply_text(request, settings, rng)
+    if reply_outcome is not None: fake.count(reply_outcome)
+
+    # the reply stops at max_tokens, as the API's does
+    pieces = split_tokens(content, fake.encoding)
+    max_tokens = request.get('max_tokens')
+    finish_reason = 'stop'
+    if max_tokens is not None and len(pieces) > max_tokens:
+      pieces, finish_reason = pieces[:max_tokens], 'length'
+
+    usage = {
+      'prompt_tokens': sum(len(str(message['content'])) // 4 + 4 for message in request['messages']),
+      'completion_tokens': len(pieces)
+    }
+    usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+    base = {'id': f'chatcmpl-fake-{rng.getrandbits(48):012x}', 'created': int(time.time()), 'model': request['model']}
+
+    if not request.get('stream'):
+      fake.delay(settings["ttft_seconds"], settings, rng)
+      return self.send_json(200, dict(base, object='chat.completion', usage=usage, choices=[
+        {'index': 0, 'message': {'role': 'assistant', 'content': ''.join(pieces)}, 'finish_reason': finish_reason}
+      ]))
+
+    fake.count('streamed')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+
+    chunk = dict(base, object='chat.completion.chunk')
+    try:
+      self.send_event(dict(chunk, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]))
+      fake.delay(settings["ttft_seconds"], settings, rng)
+
+      for i, piece in enumerate(pieces):
+        if i > 0: fake.delay(settings["inter_token_seconds"], settings, rng)
+        self.send_event(dict(chunk, choices=[{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]))
+
+      self.send_event(dict(chunk, choices=[{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]))
+      if (request.get('stream_options') or {}).get('include_usage'): self.send_event(dict(chunk, choices=[], usage=usage))
+      self.send_event(b'[DONE]')
+      self.wfile.write(b'0\r\n\r\n')
+      self.wfile.flush()
+
+    except (BrokenPipeError, ConnectionResetError):
+      # the client closed the stream (e.g. a hedged request that lost)
+      self.close_connection = True
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Local fake of the OpenAI chat completions API.')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8089)
+  parser.add_argument('--scenario', help='JSON file of scenario settings')
+  args = parser.parse_args()
+
+  scenario = None
+  if args.scenario:
+    with open(args.scenario) as scenario_file: scenario = json.load(scenario_file)
+
+  server = FakeOpenAIServer(scenario, args.host, args.port)
+  print(f'Fake OpenAI API at {server.url}', file=sys.stderr)
+  try:
+    server.httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,337 @@
+'''
+Time-to-first-token policy for streamed completions. If the first token hasn't arrived within hedge_after_seconds, another
+request is started (the same model again, then the fallback models) and whichever streams a token first is kept; the
+others are closed at once. A circuit breaker per model tracks recent TTFTs and skips a model whose percentile TTFT is over
+its threshold, until a probe after the cooldown comes back fast. A closed (losing) request only tells its breaker that it
+went at least hedge_after_seconds without a token: with ttft_threshold_seconds no higher than that, a model that keeps
+losing counts as slow. Enabled with the "elks_latency_policy" cw_config entry:
+  {
+    "model": "gpt-4-1106-preview", # primary model
+    "fallback_models": ["gpt-3.5-turbo-1106"], # tried in order after the primary
+    "hedge_same_model": True, # first hedge with a second request to the primary
+    "hedge_after_seconds": 2.0, # start the next request if no token has arrived by then
+    "max_attempts": 3, # requests started per call, at most
+    "breaker": { "window": 50, "percentile": 0.95, "ttft_threshold_seconds": 2.0, "min_samples": 10, "cooldown_seconds": 30 }
+  }
+'''
+
+import time
+import queue
+import socket
+import threading
+from collections import deque
+
+DEFAULT_BREAKER = {"window": 50, "percentile": 0.95, "ttft_threshold_seconds": 2.0, "min_samples": 10, "cooldown_seconds": 30}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def percentile(values, fraction):
+  if not values: return None
+  ordered = sorted(values)
+  return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker():
+  '''
+  Opens when the given percentile of the last window TTFTs (failures count as infinitely slow) exceeds the threshold.
+  After cooldown_seconds one probe request is let through (half open): a fast first token closes the breaker and clears
+  its history, a slow one or a failure opens it again.
+  '''
+
+  def __init__(self, window=50, percentile=0.95, ttft_threshold_seconds=2.0, min_samples=10, cooldown_seconds=30, clock=time.monotonic):
+    self.samples = deque(maxlen=window)
+    self.percentile = percentile
+    self.ttft_threshold_seconds = ttft_threshold_seconds
+    self.min_samples = min_samples
+    self.cooldown_seconds = cooldown_seconds
+    self.clock = clock
+
+    self.state = CLOSED
+    self.opened_at = None
+    self.probing = False
+    self.lock = threading.Lock()
+
+
+  def allow(self):
+    '''
+    Whether a request may be sent to this model now.
+    '''
+    with self.lock:
+      if self.state == CLOSED: return True
+
+      if self.state == OPEN and self.clock() - self.opened_at >= self.cooldown_seconds:
+        self.state = HALF_OPEN
+        self.probing = False
+
+      if self.state == HALF_OPEN and not self.probing:
+        self.probing = True
+        return True
+      return False
+
+
+  def record(self, ttft_seconds):
+    '''
+    Records a TTFT (float('inf') for a request that failed before its first token).
+    '''
+    with self.lock:
+      if self.state == HALF_OPEN:
+        if ttft_seconds <= self.ttft_threshold_seconds:
+          self.state = CLOSED
+          self.samples.clear()
+        else:
+          self.state, self.opened_at = OPEN, self.clock()
+        self.probing = False
+        if self.state == OPEN: return
+
+      self.samples.append(ttft_seconds)
+      if self.state == CLOSED and len(self.samples) >= self.min_samples and percentile(self.samples, self.percentile) > self.ttft_threshold_seconds:
+        self.state, self.opened_at = OPEN, self.clock()
+
+
+  def stats(self):
+    with self.lock:
+      finite = [sample for sample in self.samples if sample != float('inf')]
+      return {
+        'state': self.state,
+        'samples': len(self.samples),
+        'failures': len(self.samples) - len(finite),
+        'p50_ttft_s': percentile(finite, 0.50),
+        'p95_ttft_s': percentile(finite, 0.95)
+      }
+
+
+breakers = {} # { model: CircuitBreaker }, one per process
+breakers_lock = threading.Lock()
+
+def get_breaker(model, settings=None):
+  with breakers_lock:
+    if model not in breakers: breakers[model] = CircuitBreaker(**dict(DEFAULT_BREAKER, **(settings or {})))
+    return breakers[model]
+
+
+def has_token(chunk):
+  # whether a streamed chunk carries response text (the first chunk usually only carries the role)
+  choices = getattr(chunk, 'choices', None)
+  return bool(choices) and bool(getattr(choices[0].delta, 'content', None))
+
+
+def close_stream(stream):
+  '''
+  Closes a streamed completion from another thread, interrupting the read in progress.
+  '''
+  try:
+    # closing a response doesn't wake the thread blocked reading it: an HTTP/1.1 response's connection is shut down
+    # first (it is dropped from the pool, where it couldn't be reused mid-response anyway)
+    response = getattr(stream, 'response', None)
+    if getattr(response, 'http_version', None) == 'HTTP/1.1' and response.extensions.get('network_stream') is not None:
+      connection = response.extensions['network_stream'].get_extra_info('socket')
+      if connection is not None: connection.shutdown(socket.SHUT_RDWR)
+
+    if hasattr(stream, 'close'): stream.close()
+  except Exception:
+    pass
+
+
+class Attempt():
+  '''
+  One streaming request, read on its own thread into the shared events queue. It records its own TTFT in its model's
+  breaker. A cancelled (losing) request is closed as soon as it is cancelled (or, if it is still being opened, as soon
+  as its response starts), so it stops generating tokens and frees its connection; its breaker records how long it had
+  gone without a token by then (it was at least that slow). release(model), if given, is
+  called once for a request that isn't kept (cancelled, or failed), e.g. to return its rate limit reservation.
+  '''
+
+  def __init__(self, model, open_stream, events, breaker, release=None):
+    self.model = model
+    self.started_at = time.monotonic()
+    self.buffer = [] # chunks received before the first token
+    self.cancelled = threading.Event()
+    self.stream = None
+    self.release = release
+    self.finished = False
+    self.released = False
+    self.lock = threading.Lock()
+    self.thread = threading.Thread(target=self.run, args=(open_stream, events, breaker), daemon=True)
+    self.thread.start()
+
+
+  def run(self, open_stream, events, breaker):
+    first_token = False
+    failed = False
+    try:
+      stream = open_stream(self.model)
+      with self.lock: self.stream = stream
+      # (a request cancelled while it was being opened is closed before it is read)
+      if self.cancelled.is_set(): self.close()
+
+      for chunk in stream:
+        if self.cancelled.is_set(): break
+
+        if not first_token and has_token(chunk):
+          first_token = True
+          breaker.record(time.monotonic() - self.started_at)
+        events.put((self, 'chunk', chunk))
+
+      if self.cancelled.is_set():
+        if not first_token: breaker.record(time.monotonic() - self.started_at)
+      else:
+        # finished without any text
+        if not first_token: breaker.record(time.monotonic() - self.started_at)
+        events.put((self, 'end', None))
+
+    except Exception as e:
+      if self.cancelled.is_set():
+        # (closing a losing request interrupts its read)
+        if not first_token: breaker.record(time.monotonic() - self.started_at)
+      else:
+        failed = True
+        if not first_token: breaker.record(float('inf'))
+        events.put((self, 'error', e))
+
+    finally:
+      with self.lock:
+        self.finished = True
+        release = self.cancelled.is_set() or failed
+      if release: self.release_once()
+
+
+  def cancel(self, release=True):
+    with self.lock:
+      if self.cancelled.is_set(): return
+      if not release: self.released = True
+      self.cancelled.set()
+      finished = self.finished
+
+    self.close()
+    # a request that already ended (without text) is released here, one still running when it stops
+    if finished: self.release_once()
+
+
+  def close(self):
+    with self.lock: stream = self.stream
+    if stream is not None: close_stream(stream)
+
+
+  def release_once(self):
+    with self.lock:
+      if self.released or self.release is None: return
+      self.released = True
+    self.release(self.model)
+
+
+class LatencyPolicy():
+  def __init__(self, model, fallback_models=(), hedge_same_model=True, hedge_after_seconds=2.0, max_attempts=3, breaker=None):
+    self.model = model
+    self.fallback_models = list(fallback_models)
+    self.hedge_same_model = hedge_same_model
+    self.hedge_after_seconds = hedge_after_seconds
+    self.max_attempts = max_attempts
+    self.breaker_settings = breaker
+
+    self.calls = 0
+    self.hedged = 0 # calls that started more than one request
+    self.wins = {} # { model: calls it streamed }
+    self.lock = threading.Lock()
+
+
+  def stream(self, open_stream, release=None):
+    '''
+    open_stream(model) starts a streaming request and returns its chunk iterator. Returns (model, chunks) of the request
+    that streamed a token first; chunks yields its chunks (including those received before the first token). Raises the
+    last error if every request failed before a token. release(model) is called for every other request (see Attempt).
+    '''
+    models = deque([self.model] + ([self.model] if self.hedge_same_model else []) + self.fallback_models)
+    events = queue.Queue()
+    attempts = []
+
+    def launch():
+      # starts the next model whose breaker lets it through (a half-open breaker lets one probe through)
+      while models and len(attempts) < self.max_attempts:
+        model = models.popleft()
+        if get_breaker(model, self.breaker_settings).allow():
+          attempts.append(Attempt(model, open_stream, events, get_breaker(model, self.breaker_settings), release))
+          return True
+      models.clear()
+      return False
+
+    # with every breaker open the primary is used anyway
+    if not launch(): attempts.append(Attempt(self.model, open_stream, events, get_breaker(self.model, self.breaker_settings), release))
+    deadline = time.monotonic() + self.hedge_after_seconds
+    failed = []
+
+    while True:
+      # no token yet: hedge once the deadline passes (or right away when every running request has failed)
+      if models and (time.monotonic() >= deadline or len(failed) == len(attempts)):
+        if launch(): deadline = time.monotonic() + self.hedge_after_seconds
+
+      if len(failed) == len(attempts):
+        # every request failed or finished without text: raise the last error, or stream the empty response
+        attempt, kind, payload = failed[-1]
+        if kind == 'error': raise payload
+        attempt.buffer.append(None)
+        break
+
+      try:
+        attempt, kind, payload = events.get(timeout=max(deadline - time.monotonic(), 0.001) if models else None)
+      except queue.Empty:
+        continue
+
+      if kind == 'chunk':
+        attempt.buffer.append(payload)
+        if has_token(payload): break
+
+      else:
+        failed.append((attempt, kind, payload))
+
+    winner = attempt
+    for attempt in attempts:
+      if attempt is not winner: attempt.cancel()
+
+    with self.lock:
+      self.calls += 1
+      if len(attempts) > 1: self.hedged += 1
+      self.wins[winner.model] = self.wins.get(winner.model, 0) + 1
+
+    return (winner.model, self.winner_chunks(winner, events))
+
+
+  def winner_chunks(self, winner, events):
+    try:
+      for chunk in winner.buffer:
+        if chunk is None: return
+        yield chunk
+
+      while True:
+        attempt, kind, payload = events.get()
+        if attempt is not winner: continue
+        if kind == 'end': return
+        if kind == 'error': raise payload
+        yield payload
+
+    except GeneratorExit:
+      # the caller stopped reading (closed chunks): close the request too. Its reservation is the caller's to settle
+      winner.cancel(release=False)
+      raise
+
+
+  def stats(self):
+    with self.lock:
+      stats = {'calls': self.calls, 'hedged': self.hedged, 'wins': dict(self.wins)}
+    stats['breakers'] = {model: get_breaker(model, self.breaker_settings).stats() for model in [self.model] + self.fallback_models}
+    return stats
+
+
+policies = {} # { id(settings): LatencyPolicy }, one per cw_config
+
+def get_latency_policy(cw_config):
+  '''
+  Returns the process-wide latency policy of cw_config's "elks_latency_policy", or None if it isn't set.
+  '''
+  settings = cw_config.get("elks_latency_policy")
+  if not settings: return None
+
+  if id(settings) not in policies: policies[id(settings)] = LatencyPolicy(**settings)
+  return policies[id(settings)]
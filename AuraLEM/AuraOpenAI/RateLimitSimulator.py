@@ -0,0 +1,96 @@
+'''
+Discrete-event simulation of the OpenAI admission layer under synthetic load: Poisson arrivals of ELKS replies and
+sync/async ELAM analyses against one model's RPM/TPM limits, on a virtual clock. Reports the queueing delay of each
+priority class with priorities on, and with every call in one FIFO class for comparison.
+  cd AuraLEM && python -m AuraOpenAI.RateLimitSimulator
+'''
+
+import random
+from AuraOpenAI.RateLimiter import AdmissionController, PRIORITY_ELKS, PRIORITY_ELAM_SYNC, PRIORITY_ELAM_ASYNC, PRIORITY_NAMES
+
+MODEL = "gpt-4-1106-preview"
+
+# calls per second & estimated tokens per call (prompt + max_tokens) of each class, shaped after the production cw_config
+LOAD = {
+  PRIORITY_ELKS: {'rate': 1.5, 'tokens': 4096},
+  PRIORITY_ELAM_SYNC: {'rate': 0.05, 'tokens': 4096},
+  PRIORITY_ELAM_ASYNC: {'rate': 0.6, 'tokens': 3600}
+}
+
+# the offered load above averages ~380k tokens/min, so the TPM limit is exceeded in bursts and on average
+LIMITS = {MODEL: {'rpm': 500, 'tpm': 330000}}
+
+
+class VirtualClock():
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+def percentile(values, fraction):
+  if not values: return 0.0
+  ordered = sorted(values)
+  return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def simulate(load=LOAD, limits=LIMITS, duration_seconds=600, api_keys=20, prioritized=True, seed=0):
+  '''
+  Returns { class: { 'calls', 'mean_wait_s', 'p50_wait_s', 'p95_wait_s', 'p99_wait_s', 'max_wait_s' } }.
+  '''
+  rng = random.Random(seed)
+  clock = VirtualClock()
+  controller = AdmissionController(limits, None, clock)
+
+  arrivals = [] # (time, priority, tokens, api_key)
+  for priority, shape in load.items():
+    t = rng.expovariate(shape['rate'])
+    while t < duration_seconds:
+      tokens = int(shape['tokens'] * rng.uniform(0.5, 1.0))
+      arrivals.append((t, priority, tokens, f'key{rng.randrange(api_keys)}'))
+      t += rng.expovariate(shape['rate'])
+  arrivals.sort()
+
+  requests = [] # (class priority, request)
+  next_arrival = 0
+  next_admission = None
+  while next_arrival < len(arrivals) or next_admission is not None:
+    # advance to the next arrival or the next moment a waiting call fits, whichever is first
+    candidates = []
+    if next_arrival < len(arrivals): candidates.append(arrivals[next_arrival][0])
+    if next_admission is not None: candidates.append(clock.now + next_admission)
+    clock.now = max(clock.now, min(candidates))
+
+    while next_arrival < len(arrivals) and arrivals[next_arrival][0] <= clock.now:
+      t, priority, tokens, api_key = arrivals[next_arrival]
+      request = controller.enqueue(MODEL, api_key, tokens, priority if prioritized else 0)
+      requests.append((priority, request))
+      next_arrival += 1
+
+    next_admission = controller.poll()
+
+  results = {}
+  for priority in load:
+    waits = [request['admitted_at'] - request['enqueued_at'] for request_priority, request in requests if request_priority == priority]
+    results[PRIORITY_NAMES[priority]] = {
+      'calls': len(waits),
+      'mean_wait_s': sum(waits) / len(waits) if waits else 0.0,
+      'p50_wait_s': percentile(waits, 0.50),
+      'p95_wait_s': percentile(waits, 0.95),
+      'p99_wait_s': percentile(waits, 0.99),
+      'max_wait_s': max(waits, default=0.0)
+    }
+  return results
+
+
+def main():
+  for prioritized in (True, False):
+    print("priority classes" if prioritized else "single FIFO class")
+    for name, result in simulate(prioritized=prioritized).items():
+      print(f"  {name}: " + ", ".join(f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}" for key, value in result.items()))
+    print("\n")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,225 @@
+'''
+Admission control for OpenAI calls: token buckets per model and per api_key (requests & tokens per minute), shared by
+every call made from this process, with priority classes so background analyses can't take the quota interactive
+replies need. Enabled with the "openai_rate_limits" cw_config entry.
+'''
+
+import math
+import time
+import heapq
+import threading
+
+# priority classes, lower is admitted first
+PRIORITY_ELKS = 0 # interactive chat replies
+PRIORITY_ELAM_SYNC = 1 # force_reflect analyses the user is waiting on
+PRIORITY_ELAM_ASYNC = 2 # background analyses
+
+PRIORITY_NAMES = {PRIORITY_ELKS: 'elks', PRIORITY_ELAM_SYNC: 'elam_sync', PRIORITY_ELAM_ASYNC: 'elam_async'}
+
+
+def estimate_request_tokens(messages, max_tokens):
+  '''
+  Estimate of the tokens a call counts against TPM: the prompt (OpenAI's own limiter counts roughly 4 bytes per token,
+  so bytes/4 rounded up plus the per-message overhead) plus max_tokens. Not a bound: text of short tokens uses more.
+  The reservation is corrected to the call's actual usage with settle once it finishes.
+  '''
+  prompt_tokens = sum(math.ceil(len(str(message['content']).encode('utf-8')) / 4) + 4 for message in messages)
+  return prompt_tokens + int(max_tokens)
+
+
+class TokenBucket():
+  '''
+  Holds up to capacity units, refilled continuously at capacity per period_seconds.
+  '''
+
+  def __init__(self, capacity, period_seconds=60, clock=time.monotonic):
+    self.capacity = capacity
+    self.rate = capacity / period_seconds
+    self.clock = clock
+    self.level = capacity
+    self.updated_at = clock()
+
+
+  def refill(self):
+    now = self.clock()
+    self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+    self.updated_at = now
+
+
+  def time_until(self, amount):
+    '''
+    Seconds until amount (capped at capacity, so oversized requests are admitted from a full bucket) is available.
+    '''
+    self.refill()
+    missing = min(amount, self.capacity) - self.level
+    # (a rounding-error shortfall counts as available, or a waiter could be rescheduled at the same instant forever)
+    return missing / self.rate if missing > 1e-9 * self.capacity else 0.0
+
+
+  def take(self, amount):
+    self.refill()
+    self.level -= min(amount, self.capacity)
+
+
+  def give(self, amount):
+    self.refill()
+    self.level = min(self.capacity, self.level + amount)
+
+
+class AdmissionController():
+  '''
+  Admits calls in priority order (then arrival order). A waiting call reserves the buckets it is blocked on: lower
+  priority calls that need any of those buckets wait behind it, so a stream of small background calls can't starve a
+  large interactive one. Calls using other buckets (another model or api_key) are not held up.
+
+  model_limits: { model: { 'rpm': requests/min, 'tpm': tokens/min } }
+  api_key_limits: { 'rpm', 'tpm' } applied to each api_key separately, or None.
+  With neither set, acquire returns immediately.
+  '''
+
+  def __init__(self, model_limits=None, api_key_limits=None, clock=time.monotonic):
+    self.model_limits = model_limits or {}
+    self.api_key_limits = api_key_limits
+    self.clock = clock
+
+    self.buckets = {} # { (scope, name, 'rpm' | 'tpm'): TokenBucket }
+    self.waiters = [] # heap of (priority, seq, request)
+    self.seq = 0
+    self.admissions = 0
+    self.condition = threading.Condition()
+
+    self.admitted = {name: 0 for name in PRIORITY_NAMES.values()}
+    self.wait_seconds = {name: 0.0 for name in PRIORITY_NAMES.values()}
+    self.max_wait_seconds = {name: 0.0 for name in PRIORITY_NAMES.values()}
+
+
+  def enabled(self):
+    return bool(self.model_limits) or self.api_key_limits is not None
+
+
+  def bucket(self, scope, name, limit_name, limit):
+    key = (scope, name, limit_name)
+    if key not in self.buckets: self.buckets[key] = TokenBucket(limit, 60, self.clock)
+    return self.buckets[key]
+
+
+  def request_buckets(self, model, api_key, tokens, requests=1):
+    # [(bucket, amount)] a call must take from
+    needs = []
+    scopes = []
+    if model in self.model_limits: scopes.append(('model', model, self.model_limits[model]))
+    if self.api_key_limits is not None: scopes.append(('api_key', api_key, self.api_key_limits))
+
+    for scope, name, limits in scopes:
+      if limits.get('rpm') and requests: needs.append((self.bucket(scope, name, 'rpm', limits['rpm']), requests))
+      if limits.get('tpm') and tokens: needs.append((self.bucket(scope, name, 'tpm', limits['tpm']), tokens))
+    return needs
+
+
+  def enqueue(self, model, api_key, tokens, priority):
+    '''
+    Adds a waiting call. Caller holds the condition; admit it with poll().
+    '''
+    self.seq += 1
+    request = {'needs': self.request_buckets(model, api_key, tokens), 'priority': priority, 'enqueued_at': self.clock(), 'admitted_at': None}
+    heapq.heappush(self.waiters, (priority, self.seq, request))
+    return request
+
+
+  def poll(self):
+    '''
+    Admits every waiting call that fits, in priority order. Returns the seconds until the next blocked call could be
+    admitted, or None if nobody is waiting. Caller holds the condition.
+    '''
+    reserved = set() # ids of buckets held for a higher priority waiter
+    still_waiting = []
+    next_admission = None
+
+    while self.waiters:
+      priority, seq, request = heapq.heappop(self.waiters)
+      needs = request['needs']
+
+      if not any(id(bucket) in reserved for bucket, amount in needs):
+        wait = max((bucket.time_until(amount) for bucket, amount in needs), default=0.0)
+        if wait <= 0:
+          for bucket, amount in needs: bucket.take(amount)
+          self.record(request)
+          continue
+
+        next_admission = wait if next_admission is None else min(next_admission, wait)
+
+      for bucket, amount in needs: reserved.add(id(bucket))
+      still_waiting.append((priority, seq, request))
+
+    # (a waiter blocked only by a reservation is woken when the waiter holding it is admitted)
+    for waiter in still_waiting: heapq.heappush(self.waiters, waiter)
+    return next_admission
+
+
+  def record(self, request):
+    self.admissions += 1
+    request['admitted_at'] = self.clock()
+    name = PRIORITY_NAMES.get(request['priority'], str(request['priority']))
+    waited = request['admitted_at'] - request['enqueued_at']
+
+    self.admitted[name] = self.admitted.get(name, 0) + 1
+    self.wait_seconds[name] = self.wait_seconds.get(name, 0.0) + waited
+    self.max_wait_seconds[name] = max(self.max_wait_seconds.get(name, 0.0), waited)
+
+
+  def acquire(self, model, api_key, tokens, priority):
+    '''
+    Blocks until the call is admitted. tokens: estimate_request_tokens of the call. Returns the seconds waited.
+    '''
+    if not self.enabled(): return 0.0
+
+    with self.condition:
+      request = self.enqueue(model, api_key, tokens, priority)
+      while True:
+        admissions = self.admissions
+        wait = self.poll()
+
+        # poll may have admitted other threads' calls too: wake them
+        if self.admissions != admissions: self.condition.notify_all()
+        if request['admitted_at'] is not None: break
+        self.condition.wait(wait)
+
+    return request['admitted_at'] - request['enqueued_at']
+
+
+  def settle(self, model, api_key, reserved_tokens, used_tokens):
+    '''
+    Corrects a call's token reservation to its actual usage (known once it finishes): the unused part is returned, usage
+    beyond the estimate is taken as well (the buckets may go negative, delaying the next admissions until they refill).
+    '''
+    if not self.enabled() or used_tokens is None or used_tokens == reserved_tokens: return
+
+    with self.condition:
+      for bucket, amount in self.request_buckets(model, api_key, abs(reserved_tokens - used_tokens), requests=0):
+        if used_tokens < reserved_tokens: bucket.give(amount)
+        else: bucket.take(amount)
+      self.condition.notify_all()
+
+
+  def stats(self):
+    with self.condition:
+      return {
+        'waiting': len(self.waiters),
+        'admitted': dict(self.admitted),
+        'mean_wait_seconds': {name: (self.wait_seconds[name] / count if count else 0.0) for name, count in self.admitted.items()},
+        'max_wait_seconds': dict(self.max_wait_seconds)
+      }
+
+
+# shared by every OpenAI call made from this process (disabled until configure_admission sets limits)
+admission = AdmissionController()
+
+def configure_admission(cw_config):
+  '''
+  Applies cw_config's "openai_rate_limits": { 'models': { model: { 'rpm', 'tpm' } }, 'api_key': { 'rpm', 'tpm' } }.
+  '''
+  limits = cw_config.get("openai_rate_limits") or {}
+  with admission.condition:
+    admission.model_limits = limits.get('models') or {}
+    admission.api_key_limits = limits.get('api_key')
+    admission.buckets = {}
@@ -0,0 +1,210 @@
+'''
+The UserData DynamoDB table. The boto3 resource is created on first use (importing touches no AWS), one per thread:
+boto3 resources are not thread-safe.
+Traced invocations (see Tracing) also count the consumed read & write capacity units.
+'''
+
+import time
+import threading
+import boto3
+from boto3.dynamodb.conditions import Key
+from AuraStorage.StorageBackend import StorageBackend
+from Tracing import current_trace
+
+# cancellation reasons of a transaction that are retried: it conflicted with another write or was throttled, and none
+# of its conditions failed
+RETRYABLE_CANCELLATIONS = {'TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded'}
+TRANSACTION_ATTEMPTS = 3
+
+class DynamoDBBackend(StorageBackend):
+  name = 'dynamodb'
+
+  def __init__(self, table_name='UserData'):
+    super().__init__()
+    self.table_name = table_name
+    self.thread_local = threading.local()
+
+
+  def table(self):
+    if not hasattr(self.thread_local, 'table'):
+      self.thread_local.resource = boto3.resource('dynamodb')
+      self.thread_local.table = self.thread_local.resource.Table(self.table_name)
+    return self.thread_local.table
+
+
+  def client(self):
+    # the resource's client (un)marshals attribute values itself, so items are passed as plain python values
+    return self.table().meta.client
+
+
+  def with_capacity(self, params):
+    # consumed capacity is only returned (and counted) when the invocation is traced
+    if current_trace() is not None: params['ReturnConsumedCapacity'] = 'TOTAL'
+    return params
+
+
+  def record_capacity(self, response, kind):
+    consumed = response.get('ConsumedCapacity')
+    if consumed is None: return
+
+    trace = current_trace()
+    if trace is None: return
+
+    # a list for batch & transaction calls, one entry per table
+    if isinstance(consumed, dict): consumed = [consumed]
+    trace.count(f'ddb_{kind}_capacity', sum(float(entry.get('CapacityUnits', 0)) for entry in consumed), 'None')
+
+
+  def put_item(self, item):
+    self.record('put_item')
+    response = self.table().put_item(**self.with_capacity({'Item': item}))
+    self.record_capacity(response, 'write')
+
+
+  def put_items(self, items):
+    # batch_writer paginates into BatchWriteItem calls of 25 and retries unprocessed items (its consumed capacity isn't returned)
+    self.record('put_items')
+    with self.table().batch_writer() as batch:
+      for item in items:
+        batch.put_item(Item=item)
+
+
+  def put_item_conditional(self, item, condition_expression, expression_values):
+    self.record('put_item_conditional')
+    try:
+      response = self.table().put_item(**self.with_capacity({
+        'Item': item,
+        'ConditionExpression': condition_expression,
+        'ExpressionAttributeValues': expression_values
+      }))
+      self.record_capacity(response, 'write')
+      return True
+
+    except self.client().exceptions.ConditionalCheckFailedException:
+      return False
+
+
+  def transact_put_items(self, puts):
+    self.record('transact_put_items')
+
+    transact_items = []
+    for put in puts:
+      request = {
+        'TableName': self.table_name,
+        'Item': put['item']
+      }
+      if put.get('condition') is not None:
+        request['ConditionExpression'] = put['condition']
+        request['ExpressionAttributeValues'] = put['values']
+      transact_items.append({'Put': request})
+
+    for attempt in range(TRANSACTION_ATTEMPTS):
+      try:
+        response = self.client().transact_write_items(**self.with_capacity({'TransactItems': transact_items}))
+        self.record_capacity(response, 'write')
+        return True
+
+      except self.client().exceptions.TransactionCanceledException as e:
+        # one reason per item, in order ('None' for the items that didn't cause the cancellation)
+        codes = {reason.get('Code') for reason in e.response.get('CancellationReasons', [])} - {'None'}
+        if 'ConditionalCheckFailed' in codes: return False
+        if not codes or not codes <= RETRYABLE_CANCELLATIONS or attempt == TRANSACTION_ATTEMPTS - 1: raise
+
+        time.sleep(0.05 * 2 ** attempt)
+
+
+  def get_item(self, partitionk, sortk):
+    self.record('get_item')
+    response = self.table().get_item(**self.with_capacity({'Key': {'partitionk': partitionk, 'sortk': sortk}}))
+    self.record_capacity(response, 'read')
+    return response.get('Item')
+
+
+  def batch_get_items(self, keys):
+    # BatchGetItem takes 100 keys per request, retrying unprocessed keys
+    self.record('batch_get_items')
+    items = []
+
+    for i in range(0, len(keys), 100):
+      request_items = {self.table_name: {'Keys': keys[i:i + 100]}}
+
+      while request_items:
+        response = self.client().batch_get_item(**self.with_capacity({'RequestItems': request_items}))
+        self.record_capacity(response, 'read')
+        items.extend(response['Responses'].get(self.table_name, []))
+        request_items = response.get('UnprocessedKeys')
+
+    return items
+
+
+  def update_item(self, key, update_expression, expression_values, condition_expression=None):
+    self.record('update_item')
+    params = {
+      'Key': key,
+      'UpdateExpression': update_expression,
+      'ExpressionAttributeValues': expression_values
+    }
+    if condition_expression is not None: params['ConditionExpression'] = condition_expression
+
+    try:
+      response = self.table().update_item(**self.with_capacity(params))
+      self.record_capacity(response, 'write')
+      return True
+
+    except self.client().exceptions.ConditionalCheckFailedException:
+      return False
+
+
+  def query(self, partitionk, scan_index_forward=True, limit=1, consistent_read=False):
+    # returns all limit items regardless of the 1mb page limit
+    self.record('query')
+    items = []
+    params = {
+      'KeyConditionExpression': Key('partitionk').eq(partitionk),
+      'ScanIndexForward': scan_index_forward,
+      'ConsistentRead': consistent_read,
+      'Limit': limit
+    }
+    self.with_capacity(params)
+
+    while True:
+      response = self.table().query(**params)
+      self.record_capacity(response, 'read')
+      items.extend(response['Items'])
+      if 'LastEvaluatedKey' not in response or len(items) >= limit: return items
+
+      params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+      params['Limit'] = limit - len(items)
+
+
+  def count(self, partitionk, consistent_read=False):
+    # a COUNT query, paginated past the 1mb limit
+    self.record('count')
+    count = 0
+    params = {
+      'KeyConditionExpression': Key('partitionk').eq(partitionk),
+      'ConsistentRead': consistent_read,
+      'Select': 'COUNT'
+    }
+    self.with_capacity(params)
+
+    while True:
+      response = self.table().query(**params)
+      self.record_capacity(response, 'read')
+      count += response['Count']
+      if 'LastEvaluatedKey' not in response: return count
+      params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+  def delete_item(self, partitionk, sortk):
+    self.record('delete_item')
+    try:
+      response = self.table().delete_item(**self.with_capacity({
+        'Key': {'partitionk': partitionk, 'sortk': sortk},
+        'ConditionExpression': "attribute_exists(partitionk)"
+      }))
+      self.record_capacity(response, 'write')
+      return True
+
+    except self.client().exceptions.ConditionalCheckFailedException:
+      return False
@@ -0,0 +1,259 @@
+'''
+Evaluator for the subset of DynamoDB condition & update expressions the LEM uses, so the local storage backends apply
+the same conditional writes as DynamoDB:
+  conditions: OR, AND, NOT, parentheses, = <> < <= > >=, attribute_exists(a), attribute_not_exists(a), begins_with(a, :v)
+  updates: SET a = <value> [, ...] and REMOVE a [, ...], where <value> is :v, b, if_not_exists(b, :v),
+    list_append(x, y), or x + y / x - y of those
+Attribute names are top-level (no nested paths or #name placeholders). Anything else raises ValueError.
+'''
+
+import re
+from decimal import Decimal
+from functools import lru_cache
+
+TOKEN_PATTERN = re.compile(r'\s*(<>|<=|>=|=|<|>|\(|\)|,|\+|-|:[A-Za-z0-9_]+|[A-Za-z_][A-Za-z0-9_]*)')
+
+COMPARATORS = {
+  '=': lambda a, b: a == b,
+  '<>': lambda a, b: a != b,
+  '<': lambda a, b: a < b,
+  '<=': lambda a, b: a <= b,
+  '>': lambda a, b: a > b,
+  '>=': lambda a, b: a >= b
+}
+
+MISSING = object() # an attribute the item doesn't have
+
+
+def tokenize(expression):
+  tokens = []
+  position = 0
+  while position < len(expression):
+    match = TOKEN_PATTERN.match(expression, position)
+    if match is None:
+      if expression[position:].strip() == '': break
+      raise ValueError(f'Unsupported expression syntax at {position}: {expression!r}')
+    tokens.append(match.group(1))
+    position = match.end()
+  return tokens
+
+
+def value_type(value):
+  # DynamoDB only compares values of the same type (N, S, BOOL, ...)
+  if isinstance(value, bool): return 'BOOL'
+  if isinstance(value, (int, float, Decimal)): return 'N'
+  return type(value).__name__
+
+
+def compare(comparator, a, b):
+  if a is MISSING or b is MISSING: return False
+  if value_type(a) != value_type(b): return comparator == '<>'
+  if comparator not in ('=', '<>') and value_type(a) not in ('N', 'str', 'bytes'): return False
+  return COMPARATORS[comparator](a, b)
+
+
+def begins_with(value, prefix):
+  return isinstance(value, str) and isinstance(prefix, str) and value.startswith(prefix)
+
+
+class Parser():
+  def __init__(self, expression):
+    self.expression = expression
+    self.tokens = tokenize(expression)
+    self.position = 0
+
+
+  def peek(self):
+    return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+
+  def take(self, expected=None):
+    token = self.peek()
+    if token is None or (expected is not None and token.upper() != expected.upper()):
+      raise ValueError(f'Expected {expected or "a token"} in {self.expression!r}')
+    self.position += 1
+    return token
+
+
+  def at_keyword(self, *keywords):
+    token = self.peek()
+    return token is not None and token.upper() in keywords
+
+
+  def end(self):
+    if self.peek() is not None: raise ValueError(f'Unexpected {self.peek()!r} in {self.expression!r}')
+
+
+  ### conditions: each node is a function (item, values) -> bool
+
+  def condition(self):
+    node = self.conjunction()
+    while self.at_keyword('OR'):
+      self.take()
+      left, right = node, self.conjunction()
+      node = lambda item, values, left=left, right=right: left(item, values) or right(item, values)
+    return node
+
+
+  def conjunction(self):
+    node = self.negation()
+    while self.at_keyword('AND'):
+      self.take()
+      left, right = node, self.negation()
+      node = lambda item, values, left=left, right=right: left(item, values) and right(item, values)
+    return node
+
+
+  def negation(self):
+    if self.at_keyword('NOT'):
+      self.take()
+      inner = self.negation()
+      return lambda item, values: not inner(item, values)
+    return self.comparison()
+
+
+  def comparison(self):
+    if self.peek() == '(':
+      self.take('(')
+      node = self.condition()
+      self.take(')')
+      return node
+
+    if self.peek() is not None and self.peek().lower() in ('attribute_exists', 'attribute_not_exists', 'begins_with') and self.tokens[self.position + 1:self.position + 2] == ['(']:
+      function = self.take().lower()
+      self.take('(')
+      name = self.name()
+
+      if function == 'begins_with':
+        self.take(',')
+        prefix = self.operand()
+        self.take(')')
+        return lambda item, values: begins_with(item.get(name, MISSING), prefix(item, values))
+
+      self.take(')')
+      if function == 'attribute_exists': return lambda item, values: name in item
+      return lambda item, values: name not in item
+
+    left = self.operand()
+    comparator = self.take()
+    if comparator not in COMPARATORS: raise ValueError(f'Unsupported comparator {comparator!r} in {self.expression!r}')
+    right = self.operand()
+    return lambda item, values: compare(comparator, left(item, values), right(item, values))
+
+
+  def name(self):
+    token = self.take()
+    if not re.match(r'[A-Za-z_]', token): raise ValueError(f'Expected an attribute name, got {token!r} in {self.expression!r}')
+    return token
+
+
+  def operand(self):
+    # a :value placeholder or an attribute of the item; functions (item, values) -> value or MISSING
+    if self.peek() is not None and self.peek().startswith(':'):
+      placeholder = self.take()
+      return lambda item, values: values[placeholder]
+
+    name = self.name()
+    return lambda item, values: item.get(name, MISSING)
+
+
+  ### updates: (assignments [(name, value function)], removals [names])
+
+  def update(self):
+    assignments = []
+    removals = []
+
+    while self.peek() is not None:
+      section = self.take().upper()
+      if section == 'SET':
+        while True:
+          name = self.name()
+          self.take('=')
+          assignments.append((name, self.update_value()))
+          if self.peek() != ',': break
+          self.take(',')
+
+      elif section == 'REMOVE':
+        while True:
+          removals.append(self.name())
+          if self.peek() != ',': break
+          self.take(',')
+
+      else:
+        raise ValueError(f'Unsupported update section {section!r} in {self.expression!r}')
+
+    return (assignments, removals)
+
+
+  def update_value(self):
+    left = self.update_operand()
+    if self.peek() in ('+', '-'):
+      sign = 1 if self.take() == '+' else -1
+      right = self.update_operand()
+      return lambda item, values: left(item, values) + sign * right(item, values)
+    return left
+
+
+  def update_operand(self):
+    if self.peek() is not None and self.peek().lower() in ('if_not_exists', 'list_append') and self.tokens[self.position + 1:self.position + 2] == ['(']:
+      function = self.take().lower()
+      self.take('(')
+
+      if function == 'if_not_exists':
+        name = self.name()
+        self.take(',')
+        default = self.update_operand()
+        self.take(')')
+        return lambda item, values: item[name] if name in item else default(item, values)
+
+      first = self.update_operand()
+      self.take(',')
+      second = self.update_operand()
+      self.take(')')
+      return lambda item, values: list(first(item, values)) + list(second(item, values))
+
+    operand = self.operand()
+
+    def present(item, values):
+      value = operand(item, values)
+      if value is MISSING: raise ValueError(f'An operand of {self.expression!r} refers to a missing attribute')
+      return value
+    return present
+
+
+@lru_cache(maxsize=256)
+def parse_condition(expression):
+  parser = Parser(expression)
+  node = parser.condition()
+  parser.end()
+  return node
+
+
+@lru_cache(maxsize=256)
+def parse_update(expression):
+  parser = Parser(expression)
+  node = parser.update()
+  parser.end()
+  return node
+
+
+def condition_holds(condition_expression, item, values):
+  '''
+  Whether condition_expression holds for item ({} if the item doesn't exist). No condition always holds.
+  '''
+  if condition_expression is None: return True
+  return parse_condition(condition_expression)(item, values or {})
+
+
+def apply_update(update_expression, item, values):
+  '''
+  Returns a copy of item with update_expression applied. Every value is computed from the item as it was before the
+  update, as in DynamoDB.
+  '''
+  assignments, removals = parse_update(update_expression)
+  computed = [(name, value(item, values or {})) for name, value in assignments]
+
+  updated = dict(item)
+  for name, value in computed: updated[name] = value
+  for name in removals: updated.pop(name, None)
+  return updated
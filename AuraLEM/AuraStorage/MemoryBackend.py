@@ -0,0 +1,120 @@
+'''
+In-process store with DynamoDB's semantics, for offline runs & load tests. Thread-safe: every operation (including a
+conditional check and its write, and a whole transaction) runs under one lock. Items are copied in and out, so callers
+can't mutate stored items. Not shared between processes.
+'''
+
+import copy
+import bisect
+import threading
+from AuraStorage.StorageBackend import StorageBackend
+from AuraStorage.Expressions import condition_holds, apply_update
+
+class MemoryBackend(StorageBackend):
+  name = 'memory'
+
+  def __init__(self):
+    super().__init__()
+    self.partitions = {} # { partitionk: { sortk: item } }
+    self.sortks = {} # { partitionk: [sortk, ...] ascending }
+    self.lock = threading.Lock()
+
+
+  def stored(self, partitionk, sortk):
+    # caller holds the lock. The stored item (not a copy) or None
+    return self.partitions.get(partitionk, {}).get(sortk)
+
+
+  def write(self, item):
+    # caller holds the lock
+    partitionk, sortk = item['partitionk'], item['sortk']
+    partition = self.partitions.setdefault(partitionk, {})
+    if sortk not in partition: bisect.insort(self.sortks.setdefault(partitionk, []), sortk)
+    partition[sortk] = copy.deepcopy(item)
+
+
+  def remove(self, partitionk, sortk):
+    # caller holds the lock
+    del self.partitions[partitionk][sortk]
+    sortks = self.sortks[partitionk]
+    del sortks[bisect.bisect_left(sortks, sortk)]
+
+    if not sortks:
+      del self.partitions[partitionk], self.sortks[partitionk]
+
+
+  def put_item(self, item):
+    self.record('put_item')
+    with self.lock:
+      self.write(item)
+
+
+  def put_items(self, items):
+    self.record('put_items')
+    with self.lock:
+      for item in items: self.write(item)
+
+
+  def put_item_conditional(self, item, condition_expression, expression_values):
+    self.record('put_item_conditional')
+    with self.lock:
+      if not condition_holds(condition_expression, self.stored(item['partitionk'], item['sortk']) or {}, expression_values): return False
+      self.write(item)
+      return True
+
+
+  def transact_put_items(self, puts):
+    self.record('transact_put_items')
+    with self.lock:
+      for put in puts:
+        stored = self.stored(put['item']['partitionk'], put['item']['sortk']) or {}
+        if not condition_holds(put.get('condition'), stored, put.get('values')): return False
+
+      for put in puts: self.write(put['item'])
+      return True
+
+
+  def get_item(self, partitionk, sortk):
+    self.record('get_item')
+    with self.lock:
+      return copy.deepcopy(self.stored(partitionk, sortk))
+
+
+  def batch_get_items(self, keys):
+    self.record('batch_get_items')
+    with self.lock:
+      items = [self.stored(key['partitionk'], key['sortk']) for key in keys]
+      return [copy.deepcopy(item) for item in items if item is not None]
+
+
+  def update_item(self, key, update_expression, expression_values, condition_expression=None):
+    self.record('update_item')
+    with self.lock:
+      stored = self.stored(key['partitionk'], key['sortk']) or {}
+      if not condition_holds(condition_expression, stored, expression_values): return False
+
+      self.write(dict(apply_update(update_expression, stored, expression_values), **key))
+      return True
+
+
+  def query(self, partitionk, scan_index_forward=True, limit=1, consistent_read=False):
+    self.record('query')
+    with self.lock:
+      partition = self.partitions.get(partitionk, {})
+      sortks = self.sortks.get(partitionk, [])
+      selected = sortks[:limit] if scan_index_forward else sortks[max(len(sortks) - limit, 0):][::-1]
+      return [copy.deepcopy(partition[sortk]) for sortk in selected]
+
+
+  def count(self, partitionk, consistent_read=False):
+    self.record('count')
+    with self.lock:
+      return len(self.sortks.get(partitionk, []))
+
+
+  def delete_item(self, partitionk, sortk):
+    self.record('delete_item')
+    with self.lock:
+      if self.stored(partitionk, sortk) is None: return False
+      self.remove(partitionk, sortk)
+      return True
@@ -0,0 +1,138 @@
+'''
+Store in a SQLite (WAL) database file, shared by every thread & process that opens the same path (e.g. the ELAM
+worker processes). Items are stored as JSON, with numbers read back as int / Decimal like DynamoDB's. sortk is
+compared bytewise (BINARY collation), which is DynamoDB's string ordering. Conditional writes and transactions run in
+one BEGIN IMMEDIATE transaction, so they are atomic across processes.
+'''
+
+import os
+import sqlite3
+import threading
+import simplejson as json
+from AuraStorage.StorageBackend import StorageBackend
+from AuraStorage.Expressions import condition_holds, apply_update
+
+class SQLiteBackend(StorageBackend):
+  name = 'sqlite'
+
+  def __init__(self, path):
+    super().__init__()
+    self.path = path
+    self.thread_local = threading.local()
+    self.connection() # creates the table
+
+
+  def connection(self):
+    # one connection per thread (and per process: a forked child opens its own)
+    if getattr(self.thread_local, 'pid', None) != os.getpid():
+      connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+      connection.execute("PRAGMA journal_mode=WAL")
+      connection.execute("PRAGMA synchronous=NORMAL")
+      connection.execute("""CREATE TABLE IF NOT EXISTS items (
+        partitionk TEXT NOT NULL,
+        sortk TEXT NOT NULL,
+        item TEXT NOT NULL,
+        PRIMARY KEY (partitionk, sortk)
+      ) WITHOUT ROWID""")
+      self.thread_local.connection = connection
+      self.thread_local.pid = os.getpid()
+    return self.thread_local.connection
+
+
+  def transaction(self, function):
+    # runs function(connection) in a write transaction, committing what it wrote unless it raises
+    connection = self.connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+      result = function(connection)
+      connection.execute("COMMIT")
+      return result
+    except Exception:
+      connection.execute("ROLLBACK")
+      raise
+
+
+  def stored(self, connection, partitionk, sortk):
+    row = connection.execute("SELECT item FROM items WHERE partitionk = ? AND sortk = ?", (partitionk, sortk)).fetchone()
+    return json.loads(row[0], use_decimal=True) if row is not None else None
+
+
+  def write(self, connection, items):
+    connection.executemany("INSERT OR REPLACE INTO items (partitionk, sortk, item) VALUES (?, ?, ?)",
+      [(item['partitionk'], item['sortk'], json.dumps(item)) for item in items])
+
+
+  def put_item(self, item):
+    self.record('put_item')
+    self.transaction(lambda connection: self.write(connection, [item]))
+
+
+  def put_items(self, items):
+    self.record('put_items')
+    self.transaction(lambda connection: self.write(connection, items))
+
+
+  def put_item_conditional(self, item, condition_expression, expression_values):
+    self.record('put_item_conditional')
+
+    def conditional_put(connection):
+      if not condition_holds(condition_expression, self.stored(connection, item['partitionk'], item['sortk']) or {}, expression_values): return False
+      self.write(connection, [item])
+      return True
+
+    return self.transaction(conditional_put)
+
+
+  def transact_put_items(self, puts):
+    self.record('transact_put_items')
+
+    def transact_put(connection):
+      for put in puts:
+        stored = self.stored(connection, put['item']['partitionk'], put['item']['sortk']) or {}
+        if not condition_holds(put.get('condition'), stored, put.get('values')): return False
+
+      self.write(connection, [put['item'] for put in puts])
+      return True
+
+    return self.transaction(transact_put)
+
+
+  def get_item(self, partitionk, sortk):
+    self.record('get_item')
+    return self.stored(self.connection(), partitionk, sortk)
+
+
+  def batch_get_items(self, keys):
+    self.record('batch_get_items')
+    connection = self.connection()
+    items = [self.stored(connection, key['partitionk'], key['sortk']) for key in keys]
+    return [item for item in items if item is not None]
+
+
+  def update_item(self, key, update_expression, expression_values, condition_expression=None):
+    self.record('update_item')
+
+    def update(connection):
+      stored = self.stored(connection, key['partitionk'], key['sortk']) or {}
+      if not condition_holds(condition_expression, stored, expression_values): return False
+      self.write(connection, [dict(apply_update(update_expression, stored, expression_values), **key)])
+      return True
+
+    return self.transaction(update)
+
+
+  def query(self, partitionk, scan_index_forward=True, limit=1, consistent_read=False):
+    self.record('query')
+    order = "ASC" if scan_index_forward else "DESC"
+    rows = self.connection().execute(f"SELECT item FROM items WHERE partitionk = ? ORDER BY sortk {order} LIMIT ?", (partitionk, limit)).fetchall()
+    return [json.loads(row[0], use_decimal=True) for row in rows]
+
+
+  def count(self, partitionk, consistent_read=False):
+    self.record('count')
+    return self.connection().execute("SELECT COUNT(*) FROM items WHERE partitionk = ?", (partitionk,)).fetchone()[0]
+
+
+  def delete_item(self, partitionk, sortk):
+    self.record('delete_item')
+    return self.transaction(lambda connection: connection.execute("DELETE FROM items WHERE partitionk = ? AND sortk = ?", (partitionk, sortk)).rowcount > 0)
@@ -0,0 +1,87 @@
+'''
+Interface of the stores behind DynamoDBUtilities. Items are dicts keyed by ('partitionk', 'sortk'); a partition's
+items are ordered by sortk (as DynamoDB orders string sort keys: by UTF-8 bytes, which is python's str order).
+Conditions & updates are DynamoDB expressions (the local backends support the subset in AuraStorage.Expressions).
+Backend errors other than a failed condition are raised.
+'''
+
+import threading
+from Tracing import count
+
+class StorageBackend():
+  def __init__(self):
+    self.calls = {} # { operation: calls }
+    self.calls_lock = threading.Lock()
+
+
+  def record(self, operation):
+    with self.calls_lock:
+      self.calls[operation] = self.calls.get(operation, 0) + 1
+    count(f'ddb_{operation}')
+
+
+  def stats(self):
+    with self.calls_lock:
+      return {'backend': self.name, 'calls': dict(self.calls)}
+
+
+  def put_item(self, item):
+    raise NotImplementedError
+
+
+  def put_items(self, items):
+    '''
+    Writes items in batches. Not atomic: use transact_put_items for all-or-nothing writes.
+    '''
+    raise NotImplementedError
+
+
+  def put_item_conditional(self, item, condition_expression, expression_values):
+    '''
+    Returns True if written, False if the condition failed.
+    '''
+    raise NotImplementedError
+
+
+  def transact_put_items(self, puts):
+    '''
+    puts: [{'item': {...}, 'condition': expression or None, 'values': {...} or None}]. Writes all of them or none.
+    Returns True if written, False if a condition failed.
+    '''
+    raise NotImplementedError
+
+
+  def get_item(self, partitionk, sortk):
+    raise NotImplementedError
+
+
+  def batch_get_items(self, keys):
+    '''
+    Returns the items for keys [{'partitionk', 'sortk'}] in no particular order, skipping missing ones.
+    '''
+    raise NotImplementedError
+
+
+  def update_item(self, key, update_expression, expression_values, condition_expression=None):
+    '''
+    Updates (or creates) the item at key. Returns True if updated, False if the condition failed.
+    '''
+    raise NotImplementedError
+
+
+  def query(self, partitionk, scan_index_forward=True, limit=1, consistent_read=False):
+    '''
+    Returns up to limit items of the partition, by ascending (scan_index_forward) or descending sortk.
+    '''
+    raise NotImplementedError
+
+
+  def count(self, partitionk, consistent_read=False):
+    raise NotImplementedError
+
+
+  def delete_item(self, partitionk, sortk):
+    '''
+    Returns True if this call deleted the item, False if it did not exist.
+    '''
+    raise NotImplementedError
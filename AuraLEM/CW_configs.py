@@ -20,6 +20,26 @@ def get_cw_config(name):
       "elam_im_mtl": 500, # the max length of the intellignece message (in elam tokens)
       "elam_aw_mtl": 1596, # the max length of the analysis window (in tokens)
       "elam_wiggle_room": 15, # the amount of wiggle room allowed for the context window (in tokens)
+
+      "storage_backend": None, # store behind DynamoDBUtilities: None (the aura_storage_backend env var, default "dynamodb"), "dynamodb", "memory" or "sqlite"
+      "storage_path": None, # database file for "sqlite" (default: the aura_storage_path env var)
+      "context_snapshot": False, # also keep a single-item context snapshot, read with one GetItem per turn
+      "idempotency_lease_seconds": 900, # the idempotency lock expires after this long (a turn can't outlive the lambda timeout)
+      "mailbox": None, # queue messages for a locked thread: None (reject them), "local" or "dynamodb"
+      "mailbox_max_depth": 5, # queued messages per thread before new ones are rejected (429)
+      "elam_executor": None, # where async analyses run locally: None (inline), "thread", "process" or "sqlite"
+      "elam_executor_workers": 2, # concurrent analyses
+      "elam_executor_max_pending": 64, # queued + running analyses before new ones run inline
+      "elam_executor_path": None, # SQLite job queue file for "sqlite" (default: the aura_elam_queue_path env var)
+      "elam_debounce_seconds": 0, # merge a thread's async analyses submitted within this interval into one call (0: off)
+      "speculative_reflect": False, # start force_reflect analyses alongside the reply (the reply itself is analyzed async after)
+      "tracing": None, # per-invocation EMF metrics: None (the aura_tracing env var, default off) or { "namespace", "sample_rate" }, see Tracing
+      "openai_rate_limits": None, # { "models": { model: { "rpm", "tpm" } }, "api_key": { "rpm", "tpm" } }, shared per process
+      "openai_client": None, # connection pool, timeout & base_url overrides of AuraOpenAI.ClientRegistry.DEFAULT_SETTINGS
+      "elks_latency_policy": None, # hedging / fallback models on slow first tokens, see AuraOpenAI.LatencyPolicy
+      "elks_frame_max_chars": 256, # streamed deltas are coalesced into websocket frames of up to this many characters
+      "elks_frame_max_delay_seconds": 0.05, # and no delta waits longer than this to be sent
+      "elks_response_cache": None, # { "max_entries", "ttl_seconds", "opt_out_api_keys" } reuse replies to identical calls, see AuraELKs.ResponseCache
     }
 
   elif name == 'local_test_small':
@@ -41,6 +61,26 @@ def get_cw_config(name):
       "elam_im_mtl": 20, # the max length of the intellignece message (in elam tokens)
       "elam_aw_mtl": 50, # the max length of the analysis window (in tokens)
       "elam_wiggle_room": 15, # the amount of wiggle room allowed for the context window (in tokens)
+
+      "storage_backend": None, # store behind DynamoDBUtilities: None (the aura_storage_backend env var, default "dynamodb"), "dynamodb", "memory" or "sqlite"
+      "storage_path": None, # database file for "sqlite" (default: the aura_storage_path env var)
+      "context_snapshot": False, # also keep a single-item context snapshot, read with one GetItem per turn
+      "idempotency_lease_seconds": 900, # the idempotency lock expires after this long (a turn can't outlive the lambda timeout)
+      "mailbox": None, # queue messages for a locked thread: None (reject them), "local" or "dynamodb"
+      "mailbox_max_depth": 5, # queued messages per thread before new ones are rejected (429)
+      "elam_executor": None, # where async analyses run locally: None (inline), "thread", "process" or "sqlite"
+      "elam_executor_workers": 2, # concurrent analyses
+      "elam_executor_max_pending": 64, # queued + running analyses before new ones run inline
+      "elam_executor_path": None, # SQLite job queue file for "sqlite" (default: the aura_elam_queue_path env var)
+      "elam_debounce_seconds": 0, # merge a thread's async analyses submitted within this interval into one call (0: off)
+      "speculative_reflect": False, # start force_reflect analyses alongside the reply (the reply itself is analyzed async after)
+      "tracing": None, # per-invocation EMF metrics: None (the aura_tracing env var, default off) or { "namespace", "sample_rate" }, see Tracing
+      "openai_rate_limits": None, # { "models": { model: { "rpm", "tpm" } }, "api_key": { "rpm", "tpm" } }, shared per process
+      "openai_client": None, # connection pool, timeout & base_url overrides of AuraOpenAI.ClientRegistry.DEFAULT_SETTINGS
+      "elks_latency_policy": None, # hedging / fallback models on slow first tokens, see AuraOpenAI.LatencyPolicy
+      "elks_frame_max_chars": 256, # streamed deltas are coalesced into websocket frames of up to this many characters
+      "elks_frame_max_delay_seconds": 0.05, # and no delta waits longer than this to be sent
+      "elks_response_cache": None, # { "max_entries", "ttl_seconds", "opt_out_api_keys" } reuse replies to identical calls, see AuraELKs.ResponseCache
     }
 
   else:
@@ -0,0 +1,152 @@
+'''
+In-process cache of conversation context (cwm, UDS & recent messages) for warm Lambda containers.
+'''
+
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+class ContextCache():
+  '''
+  LRU + TTL cache of the context of a communication thread, keyed by (api_key, uid, iid).
+  Entries are versioned by the cwm's (sortk, cw_version): the cwm item keeps its sortk for the life of the thread, so
+  synchronize_ddb bumps cw_version on every turn. A cached UDS & message history is only used when its version matches
+  the cwm just read from ddb, otherwise it is stale and refetched. The cwm version doesn't cover the UDS (ELAM analyses
+  write it outside of turns, possibly from another container or process), so get_context_window checks the cached
+  UDS's sortk against the latest UDS item on every turn.
+
+  trust_seconds > 0 additionally serves the cwm itself from the cache for that long after this container wrote it
+  (zero ddb reads). Only safe when a thread is pinned to one container, so it is off by default.
+  '''
+
+  def __init__(self, max_entries=1024, ttl_seconds=300, trust_seconds=0):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self.trust_seconds = trust_seconds
+
+    self.entries = OrderedDict() # { (api_key, uid, iid): entry }, ordered oldest -> most recently used
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.stale = 0
+    self.expirations = 0
+    self.evictions = 0
+    self.cwm_hits = 0 # cwm reads served in trust mode
+
+
+  def version(self, context_window_meta):
+    return (context_window_meta['sortk'], int(context_window_meta.get('cw_version', 0)))
+
+
+  def lookup(self, key):
+    # caller holds the lock. Returns the live entry or None, dropping it if it has expired
+    entry = self.entries.get(key)
+    if entry is None: return None
+
+    if time.monotonic() - entry['stored_at'] > self.ttl_seconds:
+      del self.entries[key]
+      self.expirations += 1
+      return None
+
+    self.entries.move_to_end(key)
+    return entry
+
+
+  def get_cwm(self, key):
+    '''
+    Returns a copy of the cached cwm if trust mode is on and this container wrote it within trust_seconds, else None.
+    '''
+    if self.trust_seconds <= 0: return None
+
+    with self.lock:
+      entry = self.lookup(key)
+      if entry is None or time.monotonic() - entry['stored_at'] > self.trust_seconds: return None
+
+      self.cwm_hits += 1
+      return copy.deepcopy(entry['cwm'])
+
+
+  def get_context(self, key, context_window_meta, limit):
+    '''
+    Returns copies of (uds, uds_sortk, messages[:limit]) if the cached entry is at the version of context_window_meta and holds at
+    least limit messages, else None.
+    '''
+    with self.lock:
+      entry = self.lookup(key)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      if entry['version'] != self.version(context_window_meta) or len(entry['messages']) < limit:
+        del self.entries[key]
+        self.stale += 1
+        return None
+
+      self.hits += 1
+      return (copy.deepcopy(entry['uds']), entry['uds_sortk'], copy.deepcopy(entry['messages'][:limit]))
+
+
+  def put(self, key, context_window_meta, uds, messages, uds_sortk=''):
+    '''
+    Stores the context of a thread. messages is ordered [(latest/newest_message), ..., (oldest_message)].
+    '''
+    entry = {
+      'version': self.version(context_window_meta),
+      'cwm': copy.deepcopy(context_window_meta),
+      'uds': copy.deepcopy(uds),
+      'uds_sortk': uds_sortk,
+      'messages': copy.deepcopy(messages),
+      'stored_at': time.monotonic()
+    }
+
+    with self.lock:
+      # an ELAM analysis may have written a newer UDS (update_uds) while the turn that is storing its context ran
+      previous = self.entries.get(key)
+      if previous is not None and previous['uds_sortk'] > uds_sortk: entry.update({'uds': previous['uds'], 'uds_sortk': previous['uds_sortk']})
+
+      self.entries[key] = entry
+      self.entries.move_to_end(key)
+
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+
+  def update_uds(self, key, uds, uds_sortk=''):
+    '''
+    Replaces the cached UDS of a thread (after an ELAM analysis wrote a new one), keeping the rest of the entry.
+    '''
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry['uds_sortk'] <= uds_sortk: entry.update({'uds': copy.deepcopy(uds), 'uds_sortk': uds_sortk})
+
+
+  def invalidate(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses + self.stale
+      return {
+        'entries': len(self.entries),
+        'hits': self.hits,
+        'misses': self.misses,
+        'stale': self.stale,
+        'expirations': self.expirations,
+        'evictions': self.evictions,
+        'cwm_hits': self.cwm_hits,
+        'hit_rate': (self.hits / lookups) if lookups > 0 else 0.0
+      }
+
+
+# shared by every invocation served by this container
+context_cache = ContextCache()
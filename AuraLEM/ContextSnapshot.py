@@ -0,0 +1,90 @@
+'''
+Optional denormalized storage layout: one snapshot item per communication thread holding everything a turn reads (a
+copy of the cwm, the current UDS and the ch/aw messages), so a turn's context is fetched with a single GetItem instead
+of one query per partition. Enabled with the "context_snapshot" cw_config flag. The per-partition items are still
+written and remain the source of truth: the idempotency lock is taken on the cwm item itself (re-reading it if the
+snapshot's copy lags behind), and the snapshot's context is only used when its cw_version matches that cwm.
+'''
+
+import simplejson as json
+from DynamoDBUtilities import *
+
+SNAPSHOT_SORTK = 'latest'
+
+# ddb items are capped at 400KB. The snapshot is kept under this (approximate, JSON-encoded) size, of which the UDS may
+# take at most SNAPSHOT_UDS_MAX_BYTES: the UDS and the rest of the item are written separately, so each is checked
+# against its own share. A larger UDS isn't embedded (the snapshot misses until a smaller one is written), and cwm +
+# messages above the rest spill the messages over to the existing layout: the snapshot keeps only their keys, which are
+# fetched with one BatchGetItem.
+SNAPSHOT_MAX_BYTES = 350000
+SNAPSHOT_UDS_MAX_BYTES = 100000
+
+
+def snapshot_partitionk(api_key, uid, iid):
+  return api_key + uid + iid + 'context_snapshot'
+
+
+def get_context_snapshot(api_key, uid, iid):
+  return get_item_ddb(snapshot_partitionk(api_key, uid, iid), SNAPSHOT_SORTK)
+
+
+def embeddable_uds(uds):
+  '''
+  Returns uds if it fits its share of the snapshot, else None (stored as a null UDS, on which the snapshot misses).
+  '''
+  return uds if len(json.dumps(uds)) <= SNAPSHOT_UDS_MAX_BYTES else None
+
+
+def put_context_snapshot(api_key, uid, iid, context_window_meta, uds, uds_sortk, message_history):
+  '''
+  Writes the thread's context after a turn: the cwm the turn unlocked, and message_history, ordered
+  [(latest/newest_message), ..., (oldest_message)]. Never moves the snapshot back to an older cw_version.
+  The UDS is only written if the snapshot has none: after that it belongs to update_context_snapshot_uds, so a turn
+  that started before an ELAM analysis finished can't overwrite the newer UDS.
+  '''
+  key = {'partitionk': snapshot_partitionk(api_key, uid, iid), 'sortk': SNAPSHOT_SORTK}
+  expression_values = {':v': context_window_meta['cw_version'], ':c': context_window_meta, ':u': embeddable_uds(uds), ':us': uds_sortk}
+
+  if len(json.dumps(context_window_meta)) + len(json.dumps(message_history)) <= SNAPSHOT_MAX_BYTES - SNAPSHOT_UDS_MAX_BYTES:
+    update_expression = "SET cw_version = :v, cwm = :c, messages = :m, uds = if_not_exists(uds, :u), uds_sortk = if_not_exists(uds_sortk, :us) REMOVE message_keys"
+    expression_values[':m'] = message_history
+
+  else:
+    # spill: reference the message items instead of embedding them
+    update_expression = "SET cw_version = :v, cwm = :c, message_keys = :k, uds = if_not_exists(uds, :u), uds_sortk = if_not_exists(uds_sortk, :us) REMOVE messages"
+    expression_values[':k'] = [{'partitionk': message['partitionk'], 'sortk': message['sortk']} for message in message_history]
+
+  return update_item_ddb(key, update_expression, expression_values, "attribute_not_exists(cw_version) OR cw_version < :v")
+
+
+def update_context_snapshot_uds(api_key, uid, iid, uds, uds_sortk):
+  '''
+  Sets the snapshot's UDS after an ELAM analysis, unless a newer UDS is already there.
+  '''
+  key = {'partitionk': snapshot_partitionk(api_key, uid, iid), 'sortk': SNAPSHOT_SORTK}
+  return update_item_ddb(key, "SET uds = :u, uds_sortk = :us", {':u': embeddable_uds(uds), ':us': uds_sortk},
+    "attribute_not_exists(uds_sortk) OR uds_sortk < :us")
+
+
+def read_context_snapshot(api_key, uid, iid, context_window_meta, limit, snapshot=None):
+  '''
+  Returns (uds, uds_sortk, message_history[:limit]) from the snapshot if it is at the cwm's cw_version, else None (the
+  caller falls back to querying each partition).
+  snapshot: the snapshot item if the caller already read it (get_context_window_meta reads it for its cwm copy).
+  '''
+  if snapshot is None: snapshot = get_context_snapshot(api_key, uid, iid)
+  if snapshot is None or snapshot.get('uds') is None: return None
+  if int(snapshot.get('cw_version', -1)) != int(context_window_meta.get('cw_version', 0)): return None
+
+  if 'messages' in snapshot:
+    message_history = snapshot['messages']
+
+  elif 'message_keys' in snapshot:
+    message_history = batch_get_items_ddb(snapshot['message_keys'][:limit])
+    message_history.sort(key=lambda message: message['sortk'], reverse=True)
+
+  else:
+    return None
+
+  if len(message_history) < limit: return None
+  return (snapshot['uds'], snapshot['uds_sortk'], message_history[:limit])
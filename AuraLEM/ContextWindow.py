@@ -0,0 +1,116 @@
+'''
+Compact message window used for the chat history (ch) and analysis window (aw).
+'''
+
+from bisect import bisect_left
+from collections import deque
+
+class ContextWindow():
+  '''
+  Window of messages ordered [(latest/newest_message), ..., (oldest_message)], matching the lists stored in cw_response.
+  Messages are held in a deque, with a running total and a prefix-sum index per token type, so adding the newest message
+  and trimming the oldest messages to a token budget never copy the window.
+  '''
+
+  def __init__(self, messages=None, token_types=()):
+    self.messages = deque() # newest message at index 0
+    self.token_types = list(token_types)
+
+    # per token type: cumulative token lengths counted from the oldest message, cumulative[k] - cumulative[start] being the
+    # length of the k - start oldest messages still in the window. Entries before start belong to trimmed messages.
+    self.cumulative = {token_type: [0] for token_type in self.token_types}
+    self.start = 0
+
+    # messages come ordered newest -> oldest, the index is built oldest -> newest
+    for message in reversed(messages or []):
+      self.push_newest(message)
+
+
+  def __len__(self):
+    return len(self.messages)
+
+
+  def __iter__(self):
+    return iter(self.messages)
+
+
+  def __getitem__(self, i):
+    if isinstance(i, slice): return list(self.messages)[i]
+    return self.messages[i]
+
+
+  def to_list(self):
+    return list(self.messages)
+
+
+  def push_newest(self, message):
+    '''
+    Adds message as the newest message of the window.
+    '''
+    self.messages.appendleft(message)
+    for token_type in self.token_types:
+      cumulative = self.cumulative[token_type]
+      cumulative.append(cumulative[-1] + message['token_lengths'][token_type])
+
+
+  def token_length(self, token_type):
+    cumulative = self.cumulative[token_type]
+    return cumulative[-1] - cumulative[self.start]
+
+
+  def pop_oldest(self, n=1):
+    '''
+    Removes the n oldest messages from the window.
+    '''
+    for _ in range(n):
+      self.messages.pop()
+    self.start += n
+
+    # drop the trimmed prefix of the index once it makes up most of it
+    if self.start > len(self.messages):
+      for token_type in self.token_types:
+        self.cumulative[token_type] = self.cumulative[token_type][self.start:]
+      self.start = 0
+
+
+  def trim_to_budget(self, token_type, budget):
+    '''
+    Removes the fewest oldest messages so that the window's token_type length is <= budget (a single bisect over the
+    prefix-sum index). Returns (messages_removed, tokens_removed).
+    '''
+    cumulative = self.cumulative[token_type]
+    excess = self.token_length(token_type) - budget
+    if excess <= 0: return (0, 0)
+
+    # first k (past start) such that the k - start oldest messages cover the excess
+    k = bisect_left(cumulative, cumulative[self.start] + excess, self.start, len(cumulative))
+    k = min(k, len(cumulative) - 1)
+
+    removed = k - self.start
+    tokens_removed = cumulative[k] - cumulative[self.start]
+    self.pop_oldest(removed)
+    return (removed, tokens_removed)
+
+
+  def reindex(self, token_types=None):
+    '''
+    Rebuilds the prefix-sum index from the messages' token_lengths, e.g. after they have been re-tokenized.
+    '''
+    if token_types is not None: self.token_types = list(token_types)
+
+    messages = list(self.messages)
+    self.messages = deque()
+    self.cumulative = {token_type: [0] for token_type in self.token_types}
+    self.start = 0
+    for message in reversed(messages):
+      self.push_newest(message)
+
+
+  def sync_meta(self, context_window_meta, count_key, length_key, token_type):
+    '''
+    Writes the window's message count and token_type length into the cwm counters, e.g.
+    ('ch_message_count', 'elks_ch_token_length') or ('aw_message_count', 'elam_aw_token_length').
+    '''
+    context_window_meta[count_key] = len(self.messages)
+    context_window_meta[length_key] = self.token_length(token_type)
+    return context_window_meta
@@ -1,10 +1,66 @@
 from datetime import datetime
 import simplejson as json
+import os
 import pytz
-import boto3
+import asyncio
+import threading
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# the store behind the helpers below, created on first use (see get_storage)
+storage = None
+storage_lock = threading.Lock()
+
+def make_storage(kind, path=None):
+  '''
+  kind: "dynamodb" (the UserData table), "memory" (in-process) or "sqlite" (a WAL database file at path).
+  '''
+  if kind == "dynamodb":
+    from AuraStorage.DynamoDBBackend import DynamoDBBackend
+    return DynamoDBBackend()
+
+  if kind == "memory":
+    from AuraStorage.MemoryBackend import MemoryBackend
+    return MemoryBackend()
+
+  if kind == "sqlite":
+    from AuraStorage.SQLiteBackend import SQLiteBackend
+    return SQLiteBackend(path or os.environ['aura_storage_path'])
+
+  raise ValueError(f'Unknown storage backend: {kind}')
+
+
+def get_storage():
+  '''
+  Returns the process's store. Unless configured, it is selected by the aura_storage_backend environment variable
+  (default "dynamodb"), so processes spawned by this one (e.g. ELAM workers) open the same store.
+  '''
+  global storage
+  if storage is None:
+    with storage_lock:
+      if storage is None: storage = make_storage(os.environ.get('aura_storage_backend', 'dynamodb'), os.environ.get('aura_storage_path'))
+  return storage
+
+
+def set_storage(backend):
+  global storage
+  storage = backend
+
+
+def configure_storage(cw_config):
+  '''
+  Applies cw_config's "storage_backend" & "storage_path" (None keeps the environment's selection). The selection is
+  exported to the environment as well, so processes spawned by this one (e.g. ELAM workers) open the same store.
+  '''
+  kind = cw_config.get("storage_backend")
+  if kind is None: return
+
+  path = os.path.abspath(cw_config["storage_path"]) if cw_config.get("storage_path") else None
+  os.environ['aura_storage_backend'] = kind
+  if path is not None: os.environ['aura_storage_path'] = path
+  set_storage(make_storage(kind, path))
 
-client = boto3.resource('dynamodb')
-table = client.Table('UserData')
 
 '''
 Returns a timestamp for use as sort key
@@ -23,9 +79,7 @@ def put_items_ddb(items):
   Items must be [{}] iterable of objects, purpotedly items. Batch_writer automatically paginates if len(messages) > 25
   '''
   try:
-    with table.batch_writer() as batch:
-      for item in items:
-        batch.put_item(Item=item)
+    get_storage().put_items(items)
     return "Messages added successfully"
   
   except Exception as e:
@@ -38,7 +92,7 @@ def put_item_ddb(item):
   Simply puts and item to ddb.
   """
   try:
-    table.put_item(Item=item)
+    get_storage().put_item(item)
     return {
       'statusCode': 200,
       'body': json.dumps('Request processed successfully')
@@ -52,7 +106,62 @@ def put_item_ddb(item):
     }
 
 
-def full_limit_query(partitionk, scan_index_forward=True, limit=1):
+def put_item_conditional_ddb(item, condition_expression, expression_values):
+  """
+  Puts an item only if condition_expression holds for the stored item (one conditional PutItem).
+  Returns True if written, False if the condition failed.
+  """
+  return get_storage().put_item_conditional(item, condition_expression, expression_values)
+
+
+def transact_put_items_ddb(puts):
+  """
+  Puts multiple items in one all-or-nothing TransactWriteItems call.
+  puts: [{'item': {...}, 'condition': 'ConditionExpression' or None, 'values': {ExpressionAttributeValues} or None}], max 100.
+  Returns statusCode 200 if written, 409 if a condition failed (nothing written), 500 otherwise.
+  """
+  try:
+    if get_storage().transact_put_items(puts):
+      return {
+        'statusCode': 200,
+        'body': json.dumps('Transaction committed successfully')
+      }
+
+    return {
+      'statusCode': 409,
+      'body': json.dumps("Transaction cancelled: a condition failed")
+    }
+
+  except Exception as e:
+    return {
+      'statusCode': 500,
+      'body': json.dumps(f"An error occurred: {str(e)}")
+    }
+
+
+def get_item_ddb(partitionk, sortk):
+  """
+  Returns the item with the given key (a single GetItem), or None if it does not exist.
+  """
+  return get_storage().get_item(partitionk, sortk)
+
+
+def batch_get_items_ddb(keys):
+  """
+  Returns the items for keys ([{'partitionk': ..., 'sortk': ...}]) using BatchGetItem, 100 keys per request, retrying
+  unprocessed keys. Items come back in no particular order and missing keys are skipped.
+  """
+  return get_storage().batch_get_items(keys)
+
+
+def update_item_ddb(key, update_expression, expression_values, condition_expression=None):
+  """
+  Updates (or creates) the item at key with an UpdateExpression. Returns False instead of raising if the condition failed.
+  """
+  return get_storage().update_item(key, update_expression, expression_values, condition_expression)
+
+
+def full_limit_query(partitionk, scan_index_forward=True, limit=1, consistent_read=False):
   """
   Returns a full query items list (NOT response) for a given partitionk, sortk, and limit. As in, it returns
   all items specified by limit regardless of the 1mb ddb limit.
@@ -60,28 +169,81 @@ def full_limit_query(partitionk, scan_index_forward=True, limit=1):
   paritionk: the partition key for the query in user-data
   scan_index_forward: True if ascending, False if descending
   limit: the items to be returned, must be at least 1
+  consistent_read: True for a strongly consistent read
+  """
+  return get_storage().query(partitionk, scan_index_forward, limit, consistent_read)
+
+
+def count_items_ddb(partitionk, consistent_read=False):
+  """
+  Returns the number of items in a partition (a COUNT query, paginated past the 1mb limit).
+  """
+  return get_storage().count(partitionk, consistent_read)
+
+
+def delete_item_ddb(partitionk, sortk):
+  """
+  Deletes the item at (partitionk, sortk). Returns True if this call deleted it, False if it did not exist.
   """
-  # all items will be placed, ordered, in the list below
-  items = []
-
-  # Initial query
-  initial_items_response = table.query(
-    KeyConditionExpression=boto3.dynamodb.conditions.Key('partitionk').eq(partitionk),
-    ScanIndexForward=scan_index_forward,
-    Limit=limit
-  )
-
-  # Adding initial items
-  items.extend(initial_items_response['Items'])
-
-  # Pagination handling
-  while ('LastEvaluatedKey' in initial_items_response and len(items) < limit):
-    initial_items_response = table.query(
-      KeyConditionExpression=boto3.dynamodb.conditions.Key('partitionk').eq(partitionk),
-      ScanIndexForward=scan_index_forward,
-      ExclusiveStartKey=initial_items_response['LastEvaluatedKey'],
-      Limit=limit - len(items)
-    )
-    items.extend(initial_items_response['Items'])
-
-  return items
\ No newline at end of file
+  return get_storage().delete_item(partitionk, sortk)
+
+
+### async variants: run the blocking helpers on worker threads so independent ddb calls can overlap
+
+# long-lived worker threads, so their per-thread boto3 resources (or sqlite connections) are reused across invocations of a warm container
+ddb_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='ddb')
+
+async def run_blocking(function, *args):
+  '''
+  Runs a blocking function (a ddb helper, or a stage that calls them) on ddb_executor, in the caller's context (so
+  its calls are counted in the caller's trace).
+  '''
+  return await run_in_executor(ddb_executor, function, *args)
+
+
+async def run_in_executor(executor, function, *args):
+  '''
+  run_blocking on another executor (e.g. for stages that wait on the LLM rather than on ddb).
+  '''
+  context = contextvars.copy_context()
+  return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, function, *args))
+
+
+async def put_items_ddb_async(items):
+  return await run_blocking(put_items_ddb, items)
+
+
+async def put_item_ddb_async(item):
+  return await run_blocking(put_item_ddb, item)
+
+
+async def put_item_conditional_ddb_async(item, condition_expression, expression_values):
+  return await run_blocking(put_item_conditional_ddb, item, condition_expression, expression_values)
+
+
+async def transact_put_items_ddb_async(puts):
+  return await run_blocking(transact_put_items_ddb, puts)
+
+
+async def get_item_ddb_async(partitionk, sortk):
+  return await run_blocking(get_item_ddb, partitionk, sortk)
+
+
+async def batch_get_items_ddb_async(keys):
+  return await run_blocking(batch_get_items_ddb, keys)
+
+
+async def update_item_ddb_async(key, update_expression, expression_values, condition_expression=None):
+  return await run_blocking(update_item_ddb, key, update_expression, expression_values, condition_expression)
+
+
+async def full_limit_query_async(partitionk, scan_index_forward=True, limit=1, consistent_read=False):
+  return await run_blocking(full_limit_query, partitionk, scan_index_forward, limit, consistent_read)
+
+
+async def count_items_ddb_async(partitionk, consistent_read=False):
+  return await run_blocking(count_items_ddb, partitionk, consistent_read)
+
+
+async def delete_item_ddb_async(partitionk, sortk):
+  return await run_blocking(delete_item_ddb, partitionk, sortk)
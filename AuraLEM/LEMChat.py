@@ -1,10 +1,14 @@
 import simplejson as json
 import boto3
 from LEMChatUtilities import *
-from AuraELAM.OpenAIELAM import analyze
+from AuraELAM.OpenAIELAM import analyze, use_elam_executor, start_speculative_reflect
 from CW_configs import get_cw_config
 from Tokenizers.Tokenizer import Tokenizer
 from AuraELKs.OpenAIELKs import synthesize_response
+from Mailbox import get_mailbox
+from AuraOpenAI.RateLimiter import configure_admission
+from AuraOpenAI.ClientRegistry import configure_openai_clients
+from Tracing import configure_tracing, traced_invocation, span
 
 # conn = boto3.client("apigatewaymanagementapi", endpoint_url="https://bvm4vv2jm6.execute-api.us-east-1.amazonaws.com/dev")
 from LEMTestUtilities import FakeConn
@@ -17,7 +21,27 @@ cw_config = get_cw_config('local_test_small')
 # note: tokenizer may have multiple sub-tokenizers
 tokenizer = Tokenizer({cw_config["elks_token_type"], cw_config["elam_token_type"]})
 
+# the store behind DynamoDBUtilities (DynamoDB unless configured otherwise)
+configure_storage(cw_config)
+
+# async analyses run in the background (if configured) instead of inside the chat request
+use_elam_executor(cw_config)
+
+# OpenAI calls from this process share the rate limits (if configured)
+configure_admission(cw_config)
+configure_openai_clients(cw_config)
+
+# per-invocation stage timings & counters are emitted as EMF metrics (if configured)
+configure_tracing(cw_config)
+
 def lambda_handler(event, context):
+  with traced_invocation('LEMChat', context) as trace:
+    response = handle(event, context)
+    if trace is not None: trace.set_property('statusCode', response['statusCode'])
+    return response
+
+
+def handle(event, context):
   '''
   INVARIENTS:
   elam_tl(aw) <= what ddb stores as: context_window_meta["elam_aw_mtl"].
@@ -43,39 +67,180 @@ def lambda_handler(event, context):
       'body': json.dumps(f'Error in request body: {str(e)}')
     }
 
-  # creates the user message from only text content
-  um = message_from_content(um_content, api_key, uid, iid, tokenizer)
+  with span('validate_inputs'):
+    # creates the user message from only text content (tokenized once it has passed validation)
+    um = message_from_content(um_content, api_key, uid, iid, tokenizer, tokenize=False)
+
+    # validates inputs
+    input_validation_response = validate_inputs(um, force_reflect, cw_config, tokenizer)
+    if input_validation_response["statusCode"] != 200: return input_validation_response["response"]
 
-  # validates inputs
-  input_validation_response = validate_inputs(um, force_reflect, cw_config)
-  if input_validation_response["statusCode"] != 200: return input_validation_response["response"]
+    # exact token lengths are stored with the message (served from the cache if the check above encoded the um)
+    um = tokenize_message(um, tokenizer)
 
   # get context window metadata 
-  cwm_response = get_context_window_meta(api_key, uid, iid, cw_config)
+  with span('get_context_window_meta'):
+    cwm_response = get_context_window_meta(api_key, uid, iid, cw_config)
+
+  # checks idempotency locks: if locked, returns (or queues the message), else locks for the remainder of communication
+  with span('idempotency_lock'):
+    idempotency_response = idempotency_lock(cwm_response)
+  turn = {"um": um, "force_reflect": force_reflect, "connectionId": connectionId}
+
+  mailbox = get_mailbox(cw_config)
+  queued_response = None
+
+  if idempotency_response["statusCode"] != 200:
+    if mailbox is None: return idempotency_response["response"]
+
+    with span('enqueue_turn'):
+      queued_response, cwm_response, turn = enqueue_turn(mailbox, turn, api_key, uid, iid)
+    if queued_response is not None: return queued_response
+
+  elif mailbox is not None and mailbox.depth((api_key, uid, iid)) > 0:
+    # earlier messages are still queued (their holder stopped draining): keep arrival order
+    with span('enqueue_turn'):
+      queued_response, turn = take_turn_in_order(mailbox, turn, api_key, uid, iid)
+
+  synchronize_response, _ = run_turn(cwm_response, turn)
+  if synchronize_response['statusCode'] != 200: return synchronize_response
 
-  # checks idempotency locks: if locked, returns, else locks for the remainder of communication
-  idempotency_response = idempotency_lock(cwm_response)
-  if idempotency_response["statusCode"] != 200: return idempotency_response["response"]
+  # process any messages that were queued for this thread while it was locked
+  with span('drain_mailbox'):
+    drain_mailbox(api_key, uid, iid, context)
+  if queued_response is not None: return queued_response
+
+  return {
+    'statusCode': 200,
+    'body': json.dumps('Communication Instance completed successfully. Data unlocked.')
+  }
+
+
+def run_turn(cwm_response, turn):
+  '''
+  Runs one communication instance for a thread whose idempotency lock this invocation holds. Unlocks it when done.
+  turn = {"um": user message, "force_reflect": bool, "connectionId": websocket connection to stream the reply to}
+  Returns (synchronize_ddb response, analysis response). If the turn couldn't be recorded (409: the lease ran out and
+  another invocation took the lock, or 500) it isn't analyzed, and the analysis response is None.
+  '''
+  um = turn["um"]
 
   # uses cw meta to get all context: UDS, analysis & chat windows.
-  cw_response = get_context_window(cwm_response)
+  with span('get_context_window'):
+    cw_response = get_context_window(cwm_response)
 
   # if necessary, validates all context window data & meta-data
-  cw_response, cwm_response = validate_context_window(cw_response, cwm_response, tokenizer)
+  with span('validate_context_window'):
+    cw_response, cwm_response = validate_context_window(cw_response, cwm_response, tokenizer)
   
+  # a force_reflect analysis runs alongside the reply (if "speculative_reflect" is set)
+  speculation = start_speculative_reflect(cw_response, cwm_response, cw_config, um, turn["force_reflect"])
+
   # synthesizes all context into an intelligence response, streams to the user
-  im = synthesize_response(cw_response, cw_config, um, tokenizer, connectionId, conn)
+  with span('synthesize_response'):
+    im = synthesize_response(cw_response, cw_config, um, tokenizer, turn["connectionId"], conn)
 
   # updates ch_meta, ch & aw window, returns anything needed for analysis
-  analysis_input, context_window_meta = update_context_window(cwm_response, cw_response, cw_config, um, im, force_reflect)
+  with span('update_context_window'):
+    analysis_input, context_window_meta = update_context_window(cwm_response, cw_response, cw_config, um, im, turn["force_reflect"])
 
   # synchronizes ddb state & unlocks the data for future manipulation.  Unlocks idempotency lock.
-  synchronize_ddb(context_window_meta, um, im)
+  with span('synchronize_ddb'):
+    synchronize_response = synchronize_ddb(context_window_meta, um, im, cw_response)
+  if synchronize_response['statusCode'] != 200:
+    if speculation is not None: speculation.cancel()
+    return (synchronize_response, None)
 
   # syncronously if force_analyze = true, asyncronously if prompted by analysis-window.
-  analysis_response = analyze(analysis_input)
+  with span('analyze'):
+    analysis_response = analyze(analysis_input, speculation)
+  return (synchronize_response, analysis_response)
 
-  return {
-    'statusCode': 200,
-    'body': json.dumps('Communication Instance completed successfully. Data unlocked.')
+
+def enqueue_turn(mailbox, turn, api_key, uid, iid):
+  '''
+  Queues a turn for a locked thread. Returns (response, None, None) if the turn was queued (202) or the mailbox is full
+  (429). If the lock holder finished in the meantime, this invocation takes the lock over instead and returns
+  (None, cwm_response, turn) with the oldest queued turn, which it must run.
+  '''
+  key = (api_key, uid, iid)
+
+  mailbox_response = mailbox.enqueue(key, turn)
+  if not mailbox_response['accepted']:
+    return ({
+      'statusCode': 429,
+      'body': json.dumps(f'Process already running for this user and {mailbox_response["depth"]} messages are queued, please retry later.')
+    }, None, None)
+
+  queued_response = {
+    'statusCode': 202,
+    'body': json.dumps(f'Process already running for this user, message queued (position {mailbox_response["position"]}).')
   }
+
+  # the holder checks the mailbox after it unlocks. If it unlocked before our enqueue landed, nobody would drain it: retry the lock.
+  # A stale (cached, snapshot or eventually consistent) cwm could still show the lock held, so the lock write is always tried
+  cwm_response = get_context_window_meta(api_key, uid, iid, cw_config, consistent_read=True)
+  if idempotency_lock(cwm_response, always_write=True)["statusCode"] != 200: return (queued_response, None, None)
+
+  # we hold the lock now: messages are processed oldest first, which may not be ours
+  turn = dequeue_turn(mailbox, key)
+  if turn is None:
+    release_idempotency_lock(cwm_response)
+    return (queued_response, None, None)
+
+  return (None, cwm_response, turn)
+
+
+def take_turn_in_order(mailbox, turn, api_key, uid, iid):
+  '''
+  Called holding the lock while the mailbox is not empty: queues turn behind the waiting ones and returns
+  (response, oldest queued turn), which the caller runs instead. response is None, or 429 if the mailbox was full and
+  turn was dropped (the queued turns still run, so a full mailbox can't stall the thread).
+  '''
+  key = (api_key, uid, iid)
+
+  response = None
+  mailbox_response = mailbox.enqueue(key, turn)
+  if not mailbox_response['accepted']:
+    response = {
+      'statusCode': 429,
+      'body': json.dumps(f'{mailbox_response["depth"]} messages are already queued for this user, please retry later.')
+    }
+
+  # None only if another invocation emptied the mailbox without the lock, which doesn't happen; run ours then
+  queued_turn = dequeue_turn(mailbox, key)
+  return (response, queued_turn if queued_turn is not None else turn)
+
+
+def dequeue_turn(mailbox, key):
+  turn = mailbox.dequeue(key)
+
+  # re-stamp the user message so it sorts after the reply to the turn it was queued behind
+  if turn is not None: turn["um"]["sortk"] = get_sortk_timestamp()
+  return turn
+
+
+def drain_mailbox(api_key, uid, iid, context=None, min_remaining_ms=60000):
+  '''
+  Runs the thread's queued turns in arrival order, re-taking the lock for each one. Stops when the mailbox is empty,
+  when another invocation holds the lock (it drains the rest after its own turn), when a turn couldn't be recorded or
+  when the Lambda is about to time out.
+  '''
+  mailbox = get_mailbox(cw_config)
+  if mailbox is None: return
+  key = (api_key, uid, iid)
+
+  while mailbox.depth(key) > 0:
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis') and context.get_remaining_time_in_millis() < min_remaining_ms: return
+
+    # we just released the lock ourselves: a cached, snapshot or eventually consistent cwm would still show it held
+    cwm_response = get_context_window_meta(api_key, uid, iid, cw_config, consistent_read=True)
+    if idempotency_lock(cwm_response, always_write=True)["statusCode"] != 200: return
+
+    turn = dequeue_turn(mailbox, key)
+    if turn is None:
+      release_idempotency_lock(cwm_response)
+      return
+
+    synchronize_response, _ = run_turn(cwm_response, turn)
+    if synchronize_response['statusCode'] != 200: return
@@ -0,0 +1,162 @@
+'''
+Async variant of LEMChat.lambda_handler. Runs the same stages with the same responses, but overlaps the independent
+ddb calls: the latest-UDS read runs alongside the cwm read, and the idempotency lock write alongside the message history
+read. Per-stage timings of the last invocation are kept in last_stage_timings.
+'''
+
+import asyncio
+import copy
+import simplejson as json
+from concurrent.futures import ThreadPoolExecutor
+from LEMChatUtilities import *
+from LEMChat import tokenizer, cw_config, conn, enqueue_turn, take_turn_in_order, drain_mailbox
+from AuraELAM.OpenAIELAM import analyze, start_speculative_reflect
+from AuraELKs.OpenAIELKs import synthesize_response
+from StageTimer import StageTimer
+from Tracing import traced_invocation
+from Mailbox import get_mailbox
+
+# { 'total_ms': ..., 'stages': { stage: { 'start_ms', 'duration_ms' } } } of the last invocation
+last_stage_timings = None
+
+# print the stage timings of every invocation as a JSON line
+log_stage_timings = False
+
+# the stages that wait on the LLM (the reply, a synchronous analysis, the queued turns) run here, so they can't occupy
+# ddb_executor's workers while other invocations' ddb calls queue behind them
+llm_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='llm')
+
+
+async def lambda_handler_async(event, context):
+  '''
+  Same contract and INVARIENTS as LEMChat.lambda_handler.
+  '''
+  global last_stage_timings
+
+  with traced_invocation('LEMChatAsync', context) as trace:
+    # a traced invocation's stages are timed by its trace
+    timer = trace or StageTimer()
+
+    try:
+      response = await handle(event, context, timer)
+      if trace is not None: trace.set_property('statusCode', response['statusCode'])
+      return response
+
+    finally:
+      last_stage_timings = timer.report()
+      if log_stage_timings: print(json.dumps({'stage_timings': last_stage_timings}))
+
+
+async def handle(event, context, timer):
+  # Get data from request
+  connectionId = event["requestContext"]["connectionId"]
+
+  # Load the user query
+  body = json.loads(event["body"])
+
+  try:
+    api_key = str(body["sub"])
+    uid = str(body["uid"]) # uid and iid uniquely identify a communication thread for a given api key
+    iid = str(body["iid"])
+    um_content = str(body["user_message"])
+    force_reflect = bool(body["force_reflect"])
+  except Exception as e:
+    return {
+      'statusCode': 400,
+      'body': json.dumps(f'Error in request body: {str(e)}')
+    }
+
+  with timer.stage('validate_inputs'):
+    # creates the user message from only text content (tokenized once it has passed validation)
+    um = message_from_content(um_content, api_key, uid, iid, tokenizer, tokenize=False)
+
+    # validates inputs
+    input_validation_response = validate_inputs(um, force_reflect, cw_config, tokenizer)
+    if input_validation_response["statusCode"] != 200: return input_validation_response["response"]
+
+    # exact token lengths are stored with the message (served from the cache if the check above encoded the um)
+    um = tokenize_message(um, tokenizer)
+
+  # the latest UDS doesn't depend on the cwm: prefetch it alongside the cwm read (a cached context is checked against
+  # it too), unless it will come from the context snapshot
+  uds_partition_key = api_key + uid + iid + 'UDS'
+  prefetch_uds = not cw_config.get("context_snapshot", False)
+
+  reads = [timer.timed('get_context_window_meta', run_blocking(get_context_window_meta, api_key, uid, iid, cw_config))]
+  if prefetch_uds: reads.append(timer.timed('prefetch_uds', full_limit_query_async(uds_partition_key, False)))
+  read_results = await asyncio.gather(*reads)
+
+  cwm_response = read_results[0]
+  latest_UDS_items = read_results[1] if prefetch_uds else None
+
+  # checks idempotency locks: if locked, returns, else locks for the remainder of communication.
+  # the lock write overlaps with the context reads, whose results are dropped if the thread is already locked. The
+  # lock updates the cwm in place, so the reads get their own copy of it
+  read_cwm_response = dict(cwm_response, cwm=copy.deepcopy(cwm_response['cwm']))
+  idempotency_response, cw_response = await asyncio.gather(
+    timer.timed('idempotency_lock', run_blocking(idempotency_lock, cwm_response)),
+    timer.timed('get_context_window', run_blocking(get_context_window, read_cwm_response, latest_UDS_items))
+  )
+  mailbox = get_mailbox(cw_config)
+  queued_response = None
+  turn = {"um": um, "force_reflect": force_reflect, "connectionId": connectionId}
+
+  if idempotency_response["statusCode"] == 200 and cw_response['cw_version'] != int(cwm_response['cwm'].get('cw_version', 0)):
+    # the lock re-read the cwm item (the context snapshot's copy lagged it): the context read alongside is outdated
+    cw_response = await timer.timed('get_context_window', run_blocking(get_context_window, cwm_response))
+
+  if idempotency_response["statusCode"] != 200:
+    if mailbox is None: return idempotency_response["response"]
+
+    # queued (or taken over from a holder that just finished, running the oldest queued turn sequentially)
+    queued_response, cwm_response, turn = await timer.timed('enqueue_turn', run_blocking(enqueue_turn, mailbox, turn, api_key, uid, iid))
+    if queued_response is not None: return queued_response
+    cw_response = await timer.timed('get_context_window', run_blocking(get_context_window, cwm_response))
+
+  elif mailbox is not None and await run_blocking(mailbox.depth, (api_key, uid, iid)) > 0:
+    # earlier messages are still queued: keep arrival order (the context read above is still current)
+    queued_response, turn = await timer.timed('enqueue_turn', run_blocking(take_turn_in_order, mailbox, turn, api_key, uid, iid))
+
+  um, force_reflect, connectionId = turn["um"], turn["force_reflect"], turn["connectionId"]
+
+  # if necessary, validates all context window data & meta-data
+  with timer.stage('validate_context_window'):
+    cw_response, cwm_response = validate_context_window(cw_response, cwm_response, tokenizer)
+
+  # a force_reflect analysis runs alongside the reply (if "speculative_reflect" is set)
+  speculation = start_speculative_reflect(cw_response, cwm_response, cw_config, um, force_reflect)
+
+  # synthesizes all context into an intelligence response, streams to the user
+  im = await timer.timed('synthesize_response', run_in_executor(llm_executor, synthesize_response, cw_response, cw_config, um, tokenizer, connectionId, conn))
+
+  # updates ch_meta, ch & aw window, returns anything needed for analysis
+  with timer.stage('update_context_window'):
+    analysis_input, context_window_meta = update_context_window(cwm_response, cw_response, cw_config, um, im, force_reflect)
+
+  # synchronizes ddb state & unlocks the data for future manipulation.  Unlocks idempotency lock.
+  synchronize_response = await timer.timed('synchronize_ddb', run_blocking(synchronize_ddb, context_window_meta, um, im, cw_response))
+
+  # not recorded (409: the lease ran out and another invocation took the lock, or 500): the turn isn't analyzed
+  if synchronize_response['statusCode'] != 200:
+    if speculation is not None: speculation.cancel()
+    return synchronize_response
+
+  # syncronously if force_analyze = true, asyncronously if prompted by analysis-window.
+  # (runs after synchronize_ddb: async analyses read the messages it just wrote)
+  analysis_response = await timer.timed('analyze', run_in_executor(llm_executor, analyze, analysis_input, speculation))
+
+  # process any messages that were queued for this thread while it was locked
+  await timer.timed('drain_mailbox', run_in_executor(llm_executor, drain_mailbox, api_key, uid, iid, context))
+  if queued_response is not None: return queued_response
+
+  return {
+    'statusCode': 200,
+    'body': json.dumps('Communication Instance completed successfully. Data unlocked.')
+  }
+
+
+def lambda_handler(event, context):
+  '''
+  Synchronous Lambda entry point for the async handler.
+  '''
+  return asyncio.run(lambda_handler_async(event, context))
@@ -2,25 +2,50 @@
 Utilities for the LEMChat function
 '''
 
+import time
 import simplejson as json
 from DynamoDBUtilities import *
+from ContextWindow import ContextWindow
+from ContextCache import context_cache
+from ContextSnapshot import get_context_snapshot, read_context_snapshot, put_context_snapshot
+from Tracing import count
 
-def message_from_content(content, api_key, uid, iid, tokenizer):
+# async analyses carry their window & UDS inline unless the payload would exceed this (async Lambda invocations are
+# capped at 256KB); above it the ELAM job falls back to querying them
+ANALYSIS_PAYLOAD_MAX_BYTES = 200000
+
+# a new thread's cwm is written under a fixed sortk, so concurrent first messages race for the same item (and the
+# lock's attribute_not_exists(partitionk) lets only one of them through). Sorts before the timestamp sortk of a cwm
+# written by an earlier version, which the thread keeps.
+CWM_SORTK = '0'
+
+def message_from_content(content, api_key, uid, iid, tokenizer, tokenize=True):
   '''
   Creates and returns a full communication message from just text content.
+  With tokenize=False the token lengths are left for tokenize_message, so validate_inputs can reject an
+  oversized message from the tokenizer's length estimate without encoding it.
   '''
-
-  um_tl = tokenizer.calculate_tokenized_length(content)
   um = {"content": content, "role": "user", "uid": uid, "iid": iid}
-  um["token_lengths"] = um_tl
+  um["token_lengths"] = tokenizer.calculate_tokenized_length(content) if tokenize else None
   um["sortk"] = get_sortk_timestamp()
   um["partitionk"] = api_key + uid + iid + 'messages'
   return um
 
 
-def validate_inputs(um, force_reflect, cw_config):
+def tokenize_message(message, tokenizer):
+  '''
+  Sets the exact token lengths of a message, if not already set. Lengths computed during validation are served from the tokenizer cache.
+  '''
+  if message["token_lengths"] is None:
+    message["token_lengths"] = tokenizer.calculate_tokenized_length(message["content"])
+  return message
+
+
+def validate_inputs(um, force_reflect, cw_config, tokenizer=None):
   '''
   Validates invariants about the inputs and returns a response accordingly. 
+  If um has not been tokenized yet, its token limits are checked with tokenizer.within_tokenized_length instead (exact
+  only near a limit).
   '''
   input_validation_response = {}
 
@@ -36,8 +61,14 @@ def validate_inputs(um, force_reflect, cw_config):
     return input_validation_response
 
   # assert the um is the appropriate token length 
-  if (um["token_lengths"][cw_config["elks_token_type"]] > cw_config["elks_um_mtl"]) or \
-    (um["token_lengths"][cw_config["elam_token_type"]] > cw_config["elam_um_mtl"]):
+  if um["token_lengths"] is not None:
+    um_within_mtl = (um["token_lengths"][cw_config["elks_token_type"]] <= cw_config["elks_um_mtl"]) and \
+      (um["token_lengths"][cw_config["elam_token_type"]] <= cw_config["elam_um_mtl"])
+  else:
+    um_within_mtl = tokenizer.within_tokenized_length(um["content"], cw_config["elks_token_type"], cw_config["elks_um_mtl"]) and \
+      tokenizer.within_tokenized_length(um["content"], cw_config["elam_token_type"], cw_config["elam_um_mtl"])
+
+  if not um_within_mtl:
     input_validation_response["statusCode"] = 400
     input_validation_response["response"] = {
       'statusCode': 400,
@@ -62,24 +93,36 @@ def validate_inputs(um, force_reflect, cw_config):
   return input_validation_response
 
 
-def get_context_window_meta(api_key, uid, iid, cw_config):
+def get_context_window_meta(api_key, uid, iid, cw_config, consistent_read=False):
   '''
   Returns the communication meta information, or a blank template message if none exists.
   This object contains all meta-information about the context window sizes and current state,
   which is needed for AuraLEM to run. It does not contain the message data for aw & ch itself.
+  consistent_read: read the cwm item itself with a strongly consistent read (bypassing the context cache & snapshot).
   '''
   cwm_response = {}
 
   # get the context window meta information
   context_window_meta_partitionk = api_key + uid + iid + 'ch_context_window_meta'
-  context_window_meta_items = full_limit_query(context_window_meta_partitionk)
+
+  # in trust mode a cwm this container wrote moments ago is served without a ddb read
+  cached_cwm = None if consistent_read else context_cache.get_cwm((api_key, uid, iid))
+
+  # with the context snapshot, its copy of the cwm is read along with the turn's context (one GetItem for both)
+  snapshot = None
+  if cached_cwm is None and not consistent_read and cw_config.get("context_snapshot", False): snapshot = get_context_snapshot(api_key, uid, iid)
+  cwm_from_snapshot = snapshot is not None and 'cwm' in snapshot
+
+  if cached_cwm is not None: context_window_meta_items = [cached_cwm]
+  elif cwm_from_snapshot: context_window_meta_items = [snapshot['cwm']]
+  else: context_window_meta_items = full_limit_query(context_window_meta_partitionk, consistent_read=consistent_read)
 
   context_window_meta = {}
   if not context_window_meta_items:       
     # if there is no item / cmwi was empty, this is the first time the user is chatting with this intelligence
     context_window_meta = {
       'partitionk': context_window_meta_partitionk,
-      'sortk': get_sortk_timestamp(),
+      'sortk': CWM_SORTK,
       'idempotency_lock': False,
       'elam_aw_token_length': 0,
       'elam_token_type': cw_config["elam_token_type"],
@@ -88,46 +131,85 @@ def get_context_window_meta(api_key, uid, iid, cw_config):
       'elks_ch_token_length': 0,
       'elks_token_type': cw_config["elks_token_type"],
       'ch_message_count': 0, # the amount of messages to retrieve (starting from more recent) for the chat history 
-      'elks_ch_mtl': cw_config["elks_ch_mtl"]
+      'elks_ch_mtl': cw_config["elks_ch_mtl"],
+      'cw_version': 0 # incremented by every synchronize_ddb, versions the context cache
     }
 
   else:
     # context_window_meta_items was not empty: set it to the latest context window meta object
     context_window_meta = context_window_meta_items[0]
 
-  context_window_meta = json.loads(json.dumps(context_window_meta))
-
-  cwm_response['cwm'] = context_window_meta
   cwm_response['uds_partition_key'] = api_key + uid + iid + 'UDS'
   cwm_response['message_history_partitionk'] = api_key + uid + iid + "messages"
   cwm_response['current_elam_aw_mtl'] = cw_config["elam_aw_mtl"]
   cwm_response['current_elks_ch_mtl'] = cw_config["elks_ch_mtl"]
   cwm_response['current_elam_token_type'] = cw_config["elam_token_type"]
   cwm_response['current_elks_token_type'] = cw_config["elks_token_type"]
-
-  # past batch size to use for analysis window
-  cwm_response['prev_elam_aw_mtl'] = context_window_meta["elam_aw_mtl"]
-  cwm_response['aw_overflow_reflect'] = False
-
-  cwm_response['elks_token_type_updated'] = context_window_meta["elks_token_type"] != cw_config["elks_token_type"]
-  cwm_response['elam_token_type_updated'] = context_window_meta["elam_token_type"] != cw_config["elam_token_type"]
+  cwm_response['context_snapshot'] = cw_config.get("context_snapshot", False) # read & write the single-item context snapshot
+  cwm_response['lease_seconds'] = cw_config.get("idempotency_lease_seconds", 900) # how long the idempotency lock is held at most
+  cwm_response['snapshot'] = snapshot # reused by get_context_window
+  cwm_response['cwm_from_snapshot'] = cwm_from_snapshot
 
   # add the api_key, uid, and iid to cwm_response
   cwm_response['api_key'] = api_key
   cwm_response['uid'] = uid
   cwm_response['iid'] = iid
 
+  set_context_window_meta(cwm_response, context_window_meta)
   return cwm_response
 
 
-def idempotency_lock(cwm_response):
+def set_context_window_meta(cwm_response, context_window_meta):
+  '''
+  Sets the cwm of cwm_response, and the fields derived from it.
+  '''
+  context_window_meta = json.loads(json.dumps(context_window_meta))
+  cwm_response['cwm'] = context_window_meta
+
+  # past batch size to use for analysis window
+  cwm_response['prev_elam_aw_mtl'] = context_window_meta["elam_aw_mtl"]
+  cwm_response['aw_overflow_reflect'] = False
+
+  cwm_response['elks_token_type_updated'] = context_window_meta["elks_token_type"] != cwm_response['current_elks_token_type']
+  cwm_response['elam_token_type_updated'] = context_window_meta["elam_token_type"] != cwm_response['current_elam_token_type']
+
+
+def idempotency_lock(cwm_response, always_write=False):
   '''
   Sets an idempotency lock for the AuraLEM data parameterized by (uid & iid)
+  The lock is a lease: it is taken with one conditional write of the cwm, which only succeeds if the stored cwm is
+  unlocked (or its lease has expired) and still at the cw_version this invocation read. Each acquisition bumps
+  lock_version, which synchronize_ddb checks when it unlocks. A Lambda that dies mid-turn leaves a lock that simply
+  expires after lease_seconds.
+  always_write: attempt the conditional write even if the cwm read shows the lock held.
   '''
   idempotency_response = {}
-
-  # if the lock is already active
-  if cwm_response['cwm']['idempotency_lock']:
+  context_window_meta = cwm_response['cwm']
+  now = int(time.time())
+
+  # if the lock is already active (and its lease has not run out), don't bother with the write
+  # (a lock written before leases existed has no lock_expires_at: it counts as expired, as in the condition below)
+  lock_held = not always_write and context_window_meta['idempotency_lock'] and (now <= int(context_window_meta.get('lock_expires_at', 0)))
+
+  if not lock_held:
+    context_window_meta['idempotency_lock'] = True
+    context_window_meta['lock_expires_at'] = now + cwm_response['lease_seconds']
+    context_window_meta['lock_version'] = int(context_window_meta.get('lock_version', 0)) + 1
+
+    # lock required data in dynamodb. Locks written before leases existed (no lock_expires_at) count as expired.
+    lock_held = not put_item_conditional_ddb(context_window_meta,
+      "attribute_not_exists(partitionk) OR ((attribute_not_exists(cw_version) OR cw_version = :v) AND " \
+      "(idempotency_lock = :f OR attribute_not_exists(lock_expires_at) OR lock_expires_at < :now))",
+      {':v': int(context_window_meta.get('cw_version', 0)), ':f': False, ':now': now})
+
+  if lock_held and cwm_response['cwm_from_snapshot']:
+    # the snapshot's copy of the cwm lags the cwm item if a turn's snapshot update failed: retry on the item itself
+    context_window_meta_partitionk = cwm_response['api_key'] + cwm_response['uid'] + cwm_response['iid'] + 'ch_context_window_meta'
+    cwm_response['cwm_from_snapshot'] = False
+    set_context_window_meta(cwm_response, full_limit_query(context_window_meta_partitionk)[0])
+    return idempotency_lock(cwm_response)
+
+  if lock_held:
     idempotency_response["statusCode"] = 400
     idempotency_response["response"] = {
       'statusCode': 400,
@@ -135,73 +217,108 @@ def idempotency_lock(cwm_response):
     }
     return idempotency_response
 
-  # Lock for the remainder of this invocation
-  else:
-    cwm_response['cwm']['idempotency_lock'] = True
+  # Locked for the remainder of this invocation
+  idempotency_response["statusCode"] = 200
+  idempotency_response["response"] = {
+    'statusCode': 200,
+    'body': json.dumps('Idempotency check passed. Locked for rest of invokation.')
+  }
+  return idempotency_response
 
-    # lock required data in dynamodb 
-    put_item_ddb(cwm_response['cwm'])
 
-    idempotency_response["statusCode"] = 200
-    idempotency_response["response"] = {
-      'statusCode': 200,
-      'body': json.dumps('Idempotency check passed. Locked for rest of invokation.')
-    }
-    return idempotency_response
+def release_idempotency_lock(cwm_response):
+  '''
+  Releases an idempotency lock this invocation holds without recording a turn (the cwm is otherwise unchanged).
+  '''
+  context_window_meta = cwm_response['cwm']
+  context_window_meta['idempotency_lock'] = False
+
+  return put_item_conditional_ddb(context_window_meta, "idempotency_lock = :t AND lock_version = :lv",
+    {':t': True, ':lv': int(context_window_meta['lock_version'])})
 
 
-def get_context_window(cwm_response):
+def get_context_window(cwm_response, latest_UDS_items=None):
   '''
   Retrieves message data for context window (messages that will make up aw & ch, the uds, etc.) using
   the context window meta-information.
+  latest_UDS_items: result of the latest-UDS query if the caller already ran it (e.g. concurrently with the cwm read).
+  Unless the context comes from the snapshot, the latest UDS is always queried (Limit=1): a cached UDS is only used
+  while no newer one has been written.
   '''
   cw_response = {}
 
   uds_partition_key = cwm_response['uds_partition_key']
 
-  # Check if latest_UDS exists, if not create a blank one
-  latest_UDS_items = full_limit_query(uds_partition_key, False)
-  latest_UDS = latest_UDS_items[0]['uds'] if latest_UDS_items else None
-  if not latest_UDS:
-    latest_UDS = {
-      'basic_info': {
-        'name': '',
-        'current_location': '',
-        'occupation': '',
-        'sex': ''
-      },
-      'traits': [],
-      'skills': [],
-      'factual_history': [],
-      'summary': ''
-    }
-
-  cw_response['uds'] = latest_UDS
-
   # get the current chat history and analysis window
   context_window_meta = cwm_response['cwm']
+  limit = max(context_window_meta['aw_message_count'], context_window_meta['ch_message_count'])
 
-  analysis_window = []
-  chat_history = []
+  # a warm container may already hold this version of the thread's context
+  cache_key = (cwm_response['api_key'], cwm_response['uid'], cwm_response['iid'])
+  cached_context = context_cache.get_context(cache_key, context_window_meta, limit)
 
-  message_history = []
-  limit = max(context_window_meta['aw_message_count'], context_window_meta['ch_message_count'])
+  uds_sortk = ''
+  snapshot_context = None
+  if cached_context is None and cwm_response['context_snapshot']:
+    # one GetItem for the UDS & messages, if the snapshot is at the current cwm version
+    snapshot_context = read_context_snapshot(cwm_response['api_key'], cwm_response['uid'], cwm_response['iid'], context_window_meta, limit, cwm_response['snapshot'])
+
+  if cached_context is not None:
+    latest_UDS, uds_sortk, message_history = cached_context
+
+    # the cwm version doesn't cover the UDS: another container or an ELAM worker process may have written a newer one
+    if latest_UDS_items is None: latest_UDS_items = full_limit_query(uds_partition_key, False)
+    if latest_UDS_items and latest_UDS_items[0]['sortk'] > uds_sortk:
+      latest_UDS, uds_sortk = latest_UDS_items[0]['uds'], latest_UDS_items[0]['sortk']
+      context_cache.update_uds(cache_key, latest_UDS, uds_sortk)
+
+  elif snapshot_context is not None:
+    latest_UDS, uds_sortk, message_history = snapshot_context
+    context_cache.put(cache_key, context_window_meta, latest_UDS, message_history, uds_sortk)
 
-  if(limit > 0):
-    # get the current chat history and analysis window
-    message_history_partitionk = cwm_response['message_history_partitionk']
-    message_history = full_limit_query(message_history_partitionk, False, limit)
+  else:
+    # Check if latest_UDS exists, if not create a blank one
+    if latest_UDS_items is None: latest_UDS_items = full_limit_query(uds_partition_key, False)
+    latest_UDS = latest_UDS_items[0]['uds'] if latest_UDS_items else None
+    uds_sortk = latest_UDS_items[0]['sortk'] if latest_UDS_items else ''
+    if not latest_UDS:
+      latest_UDS = {
+        'basic_info': {
+          'name': '',
+          'current_location': '',
+          'occupation': '',
+          'sex': ''
+        },
+        'traits': [],
+        'skills': [],
+        'factual_history': [],
+        'summary': ''
+      }
+
+    message_history = []
+    if(limit > 0):
+      # get the current chat history and analysis window
+      message_history_partitionk = cwm_response['message_history_partitionk']
+      message_history = full_limit_query(message_history_partitionk, False, limit)
 
-    # get the current analysis window
-    analysis_window = message_history[:context_window_meta['aw_message_count']]
+    context_cache.put(cache_key, context_window_meta, latest_UDS, message_history, uds_sortk)
+
+  cw_response['uds'] = latest_UDS
 
-    # get the current chat history
-    chat_history = message_history[:context_window_meta['ch_message_count']]
+  # get the current analysis window
+  analysis_window = ContextWindow(message_history[:context_window_meta['aw_message_count']], [context_window_meta['elam_token_type']])
 
+  # get the current chat history
+  chat_history = ContextWindow(message_history[:context_window_meta['ch_message_count']], [context_window_meta['elks_token_type']])
 
   cw_response['aw'] = analysis_window
   cw_response['ch'] = chat_history
   cw_response['message_history'] = message_history
+  cw_response['cache_key'] = cache_key
+  cw_response['uds_sortk'] = uds_sortk
+  cw_response['cw_version'] = int(context_window_meta.get('cw_version', 0)) # the cwm version the context was read at
+  cw_response['api_key'] = cwm_response['api_key']
+  cw_response['context_snapshot'] = cwm_response['context_snapshot']
   return cw_response
 
 
@@ -216,22 +333,22 @@ def validate_context_window(cw_response, cwm_response, tokenizer):
 
   # if ELKS token definition has changed: update the chat metadata, and the chat window itself
   if cwm_response['elks_token_type_updated']:
-    chat_history, ch_tls = tokenizer.update_token_context(cw_response['ch'])
+    ch_messages, ch_tls = tokenizer.update_token_context(chat_history.to_list())
+    chat_history = ContextWindow(ch_messages, [cwm_response['current_elks_token_type']])
     context_window_meta['elks_ch_token_length'] = ch_tls[cwm_response['current_elks_token_type']]
     context_window_meta['elks_token_type'] = cwm_response['current_elks_token_type']
 
   # NOTE 1: chat_history and analysis_window are ordered [(lastest/newest_message), ..., (oldest_message)]
 
-  # if ch_mtl changed & chat history is now too large, remove necessary messages
-  while context_window_meta['elks_ch_token_length'] > cwm_response["current_elks_ch_mtl"]: # continue until ch window is small enough
-    current_chm_tl = chat_history[-1]['token_lengths'][cwm_response['current_elks_token_type']] # the oldest message's elk_tl
-    context_window_meta['elks_ch_token_length'] -= current_chm_tl # subtract it from the cwm total tl
-    context_window_meta['ch_message_count'] -= 1 # subtract one from the cwm chat history count
-    chat_history = chat_history[:-1] # remove the message from the chat history window
+  # if ch_mtl changed & chat history is now too large, remove the oldest messages until it fits (one bisect over the window)
+  if context_window_meta['elks_ch_token_length'] > cwm_response["current_elks_ch_mtl"]:
+    chat_history.trim_to_budget(cwm_response['current_elks_token_type'], cwm_response["current_elks_ch_mtl"])
+    chat_history.sync_meta(context_window_meta, 'ch_message_count', 'elks_ch_token_length', cwm_response['current_elks_token_type'])
   
   # if the elam token type changed, update the tokenization
   if cwm_response['elam_token_type_updated']:
-    analysis_window, aw_tls = tokenizer.update_token_context(cw_response['aw'])
+    aw_messages, aw_tls = tokenizer.update_token_context(analysis_window.to_list())
+    analysis_window = ContextWindow(aw_messages, [cwm_response['current_elam_token_type']])
     context_window_meta['elam_aw_token_length'] = aw_tls[cwm_response['current_elam_token_type']]
     context_window_meta['elam_aw_token_type'] = cwm_response['current_elam_token_type']
 
@@ -245,7 +362,7 @@ def validate_context_window(cw_response, cwm_response, tokenizer):
 
   cw_response['ch'] = chat_history
   cw_response['aw'] = analysis_window
-  cw_response['message_history'] = chat_history if (len(chat_history) > len(analysis_window)) else analysis_window
+  cw_response['message_history'] = chat_history.to_list() if (len(chat_history) > len(analysis_window)) else analysis_window.to_list()
 
   return (cw_response, cwm_response)
 
@@ -269,11 +386,9 @@ def update_context_window(cwm_response, cw_response, cw_config, um, im, force_re
 
   # if including the current umessage & imessage into the chat history will make it too large, remove necessary messages
   # NOTE: always add user message along with assistant message as as single communication pair
-  while context_window_meta['elks_ch_token_length'] + elks_um_tl + elks_im_tl > cw_config["elks_ch_mtl"]:
-    current_chm_tl = chat_history[-1]['token_lengths'][cw_config['elks_token_type']]
-    context_window_meta['elks_ch_token_length'] -= current_chm_tl
-    context_window_meta['ch_message_count'] -= 1
-    chat_history = chat_history[:-1]
+  if context_window_meta['elks_ch_token_length'] + elks_um_tl + elks_im_tl > cw_config["elks_ch_mtl"]:
+    chat_history.trim_to_budget(cw_config['elks_token_type'], cw_config["elks_ch_mtl"] - elks_um_tl - elks_im_tl)
+    chat_history.sync_meta(context_window_meta, 'ch_message_count', 'elks_ch_token_length', cw_config['elks_token_type'])
 
   # add the current umessage & imessage to the chat history
   context_window_meta['elks_ch_token_length'] += elks_um_tl + elks_im_tl
@@ -293,7 +408,8 @@ def update_context_window(cwm_response, cw_response, cw_config, um, im, force_re
       'synchronous': False,
       'limits': [len(analysis_window), 2]
     }
-    analysis_window = [im, um]
+    analysis_response['analysis_window'] = window_from_limits(analysis_response['limits'], um, im, analysis_window)
+    analysis_window = ContextWindow([im, um], [cw_config['elam_token_type']])
     context_window_meta['elam_aw_token_length'] = elam_um_tl + elam_im_tl
     context_window_meta['aw_message_count'] = 2
 
@@ -305,22 +421,23 @@ def update_context_window(cwm_response, cw_response, cw_config, um, im, force_re
       'synchronous': False,
       'limits': [len(analysis_window)+2, 2]
       }
-      analysis_window = [im, um]
+      analysis_response['analysis_window'] = window_from_limits(analysis_response['limits'], um, im, analysis_window)
+      analysis_window = ContextWindow([im, um], [cw_config['elam_token_type']])
       context_window_meta['elam_aw_token_length'] = elam_um_tl + elam_im_tl
       context_window_meta['aw_message_count'] = 2
 
     # if no analysis was naturally queued but is user asked for it to be forced, queue it
     elif (force_reflect):
-      analysis_window.insert(0, um)
-      analysis_window.insert(0, im)
+      analysis_window.push_newest(um)
+      analysis_window.push_newest(im)
 
       analysis_response = {
         'analyze': True,
         'synchronous': True,
         'limits': [len(analysis_window), 0],
-        'analysis_window': analysis_window,
+        'analysis_window': analysis_window.to_list(),
       }
-      analysis_window = []
+      analysis_window = ContextWindow(token_types=[cw_config['elam_token_type']])
       context_window_meta['elam_aw_token_length'] = 0
       context_window_meta['aw_message_count'] = 0
 
@@ -331,8 +448,8 @@ def update_context_window(cwm_response, cw_response, cw_config, um, im, force_re
         'synchronous': None,
         'limits': None
       }
-      analysis_window.insert(0, um)
-      analysis_window.insert(0, im)
+      analysis_window.push_newest(um)
+      analysis_window.push_newest(im)
       context_window_meta['elam_aw_token_length'] += elam_um_tl + elam_im_tl
       context_window_meta['aw_message_count'] += 2
 
@@ -340,19 +457,70 @@ def update_context_window(cwm_response, cw_response, cw_config, um, im, force_re
   analysis_response['uid'] = cwm_response['uid']
   analysis_response['iid'] = cwm_response['iid']
   analysis_response['elam_response_mtl'] = cw_config["elam_response_mtl"]
+  analysis_response['context_snapshot'] = cwm_response['context_snapshot']
+
+  if analysis_response['analyze'] and analysis_response['synchronous']:
+    # the UDS this turn was synthesized with (read at its start, under the lock), so the analysis doesn't re-query it.
+    # An async job queries the latest UDS itself: another analysis may have written a newer one by the time it runs
+    analysis_response['uds'] = cw_response['uds']
+
+  elif analysis_response['analyze'] and len(json.dumps(analysis_response)) > ANALYSIS_PAYLOAD_MAX_BYTES:
+    # too large to invoke with: the job queries the window (by limits) instead
+    del analysis_response['analysis_window']
 
   return analysis_response, context_window_meta
 
 
-def synchronize_ddb(context_window_meta, um, im):
+def window_from_limits(limits, um, im, analysis_window):
+  '''
+  Returns the messages an async analysis with these limits would query once um & im are written:
+  message history [(im), (um), (analysis window, newest to oldest), ...][limits[1]:limits[0]].
+  '''
+  return ([im, um] + analysis_window.to_list())[limits[1]:limits[0]]
+
+
+def synchronize_ddb(context_window_meta, um, im, cw_response=None):
   '''
   Synchronizes the dynamodb table with the current state of the context window, and adds the new um & im to message history.
+  If cw_response is given, the new state is also written through to this container's context cache.
+  Returns statusCode 200 if the turn was recorded, 409 if this invocation no longer held the lock (nothing written), 500 otherwise.
   '''
   try:
-    context_window_meta['idempotency_lock'] = False
+    # the lock_version this invocation acquired: the unlock only goes through if we still hold that lease
+    lock_version = int(context_window_meta.get('lock_version', 0))
 
-    items_to_put = [context_window_meta, um, im]
-    put_items_ddb(items_to_put)
+    context_window_meta['idempotency_lock'] = False
+    context_window_meta['cw_version'] = int(context_window_meta.get('cw_version', 0)) + 1
+
+    # unlock & add the messages in one transaction: either the whole turn is recorded or none of it is
+    put_response = transact_put_items_ddb([
+      {
+        'item': context_window_meta,
+        'condition': "idempotency_lock = :t AND lock_version = :lv",
+        'values': {':t': True, ':lv': lock_version}
+      },
+      {'item': um},
+      {'item': im}
+    ])
+
+    if put_response['statusCode'] != 200:
+      if cw_response is not None: context_cache.invalidate(cw_response['cache_key'])
+      return put_response
+
+    if cw_response is not None:
+      # the next turn needs at most the newest max(aw, ch) messages, which are the new pair plus the current history
+      limit = max(context_window_meta['aw_message_count'], context_window_meta['ch_message_count'])
+      message_history = ([im, um] + list(cw_response['message_history']))[:limit]
+      context_cache.put(cw_response['cache_key'], context_window_meta, cw_response['uds'], message_history, cw_response['uds_sortk'])
+
+      if cw_response['context_snapshot']:
+        # best effort: the turn is recorded, and a snapshot left behind only misses on the next turn's cw_version
+        api_key, uid, iid = cw_response['cache_key']
+        try:
+          put_context_snapshot(api_key, uid, iid, context_window_meta, cw_response['uds'], cw_response['uds_sortk'], message_history)
+        except Exception as e:
+          count('context_snapshot_failures')
+          print(f"Context snapshot write failed: {str(e)}")
 
     return {
       'statusCode': 200,
@@ -360,5 +528,7 @@ def synchronize_ddb(context_window_meta, um, im):
     }
 
   except Exception as e:
-    return f"An error occurred: {str(e)}"
-
+    return {
+      'statusCode': 500,
+      'body': json.dumps(f"An error occurred: {str(e)}")
+    }
@@ -1,8 +1,12 @@
 import simplejson as json
-from openai import OpenAI
-import os
+import threading
+from AuraOpenAI.ClientRegistry import get_openai_client
 from DynamoDBUtilities import *
 from AuraELAM.UDSUtilities import validate_response
+from AuraOpenAI.RateLimiter import admission, estimate_request_tokens, PRIORITY_ELAM_ASYNC
+from ContextCache import context_cache
+from ContextSnapshot import update_context_snapshot_uds
+from Tracing import count
 
 def analyze_async(event, context):
   # Get the chat history from step function input
@@ -14,22 +18,28 @@ def analyze_async(event, context):
 
   print("\n\nRunning analyze_async with batch: ", batch, "\n\n")
 
-  message_history_partitionk = api_key + uid + iid + 'messages'
-  message_history = full_limit_query(message_history_partitionk, False, int(batch[0]))
+  if "analysis_window" in event:
+    # the window was passed inline by update_context_window
+    message_history = event["analysis_window"]
 
-  # Remove any elements beyond the batch[1]th element in the array message_history
-  message_history = message_history[batch[1]:]
+  else:
+    message_history_partitionk = api_key + uid + iid + 'messages'
+    message_history = full_limit_query(message_history_partitionk, False, int(batch[0]))
+
+    # Remove any elements beyond the batch[1]th element in the array message_history
+    message_history = message_history[batch[1]:]
   print("message history: ", message_history, "\n\n")
 
-  # Get API key from environment
-  openai_key = os.environ['openai_key']
-  openai_client = OpenAI(api_key=openai_key)
+  # shared client: reuses this process's connections to the API
+  openai_client = get_openai_client()
   
   # Specify the AI model
   model = "gpt-4-1106-preview"
   
   # create the UDS parition key
   UDS_partition_key = api_key + uid + iid + 'UDS'
+
+  # always the latest UDS: another analysis (e.g. from another container) may have written a newer one since the turn
   latest_UDS = full_limit_query(UDS_partition_key, False)
 
   # Check if latest_UDS exists, if not create a blank one
@@ -109,11 +119,14 @@ def analyze_async(event, context):
     }
   ]
   
+  reserved_tokens = estimate_request_tokens(messages, elam_response_mtl)
+  admission.acquire(model, api_key, reserved_tokens, PRIORITY_ELAM_ASYNC)
   response = openai_client.chat.completions.create(model=model,
   messages=messages,
   stop=None,
   response_format={"type": "json_object"},
   max_tokens=elam_response_mtl)
+  admission.settle(model, api_key, reserved_tokens, getattr(getattr(response, 'usage', None), 'total_tokens', None))
 
 
   validated, modified_UDS = validate_response(response)
@@ -121,10 +134,11 @@ def analyze_async(event, context):
   # If validation fails try again once more with new message
   if not validated:
     print("VALIDATION FAILED. NEEDED RETRY.")
+    count('elam_validation_retries')
 
     messages.append({
       "role": "assistant",
-      "content": response
+      "content": response.choices[0].message.content
     })
 
     messages.append({
@@ -132,16 +146,20 @@ def analyze_async(event, context):
       "content": "This response is not a valid UDS, incorrect syntax. Please try one more time. It is EXTREMELY IMPORTANT that you get the syntax correct as per the system message."
     })
       
+    reserved_tokens = estimate_request_tokens(messages, elam_response_mtl)
+    admission.acquire(model, api_key, reserved_tokens, PRIORITY_ELAM_ASYNC)
     response = openai_client.chat.completions.create(model=model,
     messages=messages,
     stop=None,
     response_format={"type": "json_object"},
     max_tokens=elam_response_mtl)
+    admission.settle(model, api_key, reserved_tokens, getattr(getattr(response, 'usage', None), 'total_tokens', None))
 
     validated, modified_UDS = validate_response(response)
     
   # If validation fails again, return error
   if not validated:
+    count('elam_validation_failures')
     return {
       'statusCode': 500,
       'body': json.dumps('Failed to generate UDS.')
@@ -161,9 +179,15 @@ def analyze_async(event, context):
   uds_put_response = put_item_ddb(item)
 
   if uds_put_response['statusCode'] == 200:
+    # keep this container's cached context on the new UDS
+    context_cache.update_uds((api_key, uid, iid), modified_UDS, item['sortk'])
+    if event.get("context_snapshot"): update_context_snapshot_uds(api_key, uid, iid, modified_UDS, item['sortk'])
+
     return {
       'statusCode': 200,
-      'body': json.dumps('Successfully updated UDS.')
+      'body': json.dumps('Successfully updated UDS.'),
+      'uds': modified_UDS, # lets an executor update the chat process's context cache (ELAMExecutor.cache_job_result)
+      'uds_sortk': item['sortk']
     }
   
   else:
@@ -187,9 +211,44 @@ class FakeConn:
     else:
       print("[COMPLETE]")
 
-class FakeLambdaClient:
+class NullConn:
+  '''
+  Connection object that drops the streamed frames (counting them), for benchmarks & load tests.
+  '''
   def __init__(self):
-    pass
+    self.frames = 0
+    self.lock = threading.Lock()
+
+  def post_to_connection(self, **kwargs):
+    with self.lock: self.frames += 1
+
+class FakeLambdaClient:
+  '''
+  Runs "invoked" analyses inline, or hands them to a background executor (AuraELAM.ELAMExecutor) when one is set.
+  '''
+  def __init__(self, executor=None):
+    self.executor = executor
+    self.inline_fallbacks = 0 # analyses run inline because the executor was full (or shutting down)
+    self.lock = threading.Lock()
 
   def invoke(self, **kwargs):
-    analyze_async(json.loads(kwargs["Payload"]), {})
\ No newline at end of file
+    payload = json.loads(kwargs["Payload"])
+
+    if self.executor is not None:
+      job_id = self.executor.submit(payload)
+      if job_id is not None: return {'StatusCode': 202, 'JobId': job_id}
+
+      # the executor is full (or shutting down): run the analysis inline rather than drop it
+      with self.lock: self.inline_fallbacks += 1
+      count('elam_inline_fallbacks')
+
+    analyze_async(payload, {})
+    return {'StatusCode': 200}
+
+  def stats(self):
+    '''
+    The executor's stats (if one is set) and how many analyses fell back to running inline.
+    '''
+    stats = dict(self.executor.stats()) if self.executor is not None else {}
+    with self.lock: stats['inline_fallbacks'] = self.inline_fallbacks
+    return stats
\ No newline at end of file
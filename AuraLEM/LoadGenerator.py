@@ -0,0 +1,376 @@
+'''
+Load generator: replays recorded conversations against LEMChat.lambda_handler from many simulated users at once, each
+user on their own thread (uid), with a FakeOpenAIServer in place of OpenAI. Arrivals are closed-loop (every user sends
+their next message once the last one is answered, after a think time) or open-loop (Poisson arrivals at a fixed rate,
+run by a pool the size of the Lambda concurrency, so latency includes waiting for a free invocation). A burst sends
+several of a user's messages at once, which contend for the thread's idempotency lock; the local_test_small preset's
+small analysis window overflows every few turns, queueing ELAM analyses.
+
+Reports throughput, outcome counts (incl. the lock rejection rate), end-to-end / service / queueing latency
+distributions, the ELAM queue lag (turn queueing an analysis -> its job starting) and storage calls per turn, as JSON.
+
+Recorded conversations are a JSON list of conversations, each a list of turns: a user message, or
+{"user": message, "assistant": reply} (the reply is served by the fake server). Without one, conversations are drawn
+from Tokenizers.EstimatorBenchmark's corpus.
+
+Run from AuraLEM/: python LoadGenerator.py --users 20 --mode open --rate 10 --duration 60 --out load.json
+'''
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import simplejson as json
+import LEMChat
+from CW_configs import get_cw_config
+from DynamoDBUtilities import configure_storage, get_storage
+from Tokenizers.Tokenizer import Tokenizer
+from Tokenizers.EstimatorBenchmark import SAMPLE_CORPUS
+from AuraOpenAI.FakeOpenAIServer import FakeOpenAIServer
+from AuraOpenAI.RateLimiter import configure_admission
+from AuraOpenAI.ClientRegistry import configure_openai_clients
+from AuraELAM import OpenAIELAM
+from LEMTestUtilities import NullConn
+from TurnBenchmark import summarize
+
+# model latency of the default scenario, roughly the API's (see AuraOpenAI.FakeOpenAIServer for the settings)
+DEFAULT_SCENARIO = {
+  "ttft_seconds": 0.3,
+  "inter_token_seconds": 0.01,
+  "jitter": 0.3
+}
+
+OUTCOMES = ['completed', 'queued', 'lock_rejected', 'mailbox_full', 'rejected', 'error']
+
+
+class SimulatedUser():
+  '''
+  One communication thread, replaying its conversation in order (from the start again once it runs out).
+  '''
+
+  def __init__(self, api_key, uid, iid, conversation):
+    self.api_key = api_key
+    self.uid = uid
+    self.iid = iid
+    self.conversation = conversation
+    self.position = 0
+    self.lock = threading.Lock()
+
+
+  def next_message(self):
+    with self.lock:
+      turn = self.conversation[self.position % len(self.conversation)]
+      self.position += 1
+    return turn["user"] if isinstance(turn, dict) else turn
+
+
+class LoadRun():
+  '''
+  Invokes the handler and records every invocation as { 'uid', 'outcome', 'status', 'burst', 'scheduled', 'started',
+  'finished' } (seconds since the run started).
+  '''
+
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.records = []
+    self.lock = threading.Lock()
+
+
+  def now(self):
+    return time.perf_counter() - self.start
+
+
+  def invoke(self, user, force_reflect=False, burst=False, scheduled=None):
+    event = {
+      "requestContext": {"connectionId": f"load-{user.uid}"},
+      "body": json.dumps({
+        "sub": user.api_key,
+        "uid": user.uid,
+        "iid": user.iid,
+        "user_message": user.next_message(),
+        "force_reflect": force_reflect
+      })
+    }
+
+    started = self.now()
+    try:
+      response = LEMChat.lambda_handler(event, None)
+      status = response['statusCode']
+      outcome = classify(response)
+    except Exception as e:
+      status, outcome = repr(e), 'error'
+
+    record = {
+      'uid': user.uid,
+      'outcome': outcome,
+      'status': status,
+      'burst': burst,
+      'scheduled': started if scheduled is None else scheduled,
+      'started': started,
+      'finished': self.now()
+    }
+    with self.lock: self.records.append(record)
+    return record
+
+
+  def send(self, user, rng, force_reflect_probability, burst_probability, burst_size, scheduled=None, pool=None):
+    '''
+    Sends the user's next message, or a burst of burst_size of them at once. On a pool the invocations are only queued;
+    otherwise this returns once they have all been answered.
+    '''
+    count = burst_size if rng.random() < burst_probability else 1
+    force_reflects = [rng.random() < force_reflect_probability for _ in range(count)]
+
+    if pool is not None:
+      for force_reflect in force_reflects: pool.submit(self.invoke, user, force_reflect, count > 1, scheduled)
+      return
+
+    if count == 1: return self.invoke(user, force_reflects[0])
+
+    threads = [threading.Thread(target=self.invoke, args=(user, force_reflect, True)) for force_reflect in force_reflects]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+
+def classify(response):
+  status = response['statusCode']
+  if status == 200: return 'completed'
+  if status == 202: return 'queued'
+  if status == 429: return 'mailbox_full'
+  if status == 400 and 'Process already running' in str(response.get('body')): return 'lock_rejected'
+  if status == 400: return 'rejected'
+  return 'error'
+
+
+def default_conversations(cw_config, count, turns, rng):
+  # user messages within the preset's um limits
+  tokenizer = Tokenizer({cw_config["elks_token_type"], cw_config["elam_token_type"]})
+  limit = min(cw_config["elks_um_mtl"], cw_config["elam_um_mtl"])
+  messages = [text for text in SAMPLE_CORPUS if text and max(tokenizer.calculate_tokenized_length(text).values()) <= limit]
+  return [[rng.choice(messages) for _ in range(turns)] for _ in range(count)]
+
+
+def recordings(conversations):
+  # { user message: recorded reply } for the fake server
+  return {turn["user"]: turn["assistant"] for conversation in conversations for turn in conversation if isinstance(turn, dict) and turn.get("assistant")}
+
+
+def configure_lem(preset, overrides):
+  '''
+  Points LEMChat (configured at import) at preset + overrides, and drops its streamed output.
+  '''
+  cw_config = LEMChat.cw_config
+  cw_config.clear()
+  cw_config.update(get_cw_config(preset), **overrides)
+
+  LEMChat.tokenizer = Tokenizer({cw_config["elks_token_type"], cw_config["elam_token_type"]})
+  LEMChat.conn = NullConn()
+  configure_storage(cw_config)
+  OpenAIELAM.use_elam_executor(cw_config)
+  configure_admission(cw_config)
+  configure_openai_clients(cw_config)
+  return cw_config
+
+
+def run_closed(load_run, users, seed, turns_per_user, duration, think_seconds, force_reflect_probability, burst_probability, burst_size):
+  def user_loop(user):
+    rng = random.Random(f'{seed}:{user.uid}')
+    for _ in range(turns_per_user):
+      if duration is not None and load_run.now() >= duration: return
+      load_run.send(user, rng, force_reflect_probability, burst_probability, burst_size)
+      if think_seconds > 0: time.sleep(rng.expovariate(1 / think_seconds))
+
+  threads = [threading.Thread(target=user_loop, args=(user,), name=f'user-{user.uid}') for user in users]
+  for thread in threads: thread.start()
+  for thread in threads: thread.join()
+
+
+def run_open(load_run, users, seed, rate, duration, concurrency, force_reflect_probability, burst_probability, burst_size):
+  rng = random.Random(seed)
+  scheduled = 0.0
+
+  with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='invocation') as pool:
+    while scheduled < duration:
+      # arrivals keep their schedule whether or not earlier ones were answered
+      delay = scheduled - load_run.now()
+      if delay > 0: time.sleep(delay)
+
+      load_run.send(rng.choice(users), rng, force_reflect_probability, burst_probability, burst_size, scheduled, pool)
+      scheduled += rng.expovariate(rate)
+
+
+def drain_elam(timeout=300):
+  '''
+  Waits for the queued analyses to finish (shutting the executor down). Returns (executor stats, queue lags, seconds waited).
+  '''
+  executor = OpenAIELAM.lambda_client.executor
+  if executor is None: return (None, [], 0.0)
+
+  start = time.perf_counter()
+  drainer = threading.Thread(target=executor.shutdown, daemon=True)
+  drainer.start()
+  drainer.join(timeout)
+  return (OpenAIELAM.lambda_client.stats(), executor.queue_lags(), time.perf_counter() - start)
+
+
+def report(load_run, elapsed, elam, storage_stats, server_stats, settings):
+  records = load_run.records
+  outcomes = {outcome: sum(record['outcome'] == outcome for record in records) for outcome in OUTCOMES}
+  completed = [record for record in records if record['outcome'] == 'completed']
+
+  # queued (202) turns are run by the invocation holding the thread's lock before it returns
+  turns = outcomes['completed'] + outcomes['queued']
+  executor_stats, queue_lags, drain_seconds = elam
+
+  def latencies(selected, start_field, end_field):
+    return summarize([(record[end_field] - record[start_field]) * 1000 for record in selected])
+
+  calls = storage_stats['calls']
+  return {
+    'settings': settings,
+    'elapsed_seconds': elapsed,
+    'invocations': len(records),
+    'bursts': sum(record['burst'] for record in records),
+    'outcomes': outcomes,
+    'status_codes': {str(status): sum(record['status'] == status for record in records) for status in set(record['status'] for record in records)},
+    'turns': turns,
+    'throughput_turns_per_second': turns / elapsed if elapsed > 0 else None,
+    'invocations_per_second': len(records) / elapsed if elapsed > 0 else None,
+    'lock_rejection_rate': outcomes['lock_rejected'] / len(records) if records else None,
+    'latency_ms': {
+      # of the invocations answered 200, which includes running the turns queued behind them
+      'end_to_end': latencies(completed, 'scheduled', 'finished'),
+      'service': latencies(completed, 'started', 'finished'),
+      'queueing': latencies(records, 'scheduled', 'started'),
+      'rejection': latencies([record for record in records if record['outcome'] == 'lock_rejected'], 'started', 'finished')
+    },
+    'elam': {
+      'executor': executor_stats,
+      'queue_lag_ms': summarize([lag * 1000 for lag in queue_lags]),
+      'analyses_timed': len(queue_lags),
+      'drain_seconds': drain_seconds
+    },
+    'storage': {
+      'backend': storage_stats['backend'],
+      'calls': calls,
+      'calls_per_turn': {operation: count / turns for operation, count in calls.items()} if turns else None
+    },
+    'openai': server_stats
+  }
+
+
+def print_summary(results, file=sys.stderr):
+  latency = results['latency_ms']
+  print(f"{results['invocations']} invocations in {results['elapsed_seconds']:.1f}s: {results['throughput_turns_per_second']:.2f} turns/s, "
+    f"lock rejection rate {results['lock_rejection_rate']:.3f}", file=file)
+  print(f"  outcomes: {results['outcomes']}", file=file)
+
+  for name in ('end_to_end', 'service', 'queueing'):
+    summary = latency[name]
+    if summary['p50'] is None: continue
+    print(f"  {name:<12} p50 {summary['p50']:9.1f}  p95 {summary['p95']:9.1f}  p99 {summary['p99']:9.1f}  max {summary['max']:9.1f} ms", file=file)
+
+  lag = results['elam']['queue_lag_ms']
+  if lag['p50'] is not None:
+    print(f"  elam lag     p50 {lag['p50']:9.1f}  p95 {lag['p95']:9.1f}  p99 {lag['p99']:9.1f}  max {lag['max']:9.1f} ms "
+      f"({results['elam']['analyses_timed']} analyses, drained in {results['elam']['drain_seconds']:.1f}s)", file=file)
+  print(f"  storage calls per turn: {results['storage']['calls_per_turn']}", file=file)
+
+
+@contextmanager
+def quiet_stdout():
+  # the handler & ELAM jobs print as they go. Silenced at the file descriptor, so worker processes started inside are too
+  sys.stdout.flush()
+  saved = os.dup(1)
+  devnull = os.open(os.devnull, os.O_WRONLY)
+  os.dup2(devnull, 1)
+  try:
+    yield
+  finally:
+    sys.stdout.flush()
+    os.dup2(saved, 1)
+    os.close(devnull)
+    os.close(saved)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Concurrent multi-user load generator for LEMChat.lambda_handler.')
+  parser.add_argument('--conversations', help='JSON file of recorded conversations')
+  parser.add_argument('--users', type=int, default=10, help='simulated users, one communication thread each')
+  parser.add_argument('--mode', choices=['closed', 'open'], default='closed')
+  parser.add_argument('--turns-per-user', type=int, default=10, help='closed loop: messages each user sends')
+  parser.add_argument('--think-seconds', type=float, default=0.5, help='closed loop: mean pause between a reply and the next message')
+  parser.add_argument('--rate', type=float, default=5.0, help='open loop: arrivals per second')
+  parser.add_argument('--duration', type=float, help='seconds to run (required for open loop)')
+  parser.add_argument('--concurrency', type=int, default=50, help='open loop: concurrent invocations (Lambda concurrency)')
+  parser.add_argument('--burst-probability', type=float, default=0.1, help='chance an arrival is a burst to the same thread')
+  parser.add_argument('--burst-size', type=int, default=3)
+  parser.add_argument('--force-reflect-probability', type=float, default=0.0)
+  parser.add_argument('--preset', default='local_test_small')
+  parser.add_argument('--storage', choices=['memory', 'sqlite'], default='memory')
+  parser.add_argument('--storage-path', default='load_test.sqlite3')
+  parser.add_argument('--elam-executor', choices=['none', 'thread', 'process', 'sqlite'], default='thread')
+  parser.add_argument('--elam-workers', type=int, default=2)
+  parser.add_argument('--elam-debounce-seconds', type=float, default=0)
+  parser.add_argument('--mailbox', choices=['none', 'local'], default='none', help='queue messages for locked threads instead of rejecting them')
+  parser.add_argument('--scenario', help='JSON file of FakeOpenAIServer scenario settings')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--out', help='write the JSON results here instead of stdout')
+  args = parser.parse_args()
+
+  if args.mode == 'open' and args.duration is None: parser.error('--duration is required for --mode open')
+  if args.storage == 'memory' and args.elam_executor in ('process', 'sqlite'): parser.error('ELAM worker processes need --storage sqlite')
+
+  rng = random.Random(args.seed)
+  if args.conversations:
+    with open(args.conversations) as conversations_file: conversations = json.load(conversations_file)
+  else:
+    conversations = default_conversations(get_cw_config(args.preset), args.users, max(args.turns_per_user, 10), rng)
+
+  scenario = dict(DEFAULT_SCENARIO, seed=args.seed, recordings=recordings(conversations))
+  if args.scenario:
+    with open(args.scenario) as scenario_file: scenario.update(json.load(scenario_file))
+  server = FakeOpenAIServer(scenario).start()
+
+  # read by the ELAM worker processes too (the API key is only ever sent to the fake server)
+  os.environ.setdefault('openai_key', 'load-test')
+  os.environ['OPENAI_BASE_URL'] = server.url
+
+  users = [SimulatedUser('load', f'user{i}', 'intelligence', conversations[i % len(conversations)]) for i in range(args.users)]
+
+  with quiet_stdout():
+    configure_lem(args.preset, {
+      "storage_backend": args.storage,
+      "storage_path": args.storage_path,
+      "elam_executor": None if args.elam_executor == 'none' else args.elam_executor,
+      "elam_executor_workers": args.elam_workers,
+      "elam_debounce_seconds": args.elam_debounce_seconds,
+      "mailbox": None if args.mailbox == 'none' else args.mailbox,
+      "openai_client": {"base_url": server.url}
+    })
+
+    load_run = LoadRun()
+    if args.mode == 'closed':
+      run_closed(load_run, users, args.seed, args.turns_per_user, args.duration, args.think_seconds, args.force_reflect_probability, args.burst_probability, args.burst_size)
+    else:
+      run_open(load_run, users, args.seed, args.rate, args.duration, args.concurrency, args.force_reflect_probability, args.burst_probability, args.burst_size)
+    elapsed = load_run.now()
+    elam = drain_elam()
+
+  server.stop()
+  settings = {key: value for key, value in vars(args).items() if key not in ('out',)}
+  results = report(load_run, elapsed, elam, get_storage().stats(), server.stats(), settings)
+  print_summary(results)
+
+  if args.out:
+    with open(args.out, 'w') as out_file: json.dump(results, out_file, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -5,9 +5,6 @@ from DynamoDBUtilities import *
 import boto3
 from CW_configs import get_cw_config
 
-client = boto3.resource('dynamodb')
-table = client.Table('UserData')
-
 api_key = "jesus"
 uid = "user6"
 iid = "intelligence6"
@@ -20,7 +17,7 @@ def reset_context_window_meta():
 
   context_window_meta = {
     'partitionk': context_window_meta_partitionk,
-    'sortk': get_sortk_timestamp(),
+    'sortk': CWM_SORTK,
     'idempotency_lock': False,
     'elam_aw_token_length': 0,
     'elam_token_type': cw_config["elam_token_type"],
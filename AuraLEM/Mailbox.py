@@ -0,0 +1,150 @@
+'''
+Per-thread mailboxes: when a message arrives for a communication thread whose idempotency lock is held, it is queued
+here instead of being rejected, and the lock holder processes queued messages in arrival order once its own turn is done.
+Selected with the "mailbox" cw_config entry: None (reject, the original behaviour), "local" or "dynamodb".
+'''
+
+import uuid
+import threading
+from collections import deque
+from DynamoDBUtilities import *
+
+class LocalMailbox():
+  '''
+  In-memory mailbox. Only sees messages for threads handled by this process (local testing / a single container).
+  '''
+
+  def __init__(self, max_depth=5):
+    self.max_depth = max_depth
+    self.queues = {} # { (api_key, uid, iid): deque of queued requests, oldest first }
+    self.lock = threading.Lock()
+
+    self.enqueued = 0
+    self.rejected = 0
+    self.dequeued = 0
+
+
+  def enqueue(self, key, request):
+    '''
+    Queues request behind the messages already waiting for the thread. Returns { 'accepted', 'position', 'depth' };
+    when the mailbox is full the request is not queued (accepted False), signalling the client to back off.
+    '''
+    with self.lock:
+      queue = self.queues.setdefault(key, deque())
+      if len(queue) >= self.max_depth:
+        self.rejected += 1
+        return {'accepted': False, 'position': None, 'depth': len(queue)}
+
+      queue.append(request)
+      self.enqueued += 1
+      return {'accepted': True, 'position': len(queue), 'depth': len(queue)}
+
+
+  def dequeue(self, key):
+    '''
+    Removes and returns the oldest queued request for the thread, or None if there is none.
+    '''
+    with self.lock:
+      queue = self.queues.get(key)
+      if not queue: return None
+
+      request = queue.popleft()
+      if not queue: del self.queues[key]
+      self.dequeued += 1
+      return request
+
+
+  def depth(self, key):
+    with self.lock:
+      return len(self.queues.get(key, ()))
+
+
+  def stats(self):
+    with self.lock:
+      return {
+        'threads': len(self.queues),
+        'queued': sum(len(queue) for queue in self.queues.values()),
+        'enqueued': self.enqueued,
+        'rejected': self.rejected,
+        'dequeued': self.dequeued
+      }
+
+
+class DynamoDBMailbox():
+  '''
+  Mailbox stored in ddb under the thread's "mailbox" partition, so any container holding the lock can drain it.
+  Items sort by arrival timestamp (plus a random suffix for ties) and are read with strongly consistent queries. The
+  depth bound is checked before writing, so concurrent arrivals can overshoot it slightly.
+  '''
+
+  def __init__(self, max_depth=5):
+    self.max_depth = max_depth
+
+    self.enqueued = 0
+    self.rejected = 0
+    self.dequeued = 0
+
+
+  def partitionk(self, key):
+    api_key, uid, iid = key
+    return api_key + uid + iid + 'mailbox'
+
+
+  def enqueue(self, key, request):
+    depth = count_items_ddb(self.partitionk(key), True)
+    if depth >= self.max_depth:
+      self.rejected += 1
+      return {'accepted': False, 'position': None, 'depth': depth}
+
+    put_response = put_item_ddb({
+      'partitionk': self.partitionk(key),
+      'sortk': get_sortk_timestamp() + '#' + uuid.uuid4().hex[:8],
+      'request': request
+    })
+    if put_response['statusCode'] != 200:
+      self.rejected += 1
+      return {'accepted': False, 'position': None, 'depth': depth}
+
+    self.enqueued += 1
+    return {'accepted': True, 'position': depth + 1, 'depth': depth + 1}
+
+
+  def dequeue(self, key):
+    while True:
+      items = full_limit_query(self.partitionk(key), True, 1, True)
+      if not items: return None
+
+      # the conditional delete makes the dequeue exclusive; if another caller got it first, try the next one
+      if delete_item_ddb(items[0]['partitionk'], items[0]['sortk']):
+        self.dequeued += 1
+        return items[0]['request']
+
+
+  def depth(self, key):
+    return count_items_ddb(self.partitionk(key), True)
+
+
+  def stats(self):
+    return {
+      'enqueued': self.enqueued,
+      'rejected': self.rejected,
+      'dequeued': self.dequeued
+    }
+
+
+mailboxes = {} # { (kind, max_depth): mailbox }, one per process
+
+def get_mailbox(cw_config):
+  '''
+  Returns the process-wide mailbox selected by cw_config, or None if queueing is disabled.
+  '''
+  kind = cw_config.get("mailbox")
+  if kind is None: return None
+
+  max_depth = cw_config.get("mailbox_max_depth", 5)
+  if (kind, max_depth) not in mailboxes:
+    if kind == "local": mailboxes[(kind, max_depth)] = LocalMailbox(max_depth)
+    elif kind == "dynamodb": mailboxes[(kind, max_depth)] = DynamoDBMailbox(max_depth)
+    else: raise ValueError(f"Unknown mailbox: {kind}")
+
+  return mailboxes[(kind, max_depth)]
@@ -0,0 +1,39 @@
+import time
+from contextlib import contextmanager
+
+class StageTimer():
+  '''
+  Records the start offset & duration of each stage of an invocation, so overlapping (concurrent) stages and the
+  resulting critical path can be compared against the sequential handler.
+  '''
+
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.stages = {} # { stage_name: (start_offset_s, duration_s) }
+
+
+  @contextmanager
+  def stage(self, name):
+    stage_start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.stages[name] = (stage_start - self.start, time.perf_counter() - stage_start)
+
+
+  async def timed(self, name, awaitable):
+    '''
+    Awaits awaitable as stage name. Used to time stages that run concurrently under asyncio.gather.
+    '''
+    with self.stage(name):
+      return await awaitable
+
+
+  def report(self):
+    '''
+    Returns { 'total_ms': wall-clock time so far, 'stages': { name: { 'start_ms', 'duration_ms' } } }.
+    '''
+    return {
+      'total_ms': (time.perf_counter() - self.start) * 1000,
+      'stages': {name: {'start_ms': offset * 1000, 'duration_ms': duration * 1000} for name, (offset, duration) in self.stages.items()}
+    }
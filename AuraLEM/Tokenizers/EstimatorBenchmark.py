@@ -0,0 +1,98 @@
+'''
+Benchmark for the token length estimator: checks the estimator's calibrated (lower, upper) estimates and the vocabulary
+bounds against exact counts on the calibration corpus and on held-out text, and reports how often validate_inputs can
+decide a um_mtl check without encoding (on the vocabulary bounds; a wrong decision there is a bug).
+
+Run from AuraLEM/: python -m Tokenizers.EstimatorBenchmark
+'''
+
+import time
+from Tokenizers.Tokenizer import Tokenizer
+from Tokenizers.EstimatorCalibration import CALIBRATION_CORPUS as SAMPLE_CORPUS
+
+# text not used for calibration
+HELD_OUT_CORPUS = [
+  "ok",
+  "What's the weather usually like in Lisbon in early October? Thinking about a short trip.",
+  "for (let i = 0; i < items.length; i++) { total += items[i].price * items[i].qty; }",
+  "Mi hermana se muda a Barcelona el mes que viene y está buscando piso cerca del centro.",
+  "한국어로 간단한 인사말을 배우고 싶어요. 도와줄 수 있나요?",
+  "Σήμερα διάβασα ένα ενδιαφέρον άρθρο για την αρχαία φιλοσοφία.",
+  "!!!??? ... --- ### $$$ %%% &&& *** ((( ))) [[[ ]]] {{{ }}}",
+  "1234567890 9876543210 5555555555 0000000000 1111111111",
+  "My favourite bands are Radiohead, Portishead and Massive Attack; I saw all three live in the 90s. " * 6,
+  "👋 hey!! just landed in Tokyo ✈️🇯🇵 jet lag is real 😴",
+]
+
+# um_mtl limits of the cw_config presets ('local_test_small' & 'production')
+LIMITS = [20, 500]
+
+
+def benchmark(token_types, corpus=SAMPLE_CORPUS, limits=LIMITS, repeat=20):
+  tokenizer = Tokenizer(token_types, cache_size=0)
+  results = {}
+
+  for token_type in tokenizer.tokenizers:
+    sub_tokenizer = tokenizer.tokenizers[token_type]
+
+    violations = 0 # texts outside the calibrated estimates
+    wrong = 0 # checks the vocabulary bounds answered differently than the exact count
+    ratios = [] # exact tokens / utf-8 bytes
+    widths = [] # upper / exact
+    decided = {limit: 0 for limit in limits} # checks answered from the bounds alone
+
+    for text in corpus:
+      lower, upper = sub_tokenizer.estimate_tokenized_length(text)
+      exact = sub_tokenizer.calculate_tokenized_length(text)
+
+      if not (lower <= exact <= upper): violations += 1
+      if exact > 0:
+        ratios.append(exact / len(text.encode('utf-8')))
+        widths.append(upper / exact)
+
+      sound_lower, sound_upper = sub_tokenizer.tokenized_length_bounds(text)
+      for limit in limits:
+        if sound_upper <= limit or sound_lower > limit:
+          decided[limit] += 1
+          if (sound_upper <= limit) != (exact <= limit): wrong += 1
+
+    # time the estimator against the exact encoder over the whole corpus
+    start = time.perf_counter()
+    for _ in range(repeat):
+      for text in corpus: sub_tokenizer.estimate_tokenized_length(text)
+    estimate_s = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+      for text in corpus: sub_tokenizer.calculate_tokenized_length(text)
+    exact_s = (time.perf_counter() - start) / repeat
+
+    results[token_type] = {
+      'samples': len(corpus),
+      'calibrated_ratios': sub_tokenizer.ratios, # (min tokens per byte, max tokens per ascii byte)
+      'estimate_violations': violations,
+      'wrong_decisions': wrong,
+      'min_tokens_per_byte': min(ratios),
+      'max_tokens_per_byte': max(ratios),
+      'max_upper_over_exact': max(widths),
+      'decided_without_encoding': {limit: decided[limit] / len(corpus) for limit in limits},
+      'estimate_us_per_text': estimate_s / len(corpus) * 1e6,
+      'exact_us_per_text': exact_s / len(corpus) * 1e6
+    }
+
+  return results
+
+
+def main():
+  for name, corpus in (('calibration corpus', SAMPLE_CORPUS), ('held-out corpus', HELD_OUT_CORPUS)):
+    print(f"--- {name} ---")
+    results = benchmark(["cl100k_base", "LLAMASentencePieceBytePairEncoding"], corpus)
+    for token_type in results:
+      print(token_type)
+      for key, value in results[token_type].items():
+        print(f"  {key}: {value}")
+      print("\n")
+
+
+if __name__ == "__main__":
+  main()
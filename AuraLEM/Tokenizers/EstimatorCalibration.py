@@ -0,0 +1,92 @@
+'''
+Bounds of the tokenized length of a text without encoding it.
+  vocabulary_bounds: every token covers 1 to max token bytes, so bytes / max token bytes <= tokens <= bytes holds for
+    any text. These are the only bounds a um_mtl check is decided on (Tokenizer.within_tokenized_length).
+  calibrated_bounds: tighter estimates for sizing and reporting. Each sub-tokenizer measures its tokens-per-byte ratios
+    on a sample corpus once per process and widens them by SAFETY_MARGIN:
+      upper: ascii bytes * the largest ratio of the ascii texts + one token per other byte (byte fallback's worst case)
+      lower: all bytes * the smallest ratio of any text
+    Texts unlike the corpus (e.g. long runs of one character) fall outside them, so never reject on them.
+'''
+
+import math
+
+# small mixed corpus: chat-like english, code, numbers, non-latin scripts, emoji and whitespace-heavy text
+CALIBRATION_CORPUS = [
+  "",
+  "hi",
+  "Hey! How's it going today?",
+  "I just got back from a month-long backpacking trip through Patagonia and I'm still processing everything.",
+  "Can you help me write a cover letter for a product manager role at a robotics startup? I have 3 years of experience.",
+  "def fib(n):\n    return n if n < 2 else fib(n - 1) + fib(n - 2)\n\nprint([fib(i) for i in range(10)])",
+  "SELECT uid, COUNT(*) FROM messages WHERE iid = 'intelligence6' GROUP BY uid ORDER BY 2 DESC LIMIT 25;",
+  "3.14159265358979323846264338327950288419716939937510 2024-01-17T22:41:09.123456+0000 0xDEADBEEF",
+  "Je pense que la réunion de demain devrait être reportée à la semaine prochaine, qu'en penses-tu ?",
+  "Ich habe gestern Abend einen wunderbaren Spaziergang entlang der Spree gemacht.",
+  "今日はとても良い天気ですね。散歩に行きましょうか？",
+  "我昨天去了图书馆，借了三本关于机器学习的书。",
+  "Привет! Как дела? Я сегодня весь день работал над новым проектом.",
+  "مرحبا، كيف حالك اليوم؟",
+  "🙂🙂🙂 lol 😂😂 this is 🔥🔥🔥",
+  "    lots     of      irregular        whitespace\n\n\n\n\tand\ttabs\t\t\t",
+  "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa",
+  "https://example.com/some/really/long/path?with=query&params=1&and=more#fragment",
+  "The mitochondria is the powerhouse of the cell. " * 20,
+  "I've been thinking a lot about whether to go back to school for a masters in physics or keep working on the startup. " * 8,
+]
+
+# calibrated ratios are widened by this factor, so texts unlike the corpus stay within the bounds
+SAFETY_MARGIN = 1.5
+
+
+def byte_counts(text):
+  '''
+  Returns (ascii bytes, other utf-8 bytes) of text.
+  '''
+  n_bytes = len(text.encode('utf-8'))
+  n_ascii = len(text.encode('ascii', 'ignore'))
+  return (n_ascii, n_bytes - n_ascii)
+
+
+def calibrate(calculate_tokenized_length, corpus=CALIBRATION_CORPUS, margin=SAFETY_MARGIN):
+  '''
+  Returns (min tokens per byte, max tokens per ascii byte), widened by margin, of calculate_tokenized_length over corpus.
+  '''
+  min_ratio = 1.0
+  max_ascii_ratio = 0.0
+
+  for text in corpus:
+    n_ascii, n_other = byte_counts(text)
+    if n_ascii + n_other == 0: continue
+
+    tokens = calculate_tokenized_length(text)
+    min_ratio = min(min_ratio, tokens / (n_ascii + n_other))
+    if n_other == 0: max_ascii_ratio = max(max_ascii_ratio, tokens / n_ascii)
+
+  return (min_ratio / margin, min(max_ascii_ratio * margin, 1.0))
+
+
+def vocabulary_bounds(n_bytes, max_token_bytes):
+  '''
+  Returns (lower, upper) bounds of the tokenized length of a text of n_bytes bytes that hold for any text: every token
+  covers 1 to max_token_bytes bytes.
+  '''
+  return (-(-n_bytes // max_token_bytes), n_bytes)
+
+
+def calibrated_bounds(text, ratios, max_token_bytes, extra_tokens=0):
+  '''
+  Returns (lower, upper) estimates of the tokenized length of text from calibrate's ratios, kept within the vocabulary
+  bounds (every token covers 1 to max_token_bytes bytes). extra_tokens: tokens the text may add regardless of its
+  length (e.g. SentencePiece's dummy prefix piece).
+  '''
+  if text == "": return (0, 0)
+
+  min_ratio, max_ascii_ratio = ratios
+  n_ascii, n_other = byte_counts(text)
+  n_bytes = n_ascii + n_other
+
+  sound_lower, sound_upper = vocabulary_bounds(n_bytes, max_token_bytes)
+  lower = max(sound_lower, int(n_bytes * min_ratio))
+  upper = min(sound_upper, math.ceil(n_ascii * max_ascii_ratio) + n_other)
+  return (lower, upper + extra_tokens)
@@ -0,0 +1,73 @@
+class IncrementalTokenCounter():
+  '''
+  Counts the tokenized length of a streamed text as its deltas arrive, so the count is ready when the stream closes.
+  Text is committed in chunks that end at a "<letter> <letter>" boundary: every sub-tokenizer's pre-tokenization splits
+  there, so the chunk lengths sum to the length of the whole text. Only the text after the last boundary is left to
+  encode in finish().
+  '''
+
+  def __init__(self, tokenizer, flush_chars=256):
+    self.tokenizer = tokenizer # higher-level Tokenizer
+    self.flush_chars = flush_chars # pending text length that triggers a commit attempt
+
+    self.committed = {token_type: 0 for token_type in tokenizer.tokenizers} # { token_type: tokenized length of committed text }
+    self.started = False # whether any text has been committed (later chunks are continuations)
+    self.pending = []
+    self.pending_chars = 0
+
+
+  def append(self, delta):
+    self.pending.append(delta)
+    self.pending_chars += len(delta)
+    if self.pending_chars >= self.flush_chars: self.commit()
+
+
+  def commit(self):
+    pending = "".join(self.pending)
+    boundary = self.last_boundary(pending)
+
+    # no safe split point yet: keep buffering
+    if boundary <= 0:
+      self.pending = [pending]
+      return
+
+    chunk = pending[:boundary]
+    for token_type in self.committed:
+      self.committed[token_type] += self.chunk_length(token_type, chunk)
+
+    self.started = True
+    self.pending = [pending[boundary:]]
+    self.pending_chars = len(pending) - boundary
+
+
+  def chunk_length(self, token_type, chunk):
+    sub_tokenizer = self.tokenizer.tokenizers[token_type]
+    if self.started: return sub_tokenizer.calculate_continuation_length(chunk)
+    return sub_tokenizer.calculate_tokenized_length(chunk)
+
+
+  def last_boundary(self, text):
+    '''
+    Returns the index of the last single space between two letters in text, or -1 if there is none.
+    '''
+    i = len(text) - 2
+    while i > 0:
+      if text[i] == ' ' and text[i - 1].isalpha() and text[i + 1].isalpha(): return i
+      i -= 1
+    return -1
+
+
+  def finish(self, known_lengths=None):
+    '''
+    Returns { token_type: tokenized_length } of the full text. Lengths in known_lengths (e.g. from provider usage
+    data) are taken as-is; the rest only encode the text since the last commit.
+    '''
+    known_lengths = known_lengths or {}
+    pending = "".join(self.pending)
+
+    lengths = {}
+    for token_type in self.committed:
+      if token_type in known_lengths: lengths[token_type] = known_lengths[token_type]
+      elif pending == "": lengths[token_type] = self.committed[token_type]
+      else: lengths[token_type] = self.committed[token_type] + self.chunk_length(token_type, pending)
+    return lengths
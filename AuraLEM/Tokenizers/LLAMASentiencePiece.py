@@ -1,16 +1,66 @@
-import sentencepiece as spm
+from Tokenizers.TokenizerModels import get_model
+from Tokenizers.EstimatorCalibration import calibrate, calibrated_bounds, vocabulary_bounds
 
 class LLAMASentiencePiece():
   def __init__(self, token_type):
     # make sure the LEMChat knows this is the token type it is using
     assert token_type == "LLAMASentencePieceBytePairEncoding"
     self.token_type = "LLAMASentencePieceBytePairEncoding"
-    self.tokenizer = spm.SentencePieceProcessor('AuraLEM/Tokenizers/tokenizer.model')
+    self.tokenizer = get_model("LLAMASentencePieceBytePairEncoding") # shared, loaded once per process
+
+    # longest piece in the vocabulary (in utf-8 bytes) and the estimator's calibrated ratios. Computed on first use.
+    self.max_piece_bytes = None
+    self.ratios = None
 
   
   def calculate_tokenized_length(self, text):
-    tokens = self.tokenizer.encode(text, out_type=str)
+    # encode to ids: only the count is needed, so don't build the piece strings
+    tokens = self.tokenizer.encode(text, out_type=int)
     return len(tokens)
+
+
+  def calculate_continuation_length(self, text):
+    '''
+    Tokenized length of text that continues an already-counted prefix (split just before a space).
+    The dummy prefix "\u2581" that SentencePiece prepends stands in for that leading space, so drop it first.
+    '''
+    if text.startswith(' '): text = text[1:]
+    return self.calculate_tokenized_length(text)
+
+
+  def tokenized_length_bounds(self, text):
+    '''
+    Returns (lower, upper) bounds of the tokenized length of text that hold for any text (see EstimatorCalibration).
+    Pieces cover the normalized text (dummy prefix added, whitespace and unicode normalized), so its bytes are counted.
+    '''
+    if self.max_piece_bytes is None:
+      self.max_piece_bytes = max(len(self.tokenizer.id_to_piece(i).replace('\u2581', ' ').encode('utf-8')) for i in range(self.tokenizer.get_piece_size()))
+
+    if text == "": return (0, 0)
+    normalized = self.tokenizer.normalize(text).replace('\u2581', ' ')
+    return vocabulary_bounds(len(normalized.encode('utf-8')), self.max_piece_bytes)
+
+
+  def estimate_tokenized_length(self, text):
+    '''
+    Returns (lower, upper) estimates of the tokenized length of text without encoding it (see EstimatorCalibration).
+    The upper estimate allows one more piece for the dummy prefix.
+    '''
+    if self.ratios is None:
+      if self.max_piece_bytes is None:
+        self.max_piece_bytes = max(len(self.tokenizer.id_to_piece(i).replace('\u2581', ' ').encode('utf-8')) for i in range(self.tokenizer.get_piece_size()))
+      self.ratios = calibrate(self.calculate_tokenized_length)
+
+    return calibrated_bounds(text, self.ratios, self.max_piece_bytes, extra_tokens=1)
+
+
+  def calculate_tokenized_lengths(self, texts, num_threads=4):
+    '''
+    Batch version of calculate_tokenized_length: SentencePiece encodes a list of texts on its own native thread pool.
+    '''
+    if len(texts) == 0: return []
+
+    return [len(ids) for ids in self.tokenizer.encode(texts, out_type=int, num_threads=num_threads)]
   
 
   def update_token_context(self, messages):
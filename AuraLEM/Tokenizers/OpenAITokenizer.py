@@ -1,16 +1,60 @@
-import tiktoken
+from Tokenizers.TokenizerModels import get_model
+from Tokenizers.EstimatorCalibration import calibrate, calibrated_bounds, vocabulary_bounds
 
 class OpenAITokenizer():
   def __init__(self, token_type):
     # make sure the LEMChat knows this is the token type it is using
     assert (token_type == "cl100k_base")
     self.token_type = "cl100k_base"
-    self.tokenizer = tiktoken.get_encoding("cl100k_base")
+    self.tokenizer = get_model("cl100k_base") # shared, loaded once per process from the shipped rank file
+
+    # longest token in the vocabulary (in bytes) and the estimator's calibrated ratios. Computed on first use.
+    self.max_token_bytes = None
+    self.ratios = None
 
   
   def calculate_tokenized_length(self, text):
     tokens = self.tokenizer.encode(text)
     return len(tokens)
+
+
+  def calculate_continuation_length(self, text):
+    '''
+    Tokenized length of text that continues an already-counted prefix (split at a pre-tokenization boundary).
+    '''
+    return self.calculate_tokenized_length(text)
+
+
+  def tokenized_length_bounds(self, text):
+    '''
+    Returns (lower, upper) bounds of the tokenized length of text that hold for any text (see EstimatorCalibration).
+    '''
+    if self.max_token_bytes is None:
+      self.max_token_bytes = max(len(token) for token in self.tokenizer.token_byte_values())
+
+    return vocabulary_bounds(len(text.encode('utf-8')), self.max_token_bytes)
+
+
+  def estimate_tokenized_length(self, text):
+    '''
+    Returns (lower, upper) estimates of the tokenized length of text without encoding it (see EstimatorCalibration).
+    '''
+    if self.ratios is None:
+      if self.max_token_bytes is None:
+        self.max_token_bytes = max(len(token) for token in self.tokenizer.token_byte_values())
+      self.ratios = calibrate(self.calculate_tokenized_length)
+
+    return calibrated_bounds(text, self.ratios, self.max_token_bytes)
+
+
+  def calculate_tokenized_lengths(self, texts, num_threads=4):
+    '''
+    Batch version of calculate_tokenized_length: encodes all texts in one call through tiktoken's threaded batch encoder.
+    '''
+    if len(texts) == 0: return []
+    if len(texts) == 1: return [self.calculate_tokenized_length(texts[0])]
+
+    return [len(tokens) for tokens in self.tokenizer.encode_batch(texts, num_threads=num_threads)]
   
 
   def update_token_context(self, messages):
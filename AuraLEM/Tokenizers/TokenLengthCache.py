@@ -0,0 +1,73 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+class TokenLengthCache():
+  '''
+  Bounded LRU cache of tokenized lengths, keyed by (token_type, content hash). Sits in front of the sub-tokenizers so
+  that retried messages, repeated system prompts and re-tokenized history cost a dictionary lookup instead of a BPE pass.
+  '''
+
+  def __init__(self, max_entries=4096):
+    # must be able to hold at least one entry
+    assert (max_entries > 0)
+    self.max_entries = max_entries
+
+    self.entries = OrderedDict() # { (token_type, content_hash): tokenized_length }, ordered oldest -> most recently used
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+
+  def key(self, token_type, text):
+    # hash the content so long messages are not held as dictionary keys
+    return (token_type, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+
+
+  def get(self, key):
+    '''
+    Returns the cached tokenized length for key, or None if it is not cached.
+    '''
+    with self.lock:
+      tl = self.entries.get(key)
+      if tl is None:
+        self.misses += 1
+        return None
+
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return tl
+
+
+  def put(self, key, tl):
+    with self.lock:
+      self.entries[key] = tl
+      self.entries.move_to_end(key)
+
+      # evict the least recently used entries until the cache is within bounds
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+  def stats(self):
+    '''
+    Returns the hit/miss/eviction counters of the cache.
+    '''
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self.entries),
+        'max_entries': self.max_entries,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': (self.hits / lookups) if lookups > 0 else 0.0
+      }
@@ -1,13 +1,18 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 from Tokenizers.OpenAITokenizer import OpenAITokenizer
 from Tokenizers.LLAMASentiencePiece import LLAMASentiencePiece
+from Tokenizers.TokenLengthCache import TokenLengthCache
+from Tokenizers.IncrementalTokenCounter import IncrementalTokenCounter
 
 class Tokenizer():
   '''
   Higher-level tokenizer that uses sub-tokenizers to tokenize text. This is used by LEMChat to tokenize messages.
   '''
 
-  def __init__(self, token_types):
+  def __init__(self, token_types, cache_size=4096, num_threads=4):
     self.token_types = token_types
+    self.num_threads = num_threads # threads each sub-tokenizer may use for batch encoding
 
     self.tokenizers = {} # { token_type: tokenizer object }
     if "cl100k_base" in token_types: self.tokenizers["cl100k_base"]= OpenAITokenizer("cl100k_base")
@@ -15,18 +20,99 @@ class Tokenizer():
 
     # must have at least one sub-tokenizer in the tokenizer
     assert (len(self.tokenizers) > 0)
+
+    # content-addressed cache of tokenized lengths shared by all sub-tokenizers. cache_size=0 disables it.
+    self.cache = TokenLengthCache(cache_size) if cache_size > 0 else None
+
+    # runs the sub-tokenizers concurrently during batch re-tokenization, created on first use (and again in a forked child)
+    self.executor = None
+    self.executor_pid = None
   
   def calculate_tokenized_length(self, text):
     lengths = {} # { token_type: tokenized_length }
     for token_type in self.tokenizers:
-      lengths[token_type] = self.tokenizers[token_type].calculate_tokenized_length(text)
+      lengths[token_type] = self.cached_tokenized_length(token_type, text)
     return lengths
+
+
+  def cached_tokenized_length(self, token_type, text):
+    '''
+    Returns the tokenized length of text for a single sub-tokenizer, only running the sub-tokenizer on a cache miss.
+    '''
+    if self.cache is None:
+      return self.tokenizers[token_type].calculate_tokenized_length(text)
+
+    key = self.cache.key(token_type, text)
+    tl = self.cache.get(key)
+    if tl is None:
+      tl = self.tokenizers[token_type].calculate_tokenized_length(text)
+      self.cache.put(key, tl)
+    return tl
+
+
+  def incremental_counter(self):
+    '''
+    Returns a counter that tokenizes a streamed text as it arrives (see IncrementalTokenCounter).
+    '''
+    return IncrementalTokenCounter(self)
+
+
+  def estimate_tokenized_length(self, text):
+    '''
+    Returns { token_type: (lower, upper) } calibrated estimates of the tokenized length of text, without running any
+    encoder (see EstimatorCalibration).
+    '''
+    bounds = {}
+    for token_type in self.tokenizers:
+      bounds[token_type] = self.tokenizers[token_type].estimate_tokenized_length(text)
+    return bounds
+
+
+  def within_tokenized_length(self, text, token_type, limit):
+    '''
+    Returns whether the tokenized length of text is <= limit. Decided on the sub-tokenizer's vocabulary bounds, which
+    hold for any text, and only encodes (through the cache) when they straddle the limit.
+    '''
+    lower, upper = self.tokenizers[token_type].tokenized_length_bounds(text)
+    if upper <= limit: return True
+    if lower > limit: return False
+    return self.cached_tokenized_length(token_type, text) <= limit
+
+
+  def cache_stats(self):
+    return self.cache.stats() if self.cache is not None else None
   
 
+  def calculate_tokenized_lengths(self, token_type, texts):
+    '''
+    Batch version of cached_tokenized_length: returns the tokenized length of every text in texts for a single
+    sub-tokenizer. Cache misses are de-duplicated and encoded in one batch call.
+    '''
+    tls = [None] * len(texts)
+    misses = {} # { text: [indices of texts equal to it] }
+
+    for i, text in enumerate(texts):
+      tl = self.cache.get(self.cache.key(token_type, text)) if self.cache is not None else None
+      if tl is None: misses.setdefault(text, []).append(i)
+      else: tls[i] = tl
+
+    if misses:
+      miss_texts = list(misses)
+      miss_tls = self.tokenizers[token_type].calculate_tokenized_lengths(miss_texts, self.num_threads)
+
+      for text, tl in zip(miss_texts, miss_tls):
+        if self.cache is not None: self.cache.put(self.cache.key(token_type, text), tl)
+        for i in misses[text]:
+          tls[i] = tl
+
+    return tls
+
+
   def update_token_context(self, messages):
     '''
     Retokenizes all the messages in messages according to the subtokenizers. Returns a list of modified messages along with their
     total token lengths.
+    Note: the whole window is encoded as one batch per sub-tokenizer, with the sub-tokenizers running concurrently.
     '''
     # get the current token length
     window_tls = {}
@@ -34,15 +120,32 @@ class Tokenizer():
     # initialize window_tls to zero
     for token_type in self.tokenizers:
       window_tls[token_type] = 0
-    
-    # tokenize the messages
-    for message in messages:
-      tls = self.calculate_tokenized_length(message["content"])
-      message["token_lengths"] = tls
 
-      # iterate through token_types, the keys of tls
-      for token_type in tls:
+    if len(messages) == 0: return (messages, window_tls)
+
+    texts = [message["content"] for message in messages]
+
+    # tokenize the window with every sub-tokenizer
+    batch_tls = {} # { token_type: [tokenized_length per message] }
+    if len(self.tokenizers) == 1:
+      for token_type in self.tokenizers:
+        batch_tls[token_type] = self.calculate_tokenized_lengths(token_type, texts)
+
+    else:
+      if self.executor is None or self.executor_pid != os.getpid():
+        self.executor = ThreadPoolExecutor(max_workers=len(self.tokenizers))
+        self.executor_pid = os.getpid()
+      futures = {token_type: self.executor.submit(self.calculate_tokenized_lengths, token_type, texts) for token_type in self.tokenizers}
+      for token_type in futures:
+        batch_tls[token_type] = futures[token_type].result()
+
+    # write the per-message token lengths & sum the window
+    for i, message in enumerate(messages):
+      tls = {}
+      for token_type in batch_tls:
+        tls[token_type] = batch_tls[token_type][i]
         window_tls[token_type] += tls[token_type]
+      message["token_lengths"] = tls
     
     return (messages, window_tls)
 
@@ -64,6 +167,10 @@ def main():
   print(result[0])
   print(result[1])
 
+  # the second pass over the same window is served from the cache
+  tokenizerDouble.update_token_context(texts)
+  print(tokenizerDouble.cache_stats())
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,157 @@
+'''
+Process-wide registry of tokenizer models. Model files are shipped with the package and loaded at most once per process,
+so constructing a tokenizer never touches the network or re-reads a model from disk.
+Models are immutable once loaded, so forked workers share the parent's copy; the registry lock is re-created in the child.
+'''
+
+import os
+import hashlib
+import threading
+from contextlib import contextmanager
+from Tracing import log_event
+
+# directory holding the shipped model files. Can be overridden, e.g. to point at a Lambda layer.
+MODEL_DIR = os.environ.get('aura_tokenizer_model_dir', os.path.dirname(os.path.abspath(__file__)))
+
+# tiktoken rank files ship in a tiktoken cache directory: tiktoken's own encoding constructors (pattern & special tokens)
+# then load them with load_tiktoken_bpe, which checks their sha256, instead of fetching them. tiktoken only takes its
+# cache directory from the environment, so it is pointed at this one for the duration of the load. A TIKTOKEN_CACHE_DIR
+# already set in the environment takes precedence (it must then hold the rank files).
+TIKTOKEN_CACHE_DIR = os.path.join(MODEL_DIR, 'tiktoken_cache')
+
+# tiktoken encodings: where tiktoken fetches each rank file from (its cache file is named by the url)
+TIKTOKEN_MODELS = {
+  "cl100k_base": {
+    "url": "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+  }
+}
+
+# sentencepiece models: local model file
+SENTENCEPIECE_MODELS = {
+  "LLAMASentencePieceBytePairEncoding": {
+    "file": "tokenizer.model"
+  }
+}
+
+models = {} # { token_type: loaded model object }
+models_lock = threading.Lock()
+
+
+def reset_lock_after_fork():
+  # a fork taken while another thread held the lock would leave it locked forever in the child
+  global models_lock
+  models_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=reset_lock_after_fork)
+
+
+def model_path(file_name):
+  return os.path.join(MODEL_DIR, file_name)
+
+
+def tiktoken_cache_path(token_type, cache_dir=None):
+  # tiktoken names cached files by the sha1 of their url
+  url = TIKTOKEN_MODELS[token_type]["url"]
+  return os.path.join(cache_dir or os.environ.get('TIKTOKEN_CACHE_DIR', TIKTOKEN_CACHE_DIR), hashlib.sha1(url.encode()).hexdigest())
+
+
+@contextmanager
+def tiktoken_cache(cache_dir):
+  '''
+  Points tiktoken at cache_dir for the enclosed block, restoring the environment after it.
+  '''
+  previous = os.environ.get('TIKTOKEN_CACHE_DIR')
+  os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir
+  try:
+    yield
+  finally:
+    if previous is None: os.environ.pop('TIKTOKEN_CACHE_DIR', None)
+    else: os.environ['TIKTOKEN_CACHE_DIR'] = previous
+
+
+def load_tiktoken_encoding(token_type):
+  import tiktoken
+
+  path = tiktoken_cache_path(token_type)
+  if os.path.exists(path):
+    with tiktoken_cache(os.path.dirname(path)):
+      return tiktoken.get_encoding(token_type)
+
+  # not shipped: tiktoken fetches it into its own (temporary) cache, which costs this cold start a download
+  log_event('tokenizer_model_not_shipped', token_type=token_type, path=path)
+  return tiktoken.get_encoding(token_type)
+
+
+def load_sentencepiece_processor(token_type):
+  import sentencepiece as spm
+
+  spec = SENTENCEPIECE_MODELS[token_type]
+  with open(model_path(spec["file"]), 'rb') as f:
+    # load from the serialized proto so the path is never resolved relative to the working directory
+    return spm.SentencePieceProcessor(model_proto=f.read())
+
+
+def get_model(token_type):
+  '''
+  Returns the loaded model for token_type, loading it on first use. Thread-safe; each model loads once per process.
+  '''
+  model = models.get(token_type)
+  if model is not None: return model
+
+  with models_lock:
+    # another thread may have loaded it while we waited on the lock
+    if token_type in models: return models[token_type]
+
+    if token_type in TIKTOKEN_MODELS: model = load_tiktoken_encoding(token_type)
+    elif token_type in SENTENCEPIECE_MODELS: model = load_sentencepiece_processor(token_type)
+    else: raise ValueError(f"Unknown token type: {token_type}")
+
+    models[token_type] = model
+    return model
+
+
+def preload(token_types):
+  '''
+  Loads every model in token_types. Call at module import so the work happens in the Lambda init phase.
+  '''
+  for token_type in token_types:
+    get_model(token_type)
+
+
+def fetch_models(cache_dir=TIKTOKEN_CACHE_DIR):
+  '''
+  Vendors the tiktoken rank files: fetches any missing one into cache_dir (by default the shipped directory, whatever
+  the environment's TIKTOKEN_CACHE_DIR). Run at build time, before packaging, so they ship with the package. tiktoken
+  checks each file's sha256 before caching it.
+  '''
+  import tiktoken
+
+  os.makedirs(cache_dir, exist_ok=True)
+  for token_type in TIKTOKEN_MODELS:
+    path = tiktoken_cache_path(token_type, cache_dir)
+    if os.path.exists(path): continue
+
+    with tiktoken_cache(cache_dir):
+      tiktoken.get_encoding(token_type)
+
+    if not os.path.exists(path): raise ValueError(f"tiktoken did not cache the {token_type} rank file")
+    print(f"fetched {token_type} -> {path}")
+
+
+def missing_models(cache_dir=TIKTOKEN_CACHE_DIR):
+  '''
+  Returns the tiktoken token types whose rank file isn't vendored in cache_dir.
+  '''
+  return [token_type for token_type in TIKTOKEN_MODELS if not os.path.exists(tiktoken_cache_path(token_type, cache_dir))]
+
+
+if __name__ == "__main__":
+  import sys
+
+  # --check: fail the build instead of shipping a package whose cold starts fetch the rank files
+  if '--check' in sys.argv[1:]:
+    missing = missing_models()
+    if missing: sys.exit(f"rank files not vendored in {TIKTOKEN_CACHE_DIR}: {', '.join(missing)}")
+  else:
+    fetch_models()
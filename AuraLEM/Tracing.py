@@ -0,0 +1,203 @@
+'''
+Per-invocation tracing: stage spans, counters (e.g. DynamoDB calls & consumed capacity, ELAM validation retries) and
+sampled values (e.g. time to first token, inter-token gaps) of one invocation, emitted when it finishes as one log line
+in CloudWatch's embedded metric format (EMF), which CloudWatch turns into metrics of the "namespace" setting.
+
+Off unless configured (the "tracing" cw_config entry, or the aura_tracing environment variable holding its JSON, which
+worker processes inherit). Off, or for an invocation not sampled, current_trace() is None: span() returns a shared no-op
+context manager and count() / observe() return at once, so instrumented code pays one context variable lookup.
+The trace follows the invocation through asyncio tasks, and into threads started with the context copied
+(contextvars.copy_context().run).
+'''
+
+import os
+import time
+import random
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+import simplejson as json
+from StageTimer import StageTimer
+
+DEFAULT_SETTINGS = {
+  "namespace": "AuraLEM", # CloudWatch metric namespace
+  "sample_rate": 1.0, # fraction of invocations traced
+  "max_samples": 100 # values kept per sampled metric (EMF takes at most 100 per metric)
+}
+
+# the trace of the invocation running in this context, or None
+current = contextvars.ContextVar('aura_trace', default=None)
+
+settings = None # None: not configured yet (see tracing_settings)
+disabled = False
+no_span = nullcontext()
+sampler = random.Random() # its own generator: sampling leaves the global random sequence alone
+
+# where finished traces go: Lambda ships stdout to CloudWatch Logs, which extracts EMF lines
+def print_line(line):
+  print(line, flush=True)
+
+sink = print_line
+
+
+class Trace(StageTimer):
+  '''
+  A StageTimer that also totals the time spent in each stage (a stage can run more than once, e.g. a turn drained
+  from the mailbox), and keeps counters & sampled values. Thread-safe.
+  '''
+
+  def __init__(self, function, settings):
+    super().__init__()
+    self.function = function
+    self.settings = settings
+    self.durations = {} # { stage: seconds, summed }
+    self.counters = {} # { name: value }
+    self.samples = {} # { name: [value, ...] }
+    self.units = {} # { metric name: EMF unit }
+    self.properties = {} # logged with the metrics, not metrics themselves
+    self.lock = threading.Lock()
+
+
+  @contextmanager
+  def stage(self, name):
+    stage_start = time.perf_counter()
+    try:
+      yield
+    finally:
+      duration = time.perf_counter() - stage_start
+      with self.lock:
+        self.stages[name] = (stage_start - self.start, duration)
+        self.durations[name] = self.durations.get(name, 0.0) + duration
+
+
+  def count(self, name, value=1, unit='Count'):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+      self.units[name] = unit
+
+
+  def observe(self, name, value, unit='Milliseconds'):
+    with self.lock:
+      samples = self.samples.setdefault(name, [])
+      if len(samples) < self.settings["max_samples"]: samples.append(value)
+      self.units[name] = unit
+
+
+  def set_property(self, name, value):
+    with self.lock:
+      self.properties[name] = value
+
+
+  def emf(self):
+    '''
+    Returns the trace as an EMF log record: one metric per stage (<stage>_ms), counter and sampled value, dimensioned
+    by function.
+    '''
+    with self.lock:
+      values = {'total_ms': (time.perf_counter() - self.start) * 1000}
+      units = {'total_ms': 'Milliseconds'}
+
+      for name, duration in self.durations.items():
+        values[f'{name}_ms'] = duration * 1000
+        units[f'{name}_ms'] = 'Milliseconds'
+
+      for name, value in self.counters.items(): values[name] = value
+      for name, samples in self.samples.items(): values[name] = list(samples)
+      units.update(self.units)
+
+      record = dict(self.properties)
+      record.update(values)
+      record['function'] = self.function
+      record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+          'Namespace': self.settings["namespace"],
+          'Dimensions': [['function']],
+          'Metrics': [{'Name': name, 'Unit': units[name]} for name in values]
+        }]
+      }
+      return record
+
+
+def configure_tracing(cw_config):
+  '''
+  Applies cw_config's "tracing" entry (None keeps the environment's selection).
+  '''
+  global settings, disabled
+  if cw_config.get("tracing") is not None:
+    settings = dict(DEFAULT_SETTINGS, **cw_config["tracing"])
+    disabled = False
+
+
+def tracing_settings():
+  '''
+  Returns the process's tracing settings, or None if tracing is off. Unless configured, they are read from the
+  aura_tracing environment variable (JSON settings, e.g. '{"namespace": "AuraLEM"}').
+  '''
+  global settings, disabled
+  if settings is None and not disabled:
+    environment_settings = os.environ.get('aura_tracing')
+    if environment_settings: settings = dict(DEFAULT_SETTINGS, **json.loads(environment_settings))
+    else: disabled = True
+  return settings
+
+
+def set_trace_sink(function):
+  '''
+  Sends finished traces' EMF lines to function(line) instead of stdout (e.g. to collect them in a load test).
+  '''
+  global sink
+  sink = function
+
+
+@contextmanager
+def traced_invocation(function, context=None):
+  '''
+  Traces the enclosed invocation of function (if tracing is on and it is sampled), emitting it when the block exits.
+  Yields the Trace, or None.
+  '''
+  trace_settings = tracing_settings()
+  if trace_settings is None or (trace_settings["sample_rate"] < 1 and sampler.random() >= trace_settings["sample_rate"]):
+    yield None
+    return
+
+  trace = Trace(function, trace_settings)
+  request_id = getattr(context, 'aws_request_id', None)
+  if request_id is not None: trace.set_property('request_id', request_id)
+
+  token = current.set(trace)
+  try:
+    yield trace
+  finally:
+    current.reset(token)
+    sink(json.dumps(trace.emf()))
+
+
+def current_trace():
+  return current.get()
+
+
+def span(name):
+  '''
+  Times the enclosed block as stage name of the current trace.
+  '''
+  trace = current.get()
+  return trace.stage(name) if trace is not None else no_span
+
+
+def count(name, value=1, unit='Count'):
+  trace = current.get()
+  if trace is not None: trace.count(name, value, unit)
+
+
+def observe(name, value, unit='Milliseconds'):
+  trace = current.get()
+  if trace is not None: trace.observe(name, value, unit)
+
+
+def log_event(name, **properties):
+  '''
+  Logs an event outside any trace (e.g. a cold start warning) as one JSON line on stdout, where CloudWatch Logs can
+  filter on its "event" field. Not sent to the trace sink, which only takes EMF lines.
+  '''
+  print_line(json.dumps(dict(properties, event=name)))
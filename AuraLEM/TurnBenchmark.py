@@ -0,0 +1,370 @@
+'''
+Benchmark of the stages of a LEMChat turn, with the in-memory store and a zero-latency FakeOpenAIServer in place of
+DynamoDB and OpenAI, so the numbers are the LEM's own overhead. Runs every (cw_config preset, history size, context
+cache state) combination: the thread is seeded with history_size messages and its chat history & analysis window hold
+as many of them as the preset's token budgets allow (a full analysis window makes every turn queue an analysis). Each
+turn is timed stage by stage, then replayed under tracemalloc for allocations.
+
+Prints JSON results ({ 'runs': [{ 'preset', 'history_size', 'context_cache', 'window', 'stages': { stage: { 'p50_ms',
+'p95_ms', 'p99_ms', 'alloc_peak_bytes', ... } } }] }). --compare checks them against a previous run's and exits 1 if
+a stage's p50 regressed.
+
+Run from AuraLEM/: python TurnBenchmark.py --out results.json [--compare baseline.json]
+'''
+
+import os
+import sys
+import random
+import argparse
+import platform
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import simplejson as json
+from CW_configs import get_cw_config
+from StageTimer import StageTimer
+from LEMChatUtilities import *
+from ContextCache import context_cache
+from Tokenizers.Tokenizer import Tokenizer
+from Tokenizers.EstimatorBenchmark import SAMPLE_CORPUS
+from AuraStorage.MemoryBackend import MemoryBackend
+from AuraOpenAI.FakeOpenAIServer import FakeOpenAIServer
+from AuraOpenAI.ClientRegistry import configure_openai_clients
+from AuraELKs.OpenAIELKs import synthesize_response
+from AuraELAM.OpenAIELAM import build_elam_messages
+from LEMTestUtilities import NullConn
+
+STAGES = [
+  'message_from_content', 'validate_inputs', 'tokenize_message', 'get_context_window_meta', 'idempotency_lock',
+  'get_context_window', 'validate_context_window', 'synthesize_response', 'update_context_window', 'synchronize_ddb',
+  'build_elam_messages'
+]
+
+PRESETS = ['local_test_small', 'production']
+HISTORY_SIZES = [0, 8, 64, 512]
+CACHE_STATES = ['cold', 'warm']
+
+API_KEY, UID, IID = 'bench', 'user', 'intelligence'
+
+# a UDS of the size the ELAM keeps (10 entries per list & a summary)
+BENCHMARK_UDS = {
+  'basic_info': {'name': 'Sam Rivera', 'current_location': 'Lisbon', 'occupation': 'Product manager', 'sex': ''},
+  'traits': [[f'trait {i}', 40 + 5 * i, 'shows up repeatedly in how they describe their plans and their week.'] for i in range(10)],
+  'skills': [[f'skill {i}', 30 + 6 * i, 'mentioned with specific, first-hand detail across several chats.'] for i in range(10)],
+  'factual_history': [f'event {i}: moved, changed jobs or travelled, as told in a past chat.' for i in range(10)],
+  'summary': 'A curious and methodical user who likes to think out loud about work, travel and learning. ' * 6
+}
+
+
+def percentile(sorted_samples, q):
+  # linearly interpolated, like numpy's default
+  if not sorted_samples: return None
+  position = (len(sorted_samples) - 1) * q
+  lower = int(position)
+  upper = min(lower + 1, len(sorted_samples) - 1)
+  return sorted_samples[lower] + (sorted_samples[upper] - sorted_samples[lower]) * (position - lower)
+
+
+def summarize(samples):
+  samples = sorted(samples)
+  return {
+    'p50': percentile(samples, 0.5),
+    'p95': percentile(samples, 0.95),
+    'p99': percentile(samples, 0.99),
+    'mean': sum(samples) / len(samples) if samples else None,
+    'max': samples[-1] if samples else None
+  }
+
+
+class AllocationProbe():
+  '''
+  Same stage() interface as StageTimer, recording each stage's tracemalloc peak above its starting point, the bytes it
+  left allocated and the net memory blocks it allocated. tracemalloc must be tracing.
+  '''
+
+  def __init__(self):
+    self.stages = {} # { stage_name: (peak_bytes, net_bytes, net_blocks) }
+
+
+  @contextmanager
+  def stage(self, name):
+    tracemalloc.reset_peak()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    start_blocks = sys.getallocatedblocks()
+    try:
+      yield
+    finally:
+      current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+      self.stages[name] = (peak_bytes - start_bytes, current_bytes - start_bytes, sys.getallocatedblocks() - start_blocks)
+
+
+def history_contents(cw_config, tokenizer, margin=0):
+  # messages the LEM would have accepted under this preset (with margin tokens to spare): within the um & im limits
+  limit = min(cw_config["elks_um_mtl"], cw_config["elam_um_mtl"], cw_config["elks_response_mtl"], cw_config["elam_im_mtl"]) - margin
+  contents = []
+  for text in SAMPLE_CORPUS:
+    token_lengths = tokenizer.calculate_tokenized_length(text)
+    if text and max(token_lengths.values()) <= limit: contents.append((text, token_lengths))
+  return contents
+
+
+def seed_thread(cw_config, tokenizer, history_size, rng):
+  '''
+  Returns the items of a thread with history_size messages (oldest first) and an unlocked cwm whose chat history and
+  analysis window hold as many of the newest messages as the preset's budgets allow.
+  '''
+  contents = history_contents(cw_config, tokenizer)
+  start = datetime(2020, 1, 1)
+
+  messages = []
+  for i in range(history_size):
+    content, token_lengths = rng.choice(contents)
+    messages.append({
+      'content': content,
+      'role': 'user' if i % 2 == 0 else 'intelligence',
+      'token_lengths': dict(token_lengths),
+      'sortk': (start + timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%S.%f') + '+0000',
+      'partitionk': API_KEY + UID + IID + 'messages',
+      'uid': UID,
+      'iid': IID
+    })
+
+  def fill(token_type, budget):
+    # the newest messages that fit in budget, as (count, tokens)
+    count, tokens = 0, 0
+    for message in reversed(messages):
+      if tokens + message['token_lengths'][token_type] > budget: break
+      count, tokens = count + 1, tokens + message['token_lengths'][token_type]
+    return count, tokens
+
+  ch_message_count, elks_ch_token_length = fill(cw_config["elks_token_type"], cw_config["elks_ch_mtl"])
+  aw_message_count, elam_aw_token_length = fill(cw_config["elam_token_type"], cw_config["elam_aw_mtl"])
+
+  context_window_meta = {
+    'partitionk': API_KEY + UID + IID + 'ch_context_window_meta',
+    'sortk': start.strftime('%Y-%m-%dT%H:%M:%S.%f') + '+0000',
+    'idempotency_lock': False,
+    'elam_aw_token_length': elam_aw_token_length,
+    'elam_token_type': cw_config["elam_token_type"],
+    'aw_message_count': aw_message_count,
+    'elam_aw_mtl': cw_config["elam_aw_mtl"],
+    'elks_ch_token_length': elks_ch_token_length,
+    'elks_token_type': cw_config["elks_token_type"],
+    'ch_message_count': ch_message_count,
+    'elks_ch_mtl': cw_config["elks_ch_mtl"],
+    'cw_version': 1
+  }
+  uds = {'partitionk': API_KEY + UID + IID + 'UDS', 'sortk': context_window_meta['sortk'], 'uds': BENCHMARK_UDS}
+
+  return messages + [context_window_meta, uds]
+
+
+def run_turn_stages(probe, cw_config, tokenizer, conn, um_content):
+  '''
+  Runs one turn of LEMChat.lambda_handler's pipeline, each stage under probe.stage(name).
+  '''
+  with probe.stage('message_from_content'):
+    um = message_from_content(um_content, API_KEY, UID, IID, tokenizer, tokenize=False)
+
+  with probe.stage('validate_inputs'):
+    input_validation_response = validate_inputs(um, False, cw_config, tokenizer)
+  if input_validation_response["statusCode"] != 200: raise RuntimeError(f'Benchmark message rejected: {input_validation_response["response"]}')
+
+  with probe.stage('tokenize_message'):
+    um = tokenize_message(um, tokenizer)
+
+  with probe.stage('get_context_window_meta'):
+    cwm_response = get_context_window_meta(API_KEY, UID, IID, cw_config)
+
+  with probe.stage('idempotency_lock'):
+    idempotency_response = idempotency_lock(cwm_response)
+  if idempotency_response["statusCode"] != 200: raise RuntimeError('Benchmark thread is locked')
+
+  with probe.stage('get_context_window'):
+    cw_response = get_context_window(cwm_response)
+
+  with probe.stage('validate_context_window'):
+    cw_response, cwm_response = validate_context_window(cw_response, cwm_response, tokenizer)
+
+  with probe.stage('synthesize_response'):
+    im = synthesize_response(cw_response, cw_config, um, tokenizer, 'bench', conn)
+
+  with probe.stage('update_context_window'):
+    analysis_input, context_window_meta = update_context_window(cwm_response, cw_response, cw_config, um, im, False)
+
+  with probe.stage('synchronize_ddb'):
+    sync_response = synchronize_ddb(context_window_meta, um, im, cw_response)
+  if sync_response['statusCode'] != 200: raise RuntimeError(f'Benchmark turn not recorded: {sync_response}')
+
+  # the prompt of the analysis this turn queued (or of a force_reflect, if none was)
+  analysis_window = analysis_input.get('analysis_window', window_from_limits([len(cw_response['aw']) + 2, 0], um, im, cw_response['aw']))
+  with probe.stage('build_elam_messages'):
+    build_elam_messages(cw_response['uds'], analysis_window)
+
+
+def benchmark_run(preset, history_size, cache_state, server_url, iterations=50, allocation_iterations=10, warmup=3, seed=0):
+  '''
+  Returns the results of one (preset, history size, cache state) combination.
+  '''
+  cw_config = get_cw_config(preset)
+  cw_config["openai_client"] = {"base_url": server_url}
+  configure_openai_clients(cw_config)
+
+  tokenizer = Tokenizer({cw_config["elks_token_type"], cw_config["elam_token_type"]})
+  conn = NullConn()
+  rng = random.Random(f'{seed}:{preset}:{history_size}')
+  items = seed_thread(cw_config, tokenizer, history_size, rng)
+  # room for the turn number appended to each user message
+  um_contents = [content for content, _ in history_contents(cw_config, tokenizer, margin=4)]
+
+  timings = {stage: [] for stage in STAGES}
+  timings['turn'] = []
+  allocations = {stage: [] for stage in STAGES}
+
+  for i in range(warmup + iterations + allocation_iterations):
+    # every turn starts from the same seeded thread, with a message the tokenizer cache hasn't seen
+    set_storage(MemoryBackend())
+    put_items_ddb(items)
+    context_cache.clear()
+    if cache_state == 'warm': get_context_window(get_context_window_meta(API_KEY, UID, IID, cw_config))
+    um_content = f'{rng.choice(um_contents)} {i}'
+
+    if i < warmup + iterations:
+      timer = StageTimer()
+      run_turn_stages(timer, cw_config, tokenizer, conn, um_content)
+      if i < warmup: continue
+
+      for stage, (_, duration) in timer.stages.items(): timings[stage].append(duration * 1000)
+      timings['turn'].append(timer.report()['total_ms'])
+
+    else:
+      probe = AllocationProbe()
+      tracemalloc.start()
+      try:
+        run_turn_stages(probe, cw_config, tokenizer, conn, um_content)
+      finally:
+        tracemalloc.stop()
+      for stage, allocation in probe.stages.items(): allocations[stage].append(allocation)
+
+  context_window_meta = items[-2]
+  stages = {}
+  for stage in STAGES + ['turn']:
+    stages[stage] = {f'{name}_ms': value for name, value in summarize(timings[stage]).items()}
+    if allocations.get(stage):
+      # medians over the traced turns
+      stages[stage]['alloc_peak_bytes'] = percentile(sorted(allocation[0] for allocation in allocations[stage]), 0.5)
+      stages[stage]['alloc_net_bytes'] = percentile(sorted(allocation[1] for allocation in allocations[stage]), 0.5)
+      stages[stage]['alloc_net_blocks'] = percentile(sorted(allocation[2] for allocation in allocations[stage]), 0.5)
+
+  return {
+    'preset': preset,
+    'history_size': history_size,
+    'context_cache': cache_state,
+    'window': {
+      'ch_messages': context_window_meta['ch_message_count'],
+      'ch_tokens': context_window_meta['elks_ch_token_length'],
+      'aw_messages': context_window_meta['aw_message_count'],
+      'aw_tokens': context_window_meta['elam_aw_token_length']
+    },
+    'iterations': iterations,
+    'allocation_iterations': allocation_iterations,
+    'stages': stages
+  }
+
+
+def benchmark(presets=PRESETS, history_sizes=HISTORY_SIZES, cache_states=CACHE_STATES, iterations=50, allocation_iterations=10, seed=0):
+  # the API key is never sent anywhere: the clients talk to the fake server
+  os.environ.setdefault('openai_key', 'benchmark')
+  server = FakeOpenAIServer({'seed': seed}).start()
+
+  try:
+    runs = []
+    for preset in presets:
+      for history_size in history_sizes:
+        for cache_state in cache_states:
+          runs.append(benchmark_run(preset, history_size, cache_state, server.url, iterations, allocation_iterations, seed=seed))
+  finally:
+    server.stop()
+
+  return {
+    'benchmark': 'turn_stages',
+    'created': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'storage': 'memory',
+    'runs': runs
+  }
+
+
+def run_key(run):
+  return (run['preset'], run['history_size'], run['context_cache'])
+
+
+def compare(results, baseline, tolerance=0.25, min_delta_ms=0.1):
+  '''
+  Returns the stages whose p50 is more than tolerance (relative) and min_delta_ms (absolute) slower than in baseline,
+  as [{ 'run', 'stage', 'baseline_p50_ms', 'p50_ms' }]. Combinations missing from either side are skipped.
+  '''
+  baseline_runs = {run_key(run): run for run in baseline['runs']}
+  regressions = []
+
+  for run in results['runs']:
+    baseline_run = baseline_runs.get(run_key(run))
+    if baseline_run is None: continue
+
+    for stage, summary in run['stages'].items():
+      baseline_p50 = baseline_run['stages'].get(stage, {}).get('p50_ms')
+      if baseline_p50 is None or summary['p50_ms'] is None: continue
+
+      if summary['p50_ms'] > baseline_p50 * (1 + tolerance) and summary['p50_ms'] - baseline_p50 > min_delta_ms:
+        regressions.append({'run': list(run_key(run)), 'stage': stage, 'baseline_p50_ms': baseline_p50, 'p50_ms': summary['p50_ms']})
+
+  return regressions
+
+
+def print_summary(results, file=sys.stderr):
+  for run in results['runs']:
+    window = run['window']
+    print(f"\n{run['preset']}, {run['history_size']} messages, {run['context_cache']} cache "
+      f"(ch {window['ch_messages']} msgs / {window['ch_tokens']} tokens, aw {window['aw_messages']} msgs / {window['aw_tokens']} tokens)", file=file)
+    print(f"  {'stage':<26}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KB':>10}{'blocks':>8}", file=file)
+
+    for stage, summary in run['stages'].items():
+      peak_kb = summary['alloc_peak_bytes'] / 1024 if 'alloc_peak_bytes' in summary else float('nan')
+      blocks = summary.get('alloc_net_blocks', float('nan'))
+      print(f"  {stage:<26}{summary['p50_ms']:>10.3f}{summary['p95_ms']:>10.3f}{summary['p99_ms']:>10.3f}{peak_kb:>10.1f}{blocks:>8.0f}", file=file)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Per-stage benchmark of the LEMChat turn pipeline.')
+  parser.add_argument('--presets', nargs='+', default=PRESETS)
+  parser.add_argument('--history-sizes', nargs='+', type=int, default=HISTORY_SIZES)
+  parser.add_argument('--cache', nargs='+', choices=CACHE_STATES, default=CACHE_STATES)
+  parser.add_argument('--iterations', type=int, default=50, help='timed turns per combination')
+  parser.add_argument('--allocation-iterations', type=int, default=10, help='turns traced for allocations per combination')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--out', help='write the JSON results here instead of stdout')
+  parser.add_argument('--compare', help='JSON results of a previous run to check for p50 regressions')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='relative p50 slowdown counted as a regression')
+  parser.add_argument('--min-delta-ms', type=float, default=0.1, help='smaller p50 slowdowns are noise, whatever their ratio')
+  args = parser.parse_args()
+
+  results = benchmark(args.presets, args.history_sizes, args.cache, args.iterations, args.allocation_iterations, args.seed)
+  print_summary(results)
+
+  if args.out:
+    with open(args.out, 'w') as out_file: json.dump(results, out_file, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+
+  if args.compare:
+    with open(args.compare) as baseline_file: baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+
+    for regression in regressions:
+      print(f"REGRESSION {regression['run']} {regression['stage']}: p50 {regression['baseline_p50_ms']:.3f} -> {regression['p50_ms']:.3f} ms", file=sys.stderr)
+    if regressions: sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()